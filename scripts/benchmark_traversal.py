@@ -0,0 +1,65 @@
+"""Benchmarks MachineTraverser against the recursive generator traversal
+it replaced, on the machines of a definition file.
+
+Usage: python benchmark_traversal.py definition_file plural_file
+                                     [printname_index]
+
+For each definition machine, the nodes are collected by both traversals
+(the results are checked to be the same) and the time of each is printed.
+"""
+import sys
+import time
+
+from pymachine.definition_parser import read
+from pymachine.utils import MachineTraverser
+
+class RecursiveTraverser():
+    """The generator version of MachineTraverser.get_nodes()."""
+    def __init__(self):
+        self.seen_for_nodes = set()
+
+    def get_nodes(self, machine):
+        if machine in self.seen_for_nodes:
+            return
+        self.seen_for_nodes.add(machine)
+        name = machine.printname()
+        if not name.isupper():
+            yield name
+        for part in machine.partitions:
+            for submachine in part:
+                for node in self.get_nodes(submachine):
+                    yield node
+        for parent, _ in machine.parents:
+            for node in self.get_nodes(parent):
+                yield node
+
+def main():
+    if len(sys.argv) not in (3, 4):
+        print __doc__
+        sys.exit(-1)
+    printname_index = int(sys.argv[3]) if len(sys.argv) == 4 else 0
+    definitions = read(open(sys.argv[1]), sys.argv[2], printname_index,
+                       three_parts=True)
+    machines = [machine for machines in definitions.itervalues()
+                for machine in machines]
+    print '{0} definitions'.format(len(machines))
+
+    sys.setrecursionlimit(100000)
+    start = time.time()
+    recursive = [list(RecursiveTraverser().get_nodes(machine))
+                 for machine in machines]
+    recursive_time = time.time() - start
+
+    start = time.time()
+    iterative = [list(MachineTraverser.get_nodes(machine))
+                 for machine in machines]
+    iterative_time = time.time() - start
+
+    if recursive != iterative:
+        print 'the results differ!'
+    print 'recursive: {0:.2f}s'.format(recursive_time)
+    print 'MachineTraverser: {0:.2f}s'.format(iterative_time)
+    print 'speedup: {0:.2f}x'.format(recursive_time / iterative_time)
+
+if __name__ == "__main__":
+    main()
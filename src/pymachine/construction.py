@@ -38,6 +38,65 @@ class Construction(object):
             self.control.read(machine, dry_run=True)
         return self.control.in_final()
 
+    def matching_sequences(self, machines, max_length):
+        """
+        Returns the sequences of at most @p max_length different machines
+        from @p machines that check() would accept, in the order in which
+        checking all permutations (shorter ones first) would find them.
+
+        The control drives the search: the machines accepted by the
+        matchers of each state are collected first, and a sequence is only
+        extended while some of its states can still lead to a final state.
+        Each matcher is called at most once on each machine.
+        """
+        control = self.control
+        control.check_states()
+        live = control.live_states()
+        final = control.final_states
+        matches = [{} for machine in machines]
+        # state -> indices of the machines matched by its transitions
+        buckets = {}
+        # (states, index) -> the states after reading the machine
+        steps = {}
+        by_length = [[] for i in xrange(max_length)]
+
+        def bucket(state):
+            if state not in buckets:
+                buckets[state] = set(
+                    i for i, machine in enumerate(machines)
+                    if control.targets(state, machine, matches[i]))
+            return buckets[state]
+
+        def step(states, i):
+            if (states, i) not in steps:
+                steps[states, i] = frozenset(control.next_states(
+                    states, machines[i], matches[i]))
+            return steps[states, i]
+
+        def extend(seq, states):
+            if control.sink:
+                # other machines would take the control into no state
+                candidates = sorted(set().union(
+                    *[bucket(state) for state in states]))
+            else:
+                candidates = xrange(len(machines))
+            for i in candidates:
+                if i in seq:
+                    continue
+                new_states = step(states, i)
+                if not new_states & live:
+                    continue
+                new_seq = seq + (i,)
+                if new_states & final:
+                    by_length[len(new_seq) - 1].append(
+                        tuple(machines[j] for j in new_seq))
+                if len(new_seq) < max_length:
+                    extend(new_seq, new_states)
+
+        if control.init_states & live and max_length > 0:
+            extend((), frozenset(control.init_states))
+        return [seq for seqs in by_length for seq in seqs]
+
     def run(self, seq):
         """Shorthand for if check: act."""
         # read the sequence first, and give it to the control
@@ -223,6 +282,11 @@ class VerbConstruction(Construction):
                 # recursive call
                 self.discover_arguments(part_machine, depth=depth+1)
 
+    def matching_sequences(self, machines, max_length):
+        if self.activated:
+            return []
+        return Construction.matching_sequences(self, machines, max_length)
+
     def check(self, seq):
         if self.activated:
             return False
@@ -267,6 +331,11 @@ class AVMConstruction(Construction):
     def check(self, seq):
         return True
 
+    def matching_sequences(self, machines, max_length):
+        """Every sequence is accepted, see check()."""
+        return [seq for length in xrange(1, max_length + 1)
+                for seq in permutations(machines, length)]
+
     def act(self, seq):
         for machine in seq:
             for matcher in self.phi:
@@ -0,0 +1,293 @@
+"""A hand-written parser for the definition grammar of DefinitionParser.
+
+DefinitionGrammar.parse() returns exactly the nested lists that the
+pyparsing grammar built in DefinitionParser.init_parser() returns, but
+every rule is parsed at most once at each position of the input (the
+results are memoized), so the choice between the alternatives of a rule
+does not take exponential time on nested definitions.
+
+The pyparsing semantics are kept:
+    - a '^' rule (Or) takes the alternative with the longest match; of the
+      equally long ones, the first;
+    - a '|' rule (MatchFirst) takes the first alternative that matches;
+    - whitespace is skipped before every token, but not inside the
+      Combine()d words.
+"""
+import logging
+import re
+import string
+import sys
+import time
+
+from pyparsing import ParseException
+
+from constants import avm_pre, deep_pre, enc_pre, id_sep
+
+def _word(chars):
+    """The regexp of a pyparsing Word(@p chars)."""
+    return '[{0}]+'.format(re.escape(chars))
+
+class DefinitionGrammar(object):
+    whitespace = re.compile('[ \t\n\r]*')
+    disambig_id = '(?:{0}[0-9]+)?'.format(re.escape(id_sep))
+    # Combine(Optional("-") + Word(...) + Optional(disambig_id))
+    unary_word = re.compile(
+        '-?' + _word(string.lowercase + "_" + string.digits) + disambig_id)
+    binary_word = re.compile(
+        _word(string.uppercase + "_" + string.digits) + disambig_id)
+    deep_case_word = re.compile(_word(string.uppercase))
+    langspec_word = re.compile(_word(string.uppercase + "_"))
+    avm_word = re.compile(_word(string.ascii_letters + "_"))
+    enc_word = re.compile(_word(string.ascii_letters + string.digits + "_-"))
+
+    def parse(self, s):
+        """The same as DefinitionParser.parse(), see the module docstring."""
+        # pyparsing works on strings with expanded tabs
+        s = s.expandtabs()
+        self.s = s
+        self.memo = {}
+        try:
+            res = self.definition(0)
+            if res is None:
+                raise ParseException(s, 0, "Expected definition")
+            toks, loc = res
+            loc = self.skip(loc)
+            if loc != len(s):
+                raise ParseException(s, loc, "Expected end of text")
+            return DefinitionGrammar.copy(toks)
+        finally:
+            self.s = self.memo = None
+
+    @staticmethod
+    def copy(toks):
+        """Memoized results may be shared, the caller gets fresh lists."""
+        return [DefinitionGrammar.copy(t) if type(t) is list else t
+                for t in toks]
+
+    # Building blocks: each returns (tokens, end position) or None
+
+    def skip(self, loc):
+        return self.whitespace.match(self.s, loc).end()
+
+    def literal(self, loc, lit):
+        loc = self.skip(loc)
+        if self.s.startswith(lit, loc):
+            return [lit], loc + len(lit)
+        return None
+
+    def regexp(self, loc, regexp):
+        loc = self.skip(loc)
+        m = regexp.match(self.s, loc)
+        if m is None:
+            return None
+        return [m.group()], m.end()
+
+    def seq(self, loc, *parts):
+        """
+        Parses @p parts one after the other. A part is a rule (a method) or
+        a literal (a string).
+        """
+        toks = []
+        for part in parts:
+            if isinstance(part, basestring):
+                res = self.literal(loc, part)
+            else:
+                res = part(loc)
+            if res is None:
+                return None
+            toks.extend(res[0])
+            loc = res[1]
+        return toks, loc
+
+    def longest(self, loc, *alternatives):
+        """pyparsing Or: each alternative is a tuple of parts (see seq())."""
+        best = None
+        for parts in alternatives:
+            res = self.seq(loc, *parts)
+            if res is not None and (best is None or res[1] > best[1]):
+                best = res
+        return best
+
+    def first(self, loc, *alternatives):
+        """pyparsing MatchFirst, see longest()."""
+        for parts in alternatives:
+            res = self.seq(loc, *parts)
+            if res is not None:
+                return res
+        return None
+
+    def group(self, res):
+        if res is None:
+            return None
+        return [res[0]], res[1]
+
+    def memoized(self, rule, loc, parse):
+        loc = self.skip(loc)
+        key = rule, loc
+        if key not in self.memo:
+            self.memo[key] = parse(loc)
+        return self.memo[key]
+
+    # The rules of the grammar
+
+    def unary(self, loc):
+        return self.memoized('unary', loc, lambda loc: self.first(
+            loc,
+            (lambda loc: self.regexp(loc, self.unary_word),),
+            (lambda loc: self.group(self.seq(
+                loc, deep_pre,
+                lambda loc: self.regexp(loc, self.deep_case_word))),),
+            (lambda loc: self.group(self.seq(
+                loc, '$', lambda loc: self.regexp(loc, self.langspec_word))),),
+            (lambda loc: self.group(self.seq(
+                loc, avm_pre, lambda loc: self.regexp(loc, self.avm_word))),),
+            (lambda loc: self.group(self.seq(
+                loc, enc_pre, lambda loc: self.regexp(loc, self.enc_word))),),
+            (lambda loc: self.group(self.seq(loc, '<', self.unary, '>')),)))
+
+    def binary(self, loc):
+        return self.memoized('binary', loc, lambda loc: self.first(
+            loc,
+            (lambda loc: self.regexp(loc, self.binary_word),),
+            (lambda loc: self.group(self.seq(loc, deep_pre, 'REL')),)))
+
+    def definition(self, loc):
+        """D -> E | E, D"""
+        def parse(loc):
+            res = self.expression(loc)
+            if res is None:
+                return None
+            toks, loc = list(res[0]), res[1]
+            while True:
+                res = self.seq(loc, ',', self.expression)
+                if res is None:
+                    break
+                # the separator is suppressed
+                toks.extend(res[0][1:])
+                loc = res[1]
+            return [toks], loc
+        return self.memoized('definition', loc, parse)
+
+    def expression(self, loc):
+        return self.memoized('expression', loc, lambda loc: self.group(
+            self.longest(
+                loc,
+                # E -> UE
+                (self.unexpr,),
+                # E -> BE
+                (self.binexpr,),
+                # E -> U ( E )
+                (self.unary, '(', self.expression, ')'),
+                # E -> < E >
+                ('<', self.expression, '>'))))
+
+    def binexpr(self, loc):
+        return self.memoized('binexpr', loc, lambda loc: self.group(
+            self.longest(
+                loc,
+                # BE -> A B
+                (self.argexpr, self.binary),
+                # BE -> B A
+                (self.binary, self.argexpr),
+                # BE -> A B A
+                (self.argexpr, self.binary, self.argexpr),
+                # BE -> B [ E; E ]
+                (self.binary, '[', self.expression, ';', self.expression,
+                 ']'))))
+
+    def unexpr(self, loc):
+        return self.memoized('unexpr', loc, lambda loc: self.group(
+            self.longest(
+                loc,
+                # UE -> U
+                (self.unary,),
+                # UE -> U [ D ]
+                (self.unary, '[', self.definition, ']'),
+                # UE -> U ( U )
+                (self.unary, '(', self.unary, ')'))))
+
+    def argexpr(self, loc):
+        return self.memoized('argexpr', loc, lambda loc: self.group(
+            self.longest(
+                loc,
+                # A -> UE
+                (self.unexpr,),
+                # A -> [ D ]
+                ('[', self.definition, ']'),
+                # A -> < A >
+                ('<', self.argexpr, '>'),
+                # A -> '
+                ("'",))))
+
+def read_definitions(file_name, def_index=7):
+    """The definition fields of the lines of a definition file."""
+    definitions = []
+    for line in open(file_name):
+        fields = line.strip('\n').split('\t')
+        if len(fields) > def_index and fields[def_index] != '':
+            definitions.append(fields[def_index])
+    return definitions
+
+def compare(definitions):
+    """
+    Parses @p definitions with both parsers and returns the ones on which
+    they disagree, as (definition, pyparsing result, DefinitionGrammar
+    result) triples. A failed parse is represented by @c None.
+    """
+    from definition_parser import DefinitionParser
+    parsers = (DefinitionParser({}), DefinitionParser({}, fast_parser=True))
+    differences = []
+    for definition in definitions:
+        results = []
+        for parser in parsers:
+            try:
+                results.append(parser.parse(definition))
+            except ParseException:
+                results.append(None)
+        if results[0] != results[1]:
+            differences.append((definition, results[0], results[1]))
+    return differences
+
+def benchmark(definitions, repeat=1):
+    """
+    Returns the number of definitions parsed per second by the pyparsing
+    grammar and by DefinitionGrammar.
+    """
+    from definition_parser import DefinitionParser
+    speeds = []
+    for fast_parser in (False, True):
+        parser = DefinitionParser({}, fast_parser=fast_parser)
+        start = time.time()
+        for i in xrange(repeat):
+            for definition in definitions:
+                try:
+                    parser.parse(definition)
+                except ParseException:
+                    pass
+        speeds.append(len(definitions) * repeat / (time.time() - start))
+    return speeds
+
+def main():
+    logging.basicConfig(level=logging.INFO,
+                        format="%(asctime)s : %(module)s (%(lineno)s) " +
+                        "- %(levelname)s - %(message)s")
+    if len(sys.argv) != 3 or sys.argv[1] not in ('compare', 'benchmark'):
+        print 'usage: {0} compare|benchmark definition_file'.format(
+            sys.argv[0])
+        sys.exit(-1)
+    definitions = read_definitions(sys.argv[2])
+    if sys.argv[1] == 'compare':
+        differences = compare(definitions)
+        for definition, res1, res2 in differences:
+            print '{0}\n\tpyparsing: {1}\n\tgrammar: {2}'.format(
+                definition, res1, res2)
+        print '{0} definitions, {1} differences'.format(
+            len(definitions), len(differences))
+    else:
+        slow, fast = benchmark(definitions)
+        print 'pyparsing: {0:.1f} definitions/s'.format(slow)
+        print 'DefinitionGrammar: {0:.1f} definitions/s'.format(fast)
+        print 'speedup: {0:.2f}x'.format(fast / slow)
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,12 @@
+import cPickle
+import hashlib
 import logging
+import multiprocessing
+import os
 import sys
 import re
 import string
-from collections import defaultdict
+from collections import defaultdict, MutableMapping
 
 try:
     import pyparsing
@@ -14,9 +18,14 @@ except ImportError:
 from hunmisc.xstring.encoding import decode_from_proszeky
 
 from constants import deep_cases, avm_pre, deep_pre, enc_pre, id_sep
+from definition_grammar import DefinitionGrammar
 from pymachine.machine import Machine
 from pymachine.control import ConceptControl
 
+# the version of the machines built from definitions; increase it whenever
+# a change in the parser changes them, so that cached definitions are rebuilt
+PARSER_VERSION = 1
+
 class ParserException(Exception):
     pass
 
@@ -38,9 +47,18 @@ class DefinitionParser(object):
     unary_p = re.compile("^[a-z_#\-/0-9]+(/[0-9]+)?$")
     binary_p = re.compile("^[A-Z_0-9]+(/[0-9]+)?$")
 
-    def __init__(self, plur_dict):
+    def __init__(self, plur_dict, fast_parser=False):
+        """
+        @param fast_parser if @c True, definitions are parsed by the
+                           hand-written DefinitionGrammar instead of the
+                           pyparsing grammar. The results are the same.
+        """
         self.plur_dict = plur_dict
-        self.init_parser()
+        self.fast_parser = fast_parser
+        if fast_parser:
+            self.grammar = DefinitionGrammar()
+        else:
+            self.init_parser()
 
     @classmethod
     def _is_binary(cls, s):
@@ -175,6 +193,8 @@ class DefinitionParser(object):
         #self.sen = self.definition + LineEnd()
 
     def parse(self, s):
+        if self.fast_parser:
+            return self.grammar.parse(s)
         return self.definition.parseString(s, parseAll=True).asList()
 
     def create_machine(self, name, partitions):
@@ -251,18 +271,15 @@ class DefinitionParser(object):
 
             pn = for_what.printname()
             for p_i, p in enumerate(where.partitions):
-                # change the partition machines
-                for part_m_i, part_m in enumerate(p):
+                # change the partition machines; the partition keeps a
+                # machine only once, so this also unifies the duplicates
+                for part_m in list(p):
                     if part_m.printname() == pn and __has_other(
                             part_m) == is_other:
-                        where.partitions[p_i][part_m_i] = for_what
+                        p.replace(part_m, for_what)
                         for_what.add_parent_link(where, p_i)
-                    __replace(where.partitions[p_i][part_m_i],
-                              for_what, is_other, visited)
-
-                # unification if there is a machine more than once on the same
-                # partition
-                where.partitions[p_i] = list(set(p))
+                        part_m = for_what
+                    __replace(part_m, for_what, is_other, visited)
 
         machines = defaultdict(list)
         __collect_machines(machine, machines, is_root=True)
@@ -493,6 +510,15 @@ class DefinitionParser(object):
         for d in definition:
             yield self.__parse_expr(d, root, loop_to_defendum, three_parts)[0]
 
+    def headword(self, string, printname_index=0):
+        """
+        Returns the printname of the machine parse_into_machines() would
+        build from the line @p string, without parsing the definition.
+        """
+        name = string.split('\t')[printname_index].lower().strip('<>')
+        name = decode_from_proszeky(self.plur_dict.get(name, name))
+        return name.split(id_sep)[0]
+
     def parse_into_machines(self, string, printname_index=0, add_indices=False,
                             loop_to_defendum=True, three_parts=False):
         printname = string.split('\t')[printname_index]
@@ -519,14 +545,128 @@ class DefinitionParser(object):
         return machine
 
 def read(f, plur_filn, printname_index=0, add_indices=False,
-         loop_to_defendum=True, three_parts=False):
+         loop_to_defendum=True, three_parts=False, processes=1,
+         fast_parser=False):
+    """
+    Reads the definitions in @p f into a dictionary: headword -> set of
+    machines.
+    @param processes if larger than 1, the lines of @p f are split into
+                     contiguous ranges, which are parsed by a pool of this
+                     many processes. The result does not depend on the
+                     number of processes.
+    @param fast_parser see DefinitionParser.
+    """
     logging.warning(
         "Will now discard all but the first definition of each \
         headword!".upper())
-    d = defaultdict(set)
     plur_dict = read_plur(open(plur_filn)) if plur_filn else {}
-    dp = DefinitionParser(plur_dict)
-    for line in f:
+    args = (plur_dict, printname_index, add_indices, loop_to_defendum,
+            three_parts, fast_parser)
+    if processes <= 1:
+        return read_lines(f, *args)
+
+    lines = f.readlines()
+    # a few shards per process, so that slower ranges do not hold up the rest
+    shard_num = min(len(lines), processes * 4) or 1
+    shard_size = (len(lines) + shard_num - 1) / shard_num
+    shards = [(lines[i:i + shard_size],) + args
+              for i in xrange(0, len(lines), shard_size)]
+    logging.info('parsing {0} lines in {1} shards with {2} processes'.format(
+        len(lines), len(shards), processes))
+    pool = multiprocessing.Pool(processes)
+    try:
+        results = pool.map(_read_shard, shards)
+    finally:
+        pool.close()
+        pool.join()
+
+    # the shards are merged in the order of the lines, so the first
+    # definition of each headword is kept, as in the sequential case
+    d = defaultdict(set)
+    for shard_d in results:
+        for pn, machines in shard_d.iteritems():
+            if pn not in d:
+                d[pn] = machines
+    return d
+
+def files_hash(file_names, sha=None):
+    """
+    Updates @p sha (a new sha1 object by default) with the contents of
+    @p file_names and returns it. @c None stands for a missing file.
+    """
+    if sha is None:
+        sha = hashlib.sha1()
+    for fn in file_names:
+        if fn is not None:
+            with open(fn, 'rb') as f:
+                for chunk in iter(lambda: f.read(1 << 20), ''):
+                    sha.update(chunk)
+        sha.update('\0')
+    return sha
+
+def cache_file_name(file_name, plur_filn, printname_index=0,
+                    add_indices=False, loop_to_defendum=True,
+                    three_parts=False, cache_dir=None):
+    """The name of the file read_cached() caches its result in."""
+    sha = files_hash((file_name, plur_filn))
+    sha.update(repr((printname_index, add_indices, loop_to_defendum,
+                     three_parts, PARSER_VERSION)))
+    if cache_dir is None:
+        cache_dir = os.path.dirname(os.path.abspath(file_name))
+    cache_prefix = os.path.join(cache_dir, os.path.basename(file_name))
+    return '{0}.{1}.pickle'.format(cache_prefix, sha.hexdigest())
+
+def read_cached(file_name, plur_filn, printname_index=0, add_indices=False,
+                loop_to_defendum=True, three_parts=False, processes=1,
+                fast_parser=False, cache_dir=None):
+    """
+    The same as read(), but the result is cached in a pickle named after
+    the hash of everything it depends on: the contents of the definition
+    and the plural file, the parameters and PARSER_VERSION. The cache is
+    reused as long as none of these change; otherwise the file is parsed
+    again and the stale cache files of @p file_name are removed.
+    @param cache_dir the directory of the cache files; by default, the
+                     directory of @p file_name.
+    """
+    cache_fn = cache_file_name(file_name, plur_filn, printname_index,
+                               add_indices, loop_to_defendum, three_parts,
+                               cache_dir)
+    cache_dir = os.path.dirname(cache_fn)
+    if os.path.exists(cache_fn):
+        logging.info('loading cached definitions from {0}...'.format(
+            cache_fn))
+        try:
+            with open(cache_fn, 'rb') as cache_file:
+                return cPickle.load(cache_file)
+        except (EOFError, ValueError, cPickle.UnpicklingError), e:
+            logging.warning('could not load {0}: {1}'.format(cache_fn, e))
+
+    with open(file_name) as def_file:
+        d = read(def_file, plur_filn, printname_index, add_indices,
+                 loop_to_defendum, three_parts, processes, fast_parser)
+    stale_p = re.compile(
+        re.escape(os.path.basename(file_name)) + r'\.[0-9a-f]{40}\.pickle$')
+    for fn in os.listdir(cache_dir):
+        if stale_p.match(fn):
+            os.remove(os.path.join(cache_dir, fn))
+    try:
+        tmp_fn = cache_fn + '.tmp'
+        with open(tmp_fn, 'wb') as cache_file:
+            cPickle.dump(d, cache_file, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fn, cache_fn)
+    except IOError, e:
+        logging.warning('could not cache definitions: {0}'.format(e))
+    return d
+
+def read_lines(lines, plur_dict, printname_index=0, add_indices=False,
+               loop_to_defendum=True, three_parts=False, fast_parser=False):
+    """
+    Parses definition @p lines, keeping only the first definition of each
+    headword.
+    """
+    d = defaultdict(set)
+    dp = DefinitionParser(plur_dict, fast_parser)
+    for line in lines:
         l = line.strip('\n')
         logging.debug("Parsing: {0}".format(l))
         try:
@@ -547,6 +687,146 @@ def read(f, plur_filn, printname_index=0, add_indices=False,
             logging.error("Error: "+str(pe))
     return d
 
+def _read_shard(args):
+    """Runs read_lines() in a worker process of read()."""
+    return read_lines(*args)
+
+class LazyDefinitions(MutableMapping):
+    """
+    A dictionary of definitions like the one returned by read(), but a
+    definition is only parsed when its headword is first accessed. The
+    byte offsets of the definitions of each headword are indexed when the
+    object is created; the index is saved next to the definition file (as
+    <file>.index) and is only rebuilt if the definition or the plural file
+    changes.
+    """
+    def __init__(self, def_files, plur_filn, add_indices=False,
+                 loop_to_defendum=True, three_parts=False, fast_parser=False):
+        """
+        @param def_files a list of (file name, printname index) pairs. The
+                         definitions of a headword are the union of its
+                         definitions in the files, as in Wrapper.
+        """
+        self.plur_filn = plur_filn
+        self.plur_dict = read_plur(open(plur_filn)) if plur_filn else {}
+        self.parser = DefinitionParser(self.plur_dict, fast_parser)
+        self.add_indices = add_indices
+        self.loop_to_defendum = loop_to_defendum
+        self.three_parts = three_parts
+        self.files = []
+        for file_name, printname_index in def_files:
+            self.files.append((open(file_name, 'rb'), printname_index,
+                               self.__get_index(file_name, printname_index)))
+        # headword -> set of machines, for the definitions already parsed
+        self.parsed = {}
+        self.deleted = set()
+
+    def __file_stamp(self, file_name):
+        if file_name is None:
+            return None
+        stat = os.stat(file_name)
+        return file_name, stat.st_size, stat.st_mtime
+
+    def __get_index(self, file_name, printname_index):
+        """
+        Returns the index {headword: [byte offsets]} of @p file_name. Only
+        non-empty definitions are indexed.
+        """
+        index_fn = '{0}.index'.format(file_name)
+        stamp = (self.__file_stamp(file_name),
+                 self.__file_stamp(self.plur_filn), printname_index)
+        if os.path.exists(index_fn):
+            try:
+                with open(index_fn, 'rb') as index_file:
+                    saved_stamp, index = cPickle.load(index_file)
+                if saved_stamp == stamp:
+                    return index
+            except (EOFError, ValueError, cPickle.UnpicklingError):
+                pass
+            logging.info('definition index {0} is stale'.format(index_fn))
+
+        logging.info('indexing definitions in {0}...'.format(file_name))
+        index = defaultdict(list)
+        with open(file_name, 'rb') as def_file:
+            offset = 0
+            for line in iter(def_file.readline, ''):
+                fields = line.strip('\n').split('\t')
+                # empty definitions are dropped by read(), too
+                if len(fields) == 9 and fields[7] != '':
+                    index[self.parser.headword(
+                        line.strip('\n'), printname_index)].append(offset)
+                offset += len(line)
+        index = dict(index)
+        try:
+            with open(index_fn, 'wb') as index_file:
+                cPickle.dump((stamp, index), index_file,
+                             cPickle.HIGHEST_PROTOCOL)
+        except IOError, e:
+            logging.warning('could not save definition index: {0}'.format(e))
+        return index
+
+    def __parse(self, pn):
+        """Parses the definitions of @p pn the same way read() would."""
+        machines = set()
+        for def_file, printname_index, index in self.files:
+            for offset in index.get(pn, []):
+                def_file.seek(offset)
+                l = def_file.readline().strip('\n')
+                try:
+                    m = self.parser.parse_into_machines(
+                        l, printname_index, self.add_indices,
+                        self.loop_to_defendum, self.three_parts)
+                except pyparsing.ParseException, pe:
+                    print l
+                    logging.error("Error: "+str(pe))
+                    continue
+                if m.partitions[0] == []:
+                    continue
+                # only the first definition of each headword is kept
+                machines.add(m)
+                break
+        return machines
+
+    def __getitem__(self, pn):
+        if pn not in self.parsed:
+            if pn in self.deleted:
+                raise KeyError(pn)
+            machines = self.__parse(pn)
+            if not machines:
+                raise KeyError(pn)
+            self.parsed[pn] = machines
+        return self.parsed[pn]
+
+    def __setitem__(self, pn, machines):
+        self.parsed[pn] = machines
+        self.deleted.discard(pn)
+
+    def __delitem__(self, pn):
+        if pn not in self:
+            raise KeyError(pn)
+        self.parsed.pop(pn, None)
+        self.deleted.add(pn)
+
+    def __contains__(self, pn):
+        if pn in self.parsed:
+            return True
+        return pn not in self.deleted and any(
+            pn in index for _, _, index in self.files)
+
+    def __iter__(self):
+        seen = set()
+        for pn in self.parsed:
+            seen.add(pn)
+            yield pn
+        for _, _, index in self.files:
+            for pn in index:
+                if pn not in seen and pn not in self.deleted:
+                    seen.add(pn)
+                    yield pn
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
 def read_plur(_file):
     plur_dict = {}
     for line in _file:
@@ -7,6 +7,9 @@ from matcher import Matcher
 from avm import AVM
 
 class FSA(object):
+    # reading a machine that matches no transition leaves no active states
+    sink = True
+
     def __init__(self):
         self.states = set()
         self.input_alphabet = set()
@@ -85,6 +88,57 @@ class FSA(object):
         if len(self.final_states) == 0:
             raise Exception("No final/acceptor states in the FSA")
 
+    def live_states(self):
+        """Returns the states from which a final state can be reached."""
+        sources = defaultdict(set)
+        for state, edges in self.transitions.iteritems():
+            for out_state in edges.itervalues():
+                sources[self._out_state(out_state)].add(state)
+        live = set(self.final_states)
+        stack = list(live)
+        while stack:
+            for state in sources[stack.pop()]:
+                if state not in live:
+                    live.add(state)
+                    stack.append(state)
+        return live
+
+    @staticmethod
+    def _out_state(out_state):
+        """The state in the value of a transition."""
+        return out_state
+
+    @staticmethod
+    def _matches(matcher, machine, matches):
+        """
+        Calls @p matcher on @p machine, unless @p matches (a dictionary of
+        the results already computed for @p machine) contains the result.
+        """
+        if matches is None:
+            return matcher.match(machine)
+        if matcher not in matches:
+            matches[matcher] = matcher.match(machine)
+        return matches[matcher]
+
+    def targets(self, state, machine, matches=None):
+        """
+        Returns the states reached from @p state by reading @p machine.
+        @param matches caches the results of the matchers on @p machine.
+        """
+        return [out_state for transition, out_state
+                in self.transitions.get(state, {}).iteritems()
+                if FSA._matches(transition, machine, matches)]
+
+    def next_states(self, states, machine, matches=None):
+        """
+        Returns the states reached from @p states by reading @p machine,
+        without changing the active states.
+        """
+        new_states = set()
+        for state in states:
+            new_states.update(self.targets(state, machine, matches))
+        return new_states
+
     def init_active_states(self):
         self.active_states = set(self.init_states)
 
@@ -115,9 +169,30 @@ class FSA(object):
                 self.read(what_, dry_run=dry_run)
 
 class FST(FSA):
+    # HACK no sink right now: unmatched machines leave the states as they were
+    sink = False
+
     def __init__(self):
         FSA.__init__(self)
 
+    @staticmethod
+    def _out_state(out_state):
+        return out_state[0]
+
+    def targets(self, state, machine, matches=None):
+        """Only the first matching transition is followed (see read_machine)."""
+        for transition, (out_state, operators) in (
+                self.transitions.get(state, {}).iteritems()):
+            if FSA._matches(transition, machine, matches):
+                return [out_state]
+        return []
+
+    def next_states(self, states, machine, matches=None):
+        new_states = FSA.next_states(self, states, machine, matches)
+        if len(new_states) > 0:
+            return new_states
+        return set(states)
+
     def add_transition(self, matcher, operators, input_state, output_state):
         if input_state not in self.states or output_state not in self.states:
             raise ValueError("transition states has to be in states already")
@@ -0,0 +1,71 @@
+"""Resolves the surface forms of words to the headwords of definitions."""
+import logging
+
+from stemming.porter2 import stem
+
+from pymachine.constants import avm_pre, deep_pre, enc_pre
+
+class LemmaIndex():
+    """
+    Maps words to headwords with three lookups, built once from the
+    headwords and a plural dictionary ({plural: singular}, see
+    definition_parser.read_plur()):
+        - the surface index maps each headword to itself, and the lowercase
+          forms and the plurals of the headwords to the headwords;
+        - the stem index maps the Porter2 stems of the headwords to the
+          headwords they belong to; stems shared by several headwords are
+          mapped to @c None, since there is no telling which one is meant;
+        - the results of get(), misses included, are memoized.
+    Binary relations (uppercase), deep cases, AVMs and entities are only
+    found by their exact printnames.
+    """
+    def __init__(self, headwords, plur_dict=None):
+        headwords = sorted(headwords)
+        words = [headword for headword in headwords
+                 if LemmaIndex.is_word(headword)]
+        self.surface = dict((headword, headword) for headword in headwords)
+        for headword in words:
+            self.surface.setdefault(headword.lower(), headword)
+        for plural, singular in (plur_dict or {}).iteritems():
+            if singular in self.surface:
+                self.surface.setdefault(plural, self.surface[singular])
+        self.stems = {}
+        for headword in words:
+            word_stem = stem(headword.lower())
+            if self.stems.setdefault(word_stem, headword) != headword:
+                self.stems[word_stem] = None
+        self.cache = {}
+        logging.info('indexed {0} surface forms and {1} stems'.format(
+            len(self.surface), len(self.stems)) + ' ({0} ambiguous)'.format(
+                sum(1 for headword in self.stems.itervalues()
+                    if headword is None)))
+
+    @staticmethod
+    def is_word(headword):
+        return (headword != '' and not headword.isupper() and
+                headword[0] not in (avm_pre, deep_pre, enc_pre))
+
+    def get(self, word, existing_only=True, stem_first=True):
+        """
+        Returns the headword of @p word. If there is none, @p word itself,
+        or @c None if @p existing_only.
+        @param stem_first whether to look for the stem of @p word among
+                          the stems of the headwords.
+        """
+        key = word, existing_only, stem_first
+        if key in self.cache:
+            return self.cache[key]
+        lemma = self.surface.get(word)
+        if lemma is None:
+            lemma = self.surface.get(word.lower())
+        if lemma is None and stem_first:
+            lemma = self.stems.get(stem(word.lower()))
+        if lemma is None and not existing_only:
+            lemma = word
+        self.cache[key] = lemma
+        return lemma
+
+    def get_all(self, words, existing_only=True, stem_first=True):
+        """The headwords of @p words, as a dictionary, see get()."""
+        return dict((word, self.get(word, existing_only, stem_first))
+                    for word in words)
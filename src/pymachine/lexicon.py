@@ -6,7 +6,8 @@ import copy
 from pymachine.machine import Machine
 from pymachine.control import ConceptControl
 from pymachine.construction import Construction, AVMConstruction
-from pymachine.constants import id_sep
+from pymachine.constants import avm_pre, id_sep
+from pymachine.static_graph import StaticGraph, StaticGraphView, DisambigView
 
 class Lexicon:
     """THE machine repository."""
@@ -16,6 +17,14 @@ class Lexicon:
         self.static = {}
         # e.g. {'in': {'in_2758', 'in_13'}}, where in_XXXs are keys in static
         self.static_disambig = defaultdict(set)
+        # the frozen, array-backed version of static; see finalize_static()
+        self.static_graph = None
+        # definitions added to static on demand; see set_definition_source()
+        self.definition_source = None
+        self.loaded_definitions = set()
+        # the printnames touched by add_static(), while it is recorded; see
+        # __load_definition()
+        self.static_changes = None
         # TODO: map: {active_machine : is it expanded?}
         self.active = {}
         # Constructions
@@ -23,6 +32,11 @@ class Lexicon:
         # AVM name -> construction. Not used by default, have to be added to
         # self.constructions first via activation
         self.avm_constructions = {}
+        # printname -> the static machines (printname, index) that depend on
+        # it; see __build_activation_index()
+        self.activation_index = {}
+        self.activation_deps = {}
+        self.activation_roots = []
 #        self.create_elvira_machine()
         self.clear_active()
 
@@ -35,6 +49,7 @@ class Lexicon:
             self.active[printname][m] = expanded | already_expanded
         else:
             self.active[printname] = {m: expanded}
+            self.activation_queue.append(printname)
 
     def add_active(self, what):
         """adds machines to active collection
@@ -52,6 +67,9 @@ class Lexicon:
         """
         Add lexical definition to the static collection
         while keeping prior links (parent links).
+        The machines in @p what are left intact: static is built of copies of
+        their nodes, so the same definitions can be added to any number of
+        lexicons.
         @note We assume that a machine is added to the static graph only once.
         """
         if isinstance(what, Machine):
@@ -71,7 +89,7 @@ class Lexicon:
         if curr_from not in replacement:
             # Deep cases are not canonized
             if curr_from.deep_case():
-                replacement[curr_from] = curr_from
+                replacement[curr_from] = self.__copy_node(curr_from)
             else:
                 """
                 try:
@@ -95,18 +113,20 @@ class Lexicon:
                     # canonical / placeholder
                     if len(curr_from.children()) == 0 or len(replacement) == 0:
                         #print "adding as canoncical"
-                        from_already_seen = [curr_from]
+                        curr_to = self.__copy_node(curr_from)
+                        from_already_seen = [curr_to]
                     # Otherwise add a placeholder + itself to static
                     else:
                         #print "adding as placeholder"
+                        curr_to = self.__copy_node(curr_from)
                         from_already_seen = [
-                            Machine(curr_from.printname()), curr_from]
+                            Machine(curr_from.printname()), curr_to]
 
                     self.static[curr_from.printname()] = from_already_seen
                     #print ("Adding to static", curr_from.printname(),
                     #       from_already_seen)
                     self.__add_to_disambig(curr_from.printname())
-                    replacement[curr_from] = curr_from
+                    replacement[curr_from] = curr_to
 
 #                    print self.static, self.static_disambig
 
@@ -118,7 +138,7 @@ class Lexicon:
                         #print "definition"
                         canonical = from_already_seen[0]
                         canonical.printname_ = curr_from.printname()
-                        canonical.control = curr_from.control
+                        canonical.set_control(copy.copy(curr_from.control))
                         replacement[curr_from] = canonical
                     # Handling non-definition words
                     else:
@@ -131,25 +151,35 @@ class Lexicon:
                         # Otherwise: add the new machine to static, and keep it
                         else:
                             #print "children"
-                            replacement[curr_from] = curr_from
-                            from_already_seen.append(curr_from)
+                            curr_to = self.__copy_node(curr_from)
+                            replacement[curr_from] = curr_to
+                            from_already_seen.append(curr_to)
+                if self.static_changes is not None:
+                    self.static_changes.add(curr_from.printname())
+                    self.static_changes.add(replacement[curr_from].printname())
 
             # Copying the children...
             curr_to = replacement[curr_from]
-            from_partitions = [[m for m in p] for p in curr_from.partitions]
-            for part_i, part in enumerate(from_partitions):
-                for child in part:
+            for part_i, part in enumerate(curr_from.partitions):
+                for child in list(part):
                     #print "found child", child
-                    #Remove to delete any parent links
-                    #print "part before", part, curr_from.partitions[part_i]
-                    curr_from.remove(child, part_i)
-                    #print "part after", part, curr_from.partitions[part_i]
                     curr_to.append(
                         self.__add_static_recursive(child, replacement),
                         part_i)
 
         return replacement[curr_from]
 
+    @staticmethod
+    def __copy_node(machine):
+        """
+        Returns a childless copy of @p machine with a shallow copy of its
+        control; add_static() fills in the partitions.
+        """
+        new_machine = Machine(machine.printname_,
+                              part_num=len(machine.partitions))
+        new_machine.set_control(copy.copy(machine.control))
+        return new_machine
+
     def __add_to_disambig(self, print_name):
         """Adds @p print_name to the static_disambig."""
         try:
@@ -199,6 +229,9 @@ class Lexicon:
 #                    print "XXX: ambiguous name alert!"
                     # We see a fully specified form: replace the ambiguous one
                     if ambig_name != print_name:
+                        if self.static_changes is not None:
+                            self.static_changes.add(ambig_name)
+                            self.static_changes.add(print_name)
                         names.remove(ambig_name)
                         names.add(print_name)
                         already_seen = self.static[ambig_name]
@@ -222,16 +255,64 @@ class Lexicon:
 #                        print "returning empty-handed"
                         return []
 
+    def set_definition_source(self, definitions):
+        """
+        Sets a dictionary of definitions (printname -> set of machines, e.g.
+        a LazyDefinitions object), whose definitions are added to static
+        only when they are first needed, i.e. when the printname is looked
+        up or one of its machines is expanded.
+
+        @note activate() only considers the definitions that have already
+              been loaded: as only the headwords of the source are indexed,
+              the definitions that depend on an active machine cannot be
+              found without loading all of them.
+        """
+        self.definition_source = definitions
+        self.loaded_definitions = set()
+
+    def __load_definition(self, print_name):
+        """
+        Adds the definition of @p print_name from definition_source to the
+        static graph, if that has not happened yet. Only the static entries
+        touched by the definition are finalized and reindexed for
+        activate().
+        """
+        if self.definition_source is None:
+            return
+        name = print_name.split(id_sep)[0]
+        if name in self.loaded_definitions:
+            return
+        self.loaded_definitions.add(name)
+        if name in self.definition_source:
+            self.static_changes = set()
+            try:
+                self.add_static(self.definition_source[name])
+                changes = self.static_changes
+            finally:
+                self.static_changes = None
+            self.__finalize_static_entries(changes)
+
     def get_static_machine(self, print_name):
-        # TODO: clean this up
         """
         Returns the machines (canonical & not) by their unique or ambiguous
         names.
         """
+        self.__load_definition(print_name)
+        key = self.__get_static_key(print_name)
+        if key is None:
+            return []
+        return self.static[key]
+
+    def __get_static_key(self, print_name):
+        # TODO: clean this up
+        """
+        Returns the key of static under which the machines referred to by
+        their unique or ambiguous name @p print_name are stored, or @c None.
+        """
         if print_name in self.static:
 #            print "XXX: printname", print_name, "in static"
             # in static: everything's OK, just return
-            return self.static[print_name]
+            return print_name
         else:
             ambig_name = print_name.split(id_sep)[0]
             names = self.static_disambig.get(ambig_name, set())
@@ -239,7 +320,7 @@ class Lexicon:
             if len(names) == 0:
 #                print "len names == 0"
                 # Not in static_disambig: we haven't heard of this word at all
-                return []
+                return None
             else:
                 # If we only know the ambiguous name, there must be at most
                 # exactly one fully qualified name that matches.
@@ -247,30 +328,88 @@ class Lexicon:
 #                print ambig_name, print_name, len(names), names
                 if ambig_name == print_name and len(names) == 1:
                     for name in names:      # why no peek()?
-                        return self.static[name]
+                        return name
                 else:
 #                        print "returning empty-handed"
-                    return []
+                    return None
 
-    def finalize_static(self):
+    def finalize_static(self, compact=False):
         """
         Must be called after all words have been added to the static graph.
         Links the modified nodes to the canonical one.
+
+        @param compact if @c True, the static graph is frozen into a
+                       StaticGraph, and static is replaced by a view over it
+                       that only creates Machine objects on demand.
         """
         for print_name, nodes in self.static.iteritems():
-            if print_name != nodes[0].printname():
-                #len(nodes) > 1 and (
-                #   nodes[0].printname() != nodes[1].printname()):
-                nodes[0].printname_ = print_name
-            # We don't care about deep cases here
-            if not nodes[0].fancy():
-                for node in nodes[1:]:
-                    # HACK don't insert for binaries
-                    if node.unary():
-                        node.append(nodes[0])
+            self.__link_static_nodes(print_name, nodes)
         # defaultdict is not safe, so convert it to a regular dict
         self.static_disambig = dict(self.static_disambig)
         # TODO: remove the id from the print name of unambiguous machines
+        if compact:
+            self.static_graph = StaticGraph.from_static(self.static)
+            self.static = StaticGraphView(self.static_graph)
+        self.__build_activation_index()
+
+    @staticmethod
+    def __link_static_nodes(print_name, nodes):
+        """Links the modified nodes stored under @p print_name to the
+        canonical one; see finalize_static()."""
+        if print_name != nodes[0].printname():
+            #len(nodes) > 1 and (
+            #   nodes[0].printname() != nodes[1].printname()):
+            nodes[0].printname_ = print_name
+        # We don't care about deep cases here
+        if not nodes[0].fancy():
+            for node in nodes[1:]:
+                # HACK don't insert for binaries
+                if node.unary():
+                    node.append(nodes[0])
+
+    def __finalize_static_entries(self, printnames):
+        """
+        finalize_static() for the entries of static stored under (or
+        referred to by) @p printnames, the names touched by add_static().
+        Also updates the activation index, if it has been built.
+        """
+        keys = set()
+        for printname in printnames:
+            key = self.__get_static_key(printname)
+            if key is not None:
+                keys.add(key)
+            if self.activation_index is not None:
+                # the machines whose children were renamed
+                keys.update(pn for pn, i in
+                            self.activation_index.get(printname, ())
+                            if pn in self.static)
+        for key in keys:
+            self.__link_static_nodes(key, self.static[key])
+        if self.activation_index is not None:
+            self.__update_activation_index(keys | set(printnames))
+
+    def save_static(self, file_name):
+        """
+        Saves the static graph to @p file_name in the snapshot format of
+        StaticGraph. Must be called after finalize_static().
+        """
+        if self.static_graph is not None and not self.static.overlay:
+            graph = self.static_graph
+        else:
+            graph = StaticGraph.from_static(self.static)
+        graph.save(file_name)
+
+    def load_static(self, file_name):
+        """
+        Replaces the static graph with the snapshot in @p file_name (see
+        save_static()). The snapshot is memory-mapped, and machines are only
+        created for the entries that are accessed.
+        """
+        self.static_graph = StaticGraph.load(file_name)
+        self.static = StaticGraphView(self.static_graph)
+        self.static_disambig = DisambigView(self.static_graph)
+        # built by the first activate() call
+        self.activation_index = None
 
     def extract_definition_graph(self, deep_cases=False):
         """
@@ -283,6 +422,8 @@ class Lexicon:
         @param deep_cases if @c False (the default), deep cases in the
                           definitions do not appear on the output graph.
         """
+        if self.static_graph is not None:
+            return self.__extract_definition_graph_compact(deep_cases)
         def_graph = {}
         canonicals = set(l[0] for l in self.static.values())
         for name in self.static.keys():
@@ -306,8 +447,7 @@ class Lexicon:
         """
         for static_child in static_m.children():
             if not static_child.fancy():
-                cname = self.get_static_machine(
-                    static_child.printname())[0].printname()
+                cname = self.__get_canonical_name(static_child.printname())
                 def_child = def_graph[cname][0]
                 if def_child != root_def_m:
                     root_def_m.append(def_child)
@@ -327,6 +467,69 @@ class Lexicon:
                                                   def_graph, stop, canonicals,
                                                   deep_cases)
 
+    def __extract_definition_graph_compact(self, deep_cases):
+        """
+        extract_definition_graph() for a compact static graph. Frozen entries
+        are walked on the node ids of static_graph, so no static machines are
+        created for them.
+        """
+        graph = self.static_graph
+        def_graph = {}
+        for name in self.static.keys():
+            def_graph[name] = [Machine(name)]
+        canonicals = set(graph.entry(name)[0] for name in graph.keys())
+        canonicals.update(l[0] for l in self.static.overlay.values())
+        for name in self.static.keys():
+            def_machine = def_graph[name][0]
+            if not self.static.is_frozen(name):
+                static_machine = self.static[name][0]
+                if not static_machine.fancy():
+                    self.__build_definition_graph(
+                        def_machine, static_machine, def_graph, set([]),
+                        canonicals, deep_cases)
+                continue
+            static_node = graph.entry(name)[0]
+            if not graph.fancy(static_node):
+                self.__build_definition_graph_compact(
+                    def_machine, static_node, def_graph, set([]), canonicals,
+                    deep_cases)
+        return def_graph
+
+    def __build_definition_graph_compact(self, root_def_m, static_node,
+                                         def_graph, stop, canonicals,
+                                         deep_cases):
+        """__build_definition_graph() on the nodes of static_graph."""
+        graph = self.static_graph
+        for static_child in set(graph.children(static_node)):
+            child_name = graph.printname(static_child)
+            if not graph.fancy(static_child):
+                cname = self.__get_canonical_name(child_name)
+                def_child = def_graph[cname][0]
+                if def_child != root_def_m:
+                    root_def_m.append(def_child)
+            elif (deep_cases and graph.deep_case(static_child) and
+                    child_name not in stop):
+                root_def_m.append(Machine(child_name))
+            if graph.fancy(static_child) or static_child not in canonicals:
+                if static_child not in stop and child_name not in stop:
+                    if graph.fancy(static_child):
+                        stop.add(child_name)
+                    else:
+                        stop.add(static_child)
+                    self.__build_definition_graph_compact(
+                        root_def_m, static_child, def_graph, stop, canonicals,
+                        deep_cases)
+
+    def __get_canonical_name(self, print_name):
+        """
+        The printname of the canonical machine for @p print_name, i.e.
+        get_static_machine(print_name)[0].printname().
+        """
+        key = self.__get_static_key(print_name)
+        if self.static_graph is not None and self.static.is_frozen(key):
+            return self.static_graph.printname(self.static_graph.entry(key)[0])
+        return self.get_static_machine(print_name)[0].printname()
+
     def add_construction(self, what):
         """
         Adds construction(s) to the lexicon.
@@ -363,6 +566,7 @@ class Lexicon:
         if everything is okay, everything from every partition of the
         static machine is copied to the active one"""
         printname = machine.printname()
+        self.__load_definition(printname)
         if (printname not in self.active or
                 machine not in self.active[printname]):
             raise Exception("""only active machines can be expanded
@@ -375,6 +579,13 @@ class Lexicon:
             self.active[printname][machine] = True
             return
 
+        if (self.static_graph is not None and
+                self.static.is_frozen(printname)):
+            for static_node in self.static_graph.entry(printname):
+                machine = self.__unify_node(static_node, zeros_only, set())
+                self.active[printname][machine] = True
+            return
+
         for static_machine in self.static[printname]:
             #logging.info('activating machine:\n{0}'.format(static_machine))
             #logging.info(
@@ -426,6 +637,7 @@ class Lexicon:
         # If it's a machine, we create the corresponding active one
         elif isinstance(static_machine, Machine):
             static_name = static_machine.printname()
+            self.__load_definition(static_name)
             #logging.debug('Does {0} start with #? {1}'.format(
             #   static_name, static_name.startswith('#')))
 
@@ -463,6 +675,34 @@ class Lexicon:
         else:
             raise TypeError('static_machine must be a Machine or a str')
 
+    def __unify_node(self, static_node, zeros_only, stop):
+        """
+        unify_recursively() for a node of static_graph: returns the active
+        machine that corresponds to @p static_node, and unifies the nodes on
+        its partitions with the active set, without creating static machines.
+        """
+        graph = self.static_graph
+        static_name = graph.printname(static_node)
+        if static_name in stop:
+            return self.active[static_name].keys()[0]
+        if static_name in self.active:
+            active_machine = self.active[static_name].keys()[0]
+        else:
+            if static_name.startswith('#'):
+                self.wake_avm_construction(static_name)
+                return None
+            active_machine = Machine(static_name)
+            active_machine.set_control(copy.copy(graph.control(static_node)))
+            self.__add_active_machine(active_machine)
+
+        stop.add(static_name)
+
+        for child, i in graph.edges(static_node):
+            as_machine = self.__unify_node(child, zeros_only, stop)
+            if as_machine is not None:
+                active_machine.append(as_machine, i)
+        return active_machine
+
     def wake_avm_construction(self, avm_name):
         """
         Copies an AVM construction from @c avm_constructions to
@@ -481,26 +721,126 @@ class Lexicon:
 
         When exactly a machine should be activated is still up for
         consideration; however, currently this method returns a machine if
-        all non-primitive machines on its partitions are active."""
+        all non-primitive machines on its partitions are active.
+
+        Only the printnames that became active since the last call are
+        looked up in the activation index, so the cost of a call does not
+        depend on the size of the lexicon. The machines activated by a call
+        can in turn activate others in the next call.
+
+        With a definition source (see set_definition_source()), only the
+        definitions loaded so far are considered."""
+        if self.activation_index is None:
+            self.__build_activation_index()
+        newly_active, self.activation_queue = self.activation_queue, []
+        candidates = set(self.activation_roots) | self.activation_ready
+        self.activation_ready = set()
+        for printname in newly_active:
+            self.activation_done.add(printname)
+            for key in self.activation_index.get(printname, ()):
+                if key in self.unsatisfied:
+                    self.unsatisfied[key] -= 1
+                else:
+                    self.unsatisfied[key] = len(
+                        self.activation_deps[key] - self.activation_done)
+                if self.unsatisfied[key] == 0:
+                    candidates.add(key)
+
         activated = []
+        for printname, i in sorted(candidates):
+            if printname in self.active:
+                continue
+            static_machine = self.static[printname][i]
+            m = Machine(printname, copy.copy(static_machine.control))
+            self.add_active(m)
+            activated.append(m)
+        return activated
 
-        for printname, static_machines in self.static.iteritems():
-            for static_machine in static_machines:
-                if printname in self.active:
+    def __build_activation_index(self):
+        """
+        Builds the index used by activate(): the printnames each static
+        machine depends on (the machines on its partitions, apart from the
+        '#' ones), and the inverted index from these printnames to the
+        static machines, which are identified by (printname, index) pairs.
+        Machines without dependencies (but with children) are stored in
+        activation_roots.
+        """
+        self.activation_index = {}
+        self.activation_deps = {}
+        self.activation_roots = []
+        for printname in self.static:
+            self.__index_static_entry(printname)
+        self.__reset_activation()
+
+    def __index_static_entry(self, printname):
+        """
+        Adds the static machines stored under @p printname to the activation
+        index. The ones whose dependencies are already active are counted
+        as in activate(), and activated by its next call.
+        """
+        for i, children in enumerate(self.__static_children(printname)):
+            if len(children) == 0:
+                continue
+            key = (printname, i)
+            deps = set(child for child in children
+                       if not child.startswith(avm_pre))
+            self.activation_deps[key] = deps
+            if len(deps) == 0:
+                self.activation_roots.append(key)
+            for child in deps:
+                self.activation_index.setdefault(child, []).append(key)
+            if len(deps & self.activation_done) > 0:
+                self.unsatisfied[key] = len(deps - self.activation_done)
+                if self.unsatisfied[key] == 0:
+                    self.activation_ready.add(key)
+
+    def __update_activation_index(self, printnames):
+        """
+        Reindexes the static machines stored under @p printnames after they
+        have been changed by add_static(). Printnames no longer in static
+        (placeholders renamed to their fully qualified names) are only
+        removed from the index.
+        """
+        for printname in printnames:
+            key = self.__get_static_key(printname)
+            count = len(self.static[key]) if key is not None else 0
+            for i in xrange(count):
+                deps = self.activation_deps.pop((printname, i), None)
+                if deps is None:
                     continue
-                has_machine = False
-                for machine in chain(*static_machine.partitions):
-                    has_machine = True
-                    if (not unicode(machine).startswith(u'#') and
-                            unicode(machine) not in self.active):
-                        break
-                else:
-                    if has_machine:
-                        m = Machine(printname,
-                                    copy.copy(static_machine.control))
-                        self.add_active(m)
-                        activated.append(m)
-        return activated
+                if len(deps) == 0:
+                    self.activation_roots.remove((printname, i))
+                for child in deps:
+                    self.activation_index[child].remove((printname, i))
+                self.unsatisfied.pop((printname, i), None)
+                self.activation_ready.discard((printname, i))
+        for printname in printnames:
+            if printname in self.static:
+                self.__index_static_entry(printname)
+
+    def __static_children(self, printname):
+        """
+        Returns the printnames of the children of the static machines stored
+        under @p printname, without creating Machine objects for frozen
+        entries.
+        """
+        if self.static_graph is not None and self.static.is_frozen(printname):
+            graph = self.static_graph
+            return [[graph.printname(child) for child in graph.children(node)]
+                    for node in graph.entry(printname)]
+        return [[m.printname() for m in chain(*static_machine.partitions)]
+                for static_machine in self.static[printname]]
+
+    def __reset_activation(self):
+        """Restarts the bookkeeping of activate() from the active machines."""
+        # (printname, index) -> number of dependencies not yet active
+        self.unsatisfied = {}
+        # printnames already taken into account by activate()
+        self.activation_done = set()
+        # indexed after their dependencies became active; see
+        # __index_static_entry()
+        self.activation_ready = set()
+        self.activation_queue = list(self.active)
 
     def is_expanded(self, m):
         """Returns whether m is expanded or not"""
@@ -535,6 +875,7 @@ class Lexicon:
         between activation phases.
         """
         self.active = {}
+        self.__reset_activation()
         # HACK
         #self.unify_recursively('train')
 
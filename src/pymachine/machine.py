@@ -6,16 +6,160 @@ import re
 from pymachine.control import Control
 from constants import deep_pre, avm_pre, enc_pre
 
+class Partition(object):
+    """
+    One partition of a machine: an insertion-ordered set of machines. It
+    supports the list operations used on partitions, but membership tests,
+    appends and removals take constant time even on large partitions.
+    """
+    __slots__ = ('_items', '_index', '_holes')
+
+    # partitions up to this size are simply scanned instead of indexed
+    scan_limit = 8
+    # marks the place of a removed item in _items
+    _hole = object()
+
+    def __init__(self, iterable=()):
+        self._items = []
+        # item -> position in _items; only maintained for large partitions
+        self._index = None
+        self._holes = 0
+        for item in iterable:
+            self.append(item)
+
+    def __getstate__(self):
+        return list(self)
+
+    def __setstate__(self, state):
+        self.__init__(state)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def __len__(self):
+        return len(self._items) - self._holes
+
+    def __iter__(self):
+        if self._holes == 0:
+            return iter(self._items)
+        return (item for item in self._items if item is not Partition._hole)
+
+    def __contains__(self, item):
+        if self._index is None:
+            return item in self._items
+        return item in self._index
+
+    def __eq__(self, other):
+        if isinstance(other, (Partition, list)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        return res if res is NotImplemented else not res
+
+    __hash__ = None
+
+    def __getitem__(self, i):
+        self._compact()
+        return self._items[i]
+
+    def __setitem__(self, i, item):
+        self._compact()
+        self.replace(self._items[i], item)
+
+    def append(self, item):
+        """Adds @p item to the end of the partition, if it is not in it."""
+        if item in self:
+            return
+        self._items.append(item)
+        if self._index is not None:
+            self._index[item] = len(self._items) - 1
+        elif len(self._items) > Partition.scan_limit:
+            self._build_index()
+
+    def remove(self, item):
+        """Removes @p item; raises a ValueError if it is not found."""
+        if self._index is None:
+            self._items.remove(item)
+            return
+        try:
+            i = self._index.pop(item)
+        except KeyError:
+            raise ValueError("Partition.remove(x): x not in partition")
+        self._items[i] = Partition._hole
+        self._holes += 1
+        if self._holes * 2 > len(self._items):
+            self._compact()
+
+    def replace(self, old, new):
+        """Puts @p new in the place of @p old."""
+        if old is new:
+            return
+        if new in self:
+            self.remove(old)
+            return
+        self._compact()
+        i = self._items.index(old)
+        self._items[i] = new
+        if self._index is not None:
+            del self._index[old]
+            self._index[new] = i
+
+    def _build_index(self):
+        self._index = dict((item, i) for i, item in enumerate(self._items))
+
+    def _compact(self):
+        """Gets rid of the holes left by remove()."""
+        if self._holes == 0:
+            return
+        self._items = [item for item in self._items
+                       if item is not Partition._hole]
+        self._holes = 0
+        if len(self._items) > Partition.scan_limit:
+            self._build_index()
+        else:
+            self._index = None
+
 class Machine(object):
+    __slots__ = ('_printname_', '_printname', 'partitions', 'control',
+                 'parents')
+
     def __init__(self, name, control=None, part_num=3):
         # assert name
         self.printname_ = name
         # if name.isupper():
         #     part_num = 3  # TODO crude, but effective
-        self.partitions = [[] for i in range(part_num)]
+        self.partitions = [Partition() for i in range(part_num)]
         self.set_control(control)
         self.parents = set()
 
+    def __getstate__(self):
+        return {'printname_': self.printname_,
+                'partitions': [list(part) for part in self.partitions],
+                'control': self.control,
+                'parents': self.parents}
+
+    def __setstate__(self, state):
+        """Also accepts the __dict__ of machines pickled before __slots__."""
+        self.printname_ = state['printname_']
+        self.partitions = [Partition(part) for part in state['partitions']]
+        self.control = state['control']
+        self.parents = state['parents']
+
+    def _get_printname_(self):
+        return self._printname_
+
+    def _set_printname_(self, name):
+        self._printname_ = name
+        # printname() is called very often, so we precompute it here
+        if name is not None and '/' in name:
+            self._printname = name.split('/')[0]
+        else:
+            self._printname = name
+
+    printname_ = property(_get_printname_, _set_printname_)
+
     def __repr__(self):
         return str(self)
 
@@ -31,7 +175,8 @@ class Machine(object):
     def __deepcopy__(self, memo):
         new_machine = self.__class__(self.printname_)
         memo[id(self)] = new_machine
-        new_partitions = copy.deepcopy(self.partitions, memo)
+        new_partitions = [Partition(copy.deepcopy(list(part), memo))
+                          for part in self.partitions]
         new_control = copy.deepcopy(self.control, memo)
         new_machine.partitions = new_partitions
         new_machine.control = new_control
@@ -43,7 +188,7 @@ class Machine(object):
 
     def unify(self, machine2):
         for i, part in enumerate(machine2.partitions):
-            for m in part:
+            for m in list(part):
                 self.append(m, i)
                 machine2.remove(m, i)
 
@@ -59,7 +204,7 @@ class Machine(object):
 
     def dot_printname(self):
         """printname for dot output"""
-        return self.printname_.split('/')[0].replace('-', '_')
+        return self._printname.replace('-', '_')
 
     @staticmethod
     def d_clean(string):
@@ -75,9 +220,7 @@ class Machine(object):
         return s
 
     def printname(self):
-        if '/' in self.printname_:
-            return self.printname_.split('/')[0]
-        return self.printname_
+        return self._printname
 
     def unique_name(self):
         return u"{0}_{1}".format(self.printname(), id(self))
@@ -103,15 +246,9 @@ class Machine(object):
     def unique_machines_in_tree(self):
         """Returns all unique machines under (and including)
         the current one."""
-        def __recur(m):
-            visited.add(m)
-            for child in m.children():
-                if child not in visited:
-                    __recur(child)
-
-        visited = set()
-        __recur(self)
-        return visited
+        from pymachine.utils import MachineTraverser
+        return set(machine for machine, depth in
+                   MachineTraverser('children').traverse(self))
 
     def append_all(self, what_iter, which_partition=0):
         """ Mass append function that calls append() for every object """
@@ -134,8 +271,8 @@ class Machine(object):
             if what in self.partitions[which_partition]:
                 return
         else:
-            self.partitions += [[] for i in range(which_partition + 1 -
-                                len(self.partitions))]
+            self.partitions += [Partition() for i in range(
+                which_partition + 1 - len(self.partitions))]
 
         self.__append(what, which_partition)
 
@@ -168,12 +305,14 @@ class Machine(object):
         if which_partition is not None:
             if len(self.partitions) > which_partition:
                 self.partitions[which_partition].remove(what)
+                if isinstance(what, Machine):
+                    what.del_parent_link(self, which_partition)
         else:
-            for partition, _ in enumerate(self.partitions):
-                self.partitions[partition].remove(what)
-
-        if isinstance(what, Machine):
-            what.del_parent_link(self, which_partition)
+            for partition, part in enumerate(self.partitions):
+                if what in part:
+                    part.remove(what)
+                    if isinstance(what, Machine):
+                        what.del_parent_link(self, partition)
 
     def add_parent_link(self, whose, part):
         self.parents.add((whose, part))
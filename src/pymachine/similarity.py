@@ -1,58 +1,441 @@
 from collections import defaultdict
+import cPickle
 from ConfigParser import ConfigParser
+import heapq
+from itertools import chain, imap, islice, izip
 import logging
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import time
 
 from gensim.models import Word2Vec
 from nltk.corpus import stopwords as nltk_stopwords
-from scipy.stats.stats import pearsonr
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.stats import rankdata
+from scipy.stats import t as t_distribution
 
-from pymachine.utils import average, harmonic_mean, jaccard, min_jaccard, MachineGraph, MachineTraverser, my_max  # nopep8
+from pymachine.utils import average, harmonic_mean, jaccard, min_jaccard, LRUCache, MachineGraph, MachineTraverser, my_max  # nopep8
 from pymachine.wrapper import Wrapper as MachineWrapper
 assert jaccard, min_jaccard  # silence pyflakes
 
+# state shared with the worker processes of get_machine_sims_parallel()
+_shard_state = {}
+
+def _machine_sims_shard(start, end, shard_fn):
+    """
+    Computes the similarities of the word pairs [start, end) in a worker
+    process of SimComparer.get_machine_sims_parallel(). The lines of the
+    text output go to @p shard_fn, the similarities to @p shard_fn.npy.
+    Returns the cache statistics of the shard (see merge_cache_stats()).
+    """
+    get_sim = _shard_state['get_sim']
+    stats_before = _shard_state['word_sim'].cache_stats()
+    sims = np.zeros(end - start)
+    started = time.time()
+    out = open(shard_fn, 'w') if _shard_state['text'] else None
+    pairs = _shard_state['pairs']
+    if isinstance(pairs, WordPairs):
+        pairs = pairs.slice(start, end)
+    else:
+        pairs = pairs[start:end]
+    for i, (w1, w2) in enumerate(pairs):
+        sim = get_sim(w1, w2)
+        if sim is None:
+            logging.warning(
+                u"sim is None for non-ooovs: {0} and {1}".format(w1, w2))
+            logging.warning("treating as 0 to avoid problems")
+        else:
+            sims[i] = sim
+        if out is not None:
+            out.write(
+                u"{0}_{1}\t{2}\n".format(w1, w2, sim).encode('utf-8'))
+    if out is not None:
+        out.close()
+    _shard_state['word_sim'].flush()
+    np.save(shard_fn + '.npy', sims)
+    logging.warning('{0}: {1} pairs, {2:.1f} pairs/s'.format(
+        shard_fn, end - start, (end - start) / (time.time() - started)))
+    # the worker processes are reused, so only the difference counts
+    stats = _shard_state['word_sim'].cache_stats()
+    for cache, cache_stats in stats.iteritems():
+        for counter in ('hits', 'misses', 'evictions'):
+            cache_stats[counter] -= stats_before[cache][counter]
+    return stats
+
+def merge_cache_stats(stats_list):
+    """
+    Adds up the counters in the statistics (WordSimilarity.cache_stats())
+    of the shards in @p stats_list; the sizes are the largest ones.
+    """
+    merged = {}
+    for stats in stats_list:
+        for cache, cache_stats in stats.iteritems():
+            if cache not in merged:
+                merged[cache] = dict(cache_stats)
+                continue
+            for key, value in cache_stats.iteritems():
+                if key in ('hits', 'misses', 'evictions'):
+                    merged[cache][key] += value
+                else:
+                    merged[cache][key] = max(merged[cache][key], value)
+    return merged
+
+# state shared with the worker processes of
+# SparseLemmaSimilarity.machine_similarities()
+_sparse_state = {}
+
+def _sparse_block(start):
+    """
+    Computes the similarities of the block of machines starting at
+    @p start in a worker of SparseLemmaSimilarity.machine_similarities().
+    """
+    return _sparse_state['engine'].block_sim_dict(
+        start, *_sparse_state['matrices'])
+
+class SimilarityStore():
+    """
+    Lemma similarities stored in an SQLite database, so that they can be
+    reused by later runs. Each similarity belongs to a lexicon fingerprint
+    (see Wrapper.definitions_fingerprint()), similarities computed from
+    other definitions are never returned. New similarities are written in
+    batches of @p batch_size; the database is in WAL mode, so any number of
+    processes can read it while one of them writes.
+    """
+    def __init__(self, file_name, fingerprint, batch_size=10000, timeout=60):
+        self.file_name = file_name
+        self.fingerprint = fingerprint
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.pid = None
+        self.connect()
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.file_name, timeout=self.timeout)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # sim has no type, so that ints and floats are kept apart
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS sims (fingerprint TEXT, ' +
+            'sim_type TEXT, lemma1 TEXT, lemma2 TEXT, sim, ' +
+            'PRIMARY KEY (fingerprint, sim_type, lemma1, lemma2))')
+        self.conn.commit()
+        self.pending = {}
+        self.pid = os.getpid()
+
+    def check_process(self):
+        """A forked process needs a connection of its own."""
+        if self.pid != os.getpid():
+            self.connect()
+
+    @staticmethod
+    def key(lemma1, lemma2, sim_type):
+        lemma1, lemma2 = [
+            lemma.decode('utf-8') if isinstance(lemma, str) else lemma
+            for lemma in sorted((lemma1, lemma2))]
+        return sim_type, lemma1, lemma2
+
+    def get(self, lemma1, lemma2, sim_type):
+        """The stored similarity or @c None."""
+        self.check_process()
+        key = SimilarityStore.key(lemma1, lemma2, sim_type)
+        if key in self.pending:
+            return self.pending[key]
+        row = self.conn.execute(
+            'SELECT sim FROM sims WHERE fingerprint = ? AND sim_type = ? ' +
+            'AND lemma1 = ? AND lemma2 = ?',
+            (self.fingerprint,) + key).fetchone()
+        return None if row is None else row[0]
+
+    def get_all(self, pairs, sim_type):
+        """
+        The stored similarities of the lemma pairs in @p pairs, as a
+        dictionary keyed by the pairs; the pairs not in the store are left
+        out. The pairs are looked up by a single query, which joins a
+        temporary table of them with the similarities.
+        """
+        self.check_process()
+        keys = defaultdict(list)
+        for lemma1, lemma2 in pairs:
+            keys[SimilarityStore.key(lemma1, lemma2, sim_type)].append(
+                (lemma1, lemma2))
+        self.conn.execute('CREATE TEMP TABLE IF NOT EXISTS wanted ' +
+                          '(lemma1 TEXT, lemma2 TEXT)')
+        self.conn.executemany('INSERT INTO wanted VALUES (?, ?)',
+                              (key[1:] for key in keys))
+        rows = self.conn.execute(
+            'SELECT sims.lemma1, sims.lemma2, sims.sim FROM wanted ' +
+            'JOIN sims ON sims.fingerprint = ? AND sims.sim_type = ? ' +
+            'AND sims.lemma1 = wanted.lemma1 ' +
+            'AND sims.lemma2 = wanted.lemma2',
+            (self.fingerprint, sim_type)).fetchall()
+        self.conn.execute('DELETE FROM wanted')
+        self.conn.commit()
+        stored = dict(((sim_type, lemma1, lemma2), sim)
+                      for lemma1, lemma2, sim in rows)
+        for key in keys:
+            if key in self.pending:
+                stored[key] = self.pending[key]
+        return dict((pair, stored[key]) for key, key_pairs in keys.iteritems()
+                    if key in stored for pair in key_pairs)
+
+    def put(self, lemma1, lemma2, sim_type, sim):
+        self.check_process()
+        self.pending[SimilarityStore.key(lemma1, lemma2, sim_type)] = sim
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        self.check_process()
+        if not self.pending:
+            return
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO sims VALUES (?, ?, ?, ?, ?)',
+            ((self.fingerprint,) + key + (sim,)
+             for key, sim in self.pending.iteritems()))
+        self.conn.commit()
+        self.pending = {}
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+# state shared with the worker processes of SentenceSimilarity.process_file()
+_pipeline_state = {}
+
+def _line_similarities(lines):
+    """
+    Scores a chunk of lines in a worker of
+    SentenceSimilarity.process_file(). Returns the scores and the time it
+    took.
+    """
+    started = time.time()
+    sen_sim = _pipeline_state['sen_sim']
+    sims = [sen_sim.line_similarity(line, *_pipeline_state['args'])
+            for line in lines]
+    return sims, time.time() - started
+
+class LinksNodesIndex():
+    """
+    The links and nodes (see WordSimilarity.get_links_nodes()) of every
+    definition, computed once and saved to a sidecar file, so that they
+    are looked up instead of being collected by walking the graphs.
+
+    A definition is identified by its lemma and the printnames of its
+    children (see signature()), which do not depend on the process. The
+    links and the nodes are interned: the file stores each distinct link
+    or node once, and the definitions as slices of int32 arrays of their
+    ids. Definitions of the same lemma with the same signature are left
+    out, so they are always computed.
+    """
+    version = 1
+
+    def __init__(self, fingerprint, items, rows, link_offsets, link_ids,
+                 node_offsets, node_ids):
+        self.fingerprint = fingerprint
+        self.items = items
+        self.rows = rows
+        self.link_offsets = link_offsets
+        self.link_ids = link_ids
+        self.node_offsets = node_offsets
+        self.node_ids = node_ids
+
+    @staticmethod
+    def signature(machine):
+        return tuple(tuple(sorted(child.printname_ for child in part))
+                     for part in machine.partitions)
+
+    @staticmethod
+    def build(word_sim, fingerprint=None):
+        """
+        Computes the links and nodes of the definitions of
+        @p word_sim.wrapper with @p word_sim.
+        """
+        definitions = word_sim.wrapper.definitions
+        item_ids = {}
+        items = []
+        rows = {}
+        ambiguous = set()
+        links_nodes = []
+
+        def get_ids(values):
+            ids = []
+            for value in values:
+                if value not in item_ids:
+                    item_ids[value] = len(items)
+                    items.append(value)
+                ids.append(item_ids[value])
+            return ids
+
+        for lemma in sorted(definitions):
+            for machine in definitions[lemma]:
+                key = lemma, LinksNodesIndex.signature(machine)
+                if key in rows:
+                    ambiguous.add(key)
+                    continue
+                links, nodes = word_sim.get_links_nodes(machine,
+                                                        use_cache=False)
+                rows[key] = len(links_nodes)
+                links_nodes.append((get_ids(links), get_ids(nodes)))
+        for key in ambiguous:
+            del rows[key]
+
+        def offsets(lists):
+            return np.cumsum([0] + map(len, lists)).astype(np.int64)
+
+        def ids(lists):
+            return np.fromiter(chain.from_iterable(lists), dtype=np.int32)
+
+        link_lists = [link_ids for link_ids, _ in links_nodes]
+        node_lists = [node_ids for _, node_ids in links_nodes]
+        logging.info(
+            'indexed the links and nodes of {0} definitions'.format(
+                len(rows)) + ' ({0} distinct items)'.format(len(items)))
+        return LinksNodesIndex(fingerprint, items, rows, offsets(link_lists),
+                               ids(link_lists), offsets(node_lists),
+                               ids(node_lists))
+
+    def save(self, file_name):
+        tmp_fn = file_name + '.tmp'
+        with open(tmp_fn, 'wb') as f:
+            cPickle.dump((LinksNodesIndex.version, self.fingerprint,
+                          self.items, self.rows, self.link_offsets,
+                          self.link_ids, self.node_offsets, self.node_ids),
+                         f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_fn, file_name)
+
+    @staticmethod
+    def load(file_name, fingerprint=None):
+        """
+        Returns @c None if the file was built by another version or (when
+        @p fingerprint is given) from other definitions.
+        """
+        with open(file_name, 'rb') as f:
+            fields = cPickle.load(f)
+        if fields[0] != LinksNodesIndex.version or (
+                fingerprint is not None and fields[1] != fingerprint):
+            logging.warning('{0} is out of date'.format(file_name))
+            return None
+        return LinksNodesIndex(*fields[1:])
+
+    def get(self, machine):
+        """The links and nodes of @p machine, or @c None if unknown."""
+        row = self.rows.get((machine.printname(),
+                             LinksNodesIndex.signature(machine)))
+        if row is None:
+            return None
+        return tuple(
+            set(self.items[i]
+                for i in ids[offsets[row]:offsets[row + 1]].tolist())
+            for offsets, ids in ((self.link_offsets, self.link_ids),
+                                 (self.node_offsets, self.node_ids)))
+
 class WordSimilarity():
-    def __init__(self, wrapper):
+    def __init__(self, wrapper, lemma_sim_cache=None, links_nodes_cache=None,
+                 store=None):
+        """
+        @param lemma_sim_cache and @p links_nodes_cache can be any objects
+        with the get() and __setitem__() methods of LRUCache, by default
+        they are unbounded LRUCaches. The former is keyed by
+        (lemma1, lemma2, sim_type), the latter by definition_key().
+        @param store a SimilarityStore, consulted before computing a lemma
+                     similarity that is not in lemma_sim_cache.
+        """
         self.wrapper = wrapper
-        self.lemma_sim_cache = {}
-        self.links_nodes_cache = {}
+        self.store = store
+        # a LinksNodesIndex, see get_links_nodes()
+        self.links_nodes_index = None
+        self.lemma_features = None
+        # the hypernyms of a machine are the machines in its 0th partition
+        self.hypernym_traverser = MachineTraverser(
+            'children', max_depth=5, partitions=(0,))
+        self.lemma_sim_cache = (LRUCache() if lemma_sim_cache is None
+                                else lemma_sim_cache)
+        self.links_nodes_cache = (LRUCache() if links_nodes_cache is None
+                                  else links_nodes_cache)
+        # lemma -> {definition: key}, see definition_key()
+        self.definition_keys = {}
         self.stopwords = set(nltk_stopwords.words('english'))
 
+    def flush(self):
+        """Writes the new similarities to the store."""
+        if self.store is not None:
+            self.store.flush()
+
+    def cache_stats(self):
+        return {'lemma_sim_cache': self.lemma_sim_cache.stats(),
+                'links_nodes_cache': self.links_nodes_cache.stats()}
+
     def log(self, string):
         if not self.wrapper.batch:
             logging.info(string)
 
+    def definition_key(self, machine):
+        """
+        The key of @p machine in links_nodes_cache: the lemma and the
+        signature of @p machine (see LinksNodesIndex.signature()), so that
+        the cache does not keep the definition graphs alive, and the keys
+        are the same in every process. Machines that are not definitions,
+        and definitions that share their signature with another definition
+        of the lemma have no key (@c None).
+        """
+        lemma = machine.printname()
+        keys = self.definition_keys.get(lemma)
+        if keys is None:
+            keys = self.definition_keys[lemma] = self.get_definition_keys(
+                lemma)
+        return keys.get(machine)
+
+    def get_definition_keys(self, lemma):
+        """
+        The keys of the definitions of @p lemma, computed once per lemma
+        by definition_key(): {definition: key}, the definitions without a
+        key left out.
+        """
+        if lemma not in self.wrapper.definitions:
+            return {}
+        signatures = dict(
+            (machine, LinksNodesIndex.signature(machine))
+            for machine in self.wrapper.definitions[lemma])
+        counts = defaultdict(int)
+        for signature in signatures.itervalues():
+            counts[signature] += 1
+        return dict((machine, (lemma, signature))
+                    for machine, signature in signatures.iteritems()
+                    if counts[signature] == 1)
+
     def get_links_nodes(self, machine, use_cache=True):
-        if use_cache and machine in self.links_nodes_cache:
-            return self.links_nodes_cache[machine]
-        self.seen_for_links = set()
+        key = self.definition_key(machine) if use_cache else None
+        if key is not None:
+            links_nodes = self.links_nodes_cache.get(key)
+            if links_nodes is None and self.links_nodes_index is not None:
+                links_nodes = self.links_nodes_index.get(machine)
+                if links_nodes is not None:
+                    self.links_nodes_cache[key] = links_nodes
+            if links_nodes is not None:
+                return links_nodes
         links = set()
         nodes = set()
-        for link, node in self._get_links_nodes(machine, depth=0):
-            if link is not None:
-                links.add(link)
-            if node is not None:
-                nodes.add(node)
-        self.links_nodes_cache[machine] = (links, nodes)
-        return links, nodes
-
-    def _get_links_nodes(self, machine, depth):
-        if machine in self.seen_for_links or depth > 5:
-            return
-        self.seen_for_links.add(machine)
-        for hypernym in machine.partitions[0]:
-            name = hypernym.printname()
-            if name == '=AGT' or not name.isupper():
-            #    if depth == 0 and name not in ("lack", "to"):  # TMP!!!
-                yield name, None
-
-            for link, node in self._get_links_nodes(hypernym, depth=depth+1):
-                yield link, node
 
-        for link, node in self.get_binary_links_nodes(machine):
-            yield link, node
+        def visit(machine, depth):
+            for hypernym in machine.partitions[0]:
+                name = hypernym.printname()
+                if name == '=AGT' or not name.isupper():
+                    links.add(name)
+            for link, node in self.get_binary_links_nodes(machine):
+                if link is not None:
+                    links.add(link)
+                if node is not None:
+                    nodes.add(node)
 
-        for node in MachineTraverser.get_nodes(machine):
-            yield None, node
+        self.hypernym_traverser.visit(machine, visit)
+        # every machine visited is connected to @p machine, so the nodes of
+        # their graphs are the same
+        nodes.update(MachineTraverser.get_nodes(machine))
+        if key is not None:
+            self.links_nodes_cache[key] = (links, nodes)
+        return links, nodes
 
     def get_binary_links_nodes(self, machine):
         for parent, partition in machine.parents:
@@ -196,11 +579,108 @@ class WordSimilarity():
         self.log(u"S({0}, {1}) = {2}".format(word1, word2, sim))
         return sim
 
+    def build_feature_index(self):
+        """
+        Indexes the lemmas of wrapper.definitions by the features of their
+        definitions: the printnames and the names among the links and nodes
+        (see MinHashIndex.names()). Each rule of
+        _links_and_nodes_similarity() needs a shared feature, so lemmas
+        without one are not similar, under any sim_type but all_pairs.
+        """
+        self.lemma_features = {}
+        self.feature_index = defaultdict(set)
+        for lemma in self.wrapper.definitions:
+            for feature in self.get_lemma_features(lemma):
+                self.feature_index[feature].add(lemma)
+        logging.info('indexed {0} lemmas by {1} features'.format(
+            len(self.lemma_features), len(self.feature_index)))
+
+    def get_lemma_features(self, lemma):
+        if lemma not in self.lemma_features:
+            features = set()
+            for machine in self.wrapper.definitions[lemma]:
+                features.add(machine.printname())
+                features.update(MinHashIndex.names(
+                    *self.get_links_nodes(machine)))
+            self.lemma_features[lemma] = features
+        return self.lemma_features[lemma]
+
+    def candidate_lemmas(self, lemma, sim_type, candidates=None):
+        """
+        The lemmas (of @p candidates, or of all lemmas) that may be similar
+        to @p lemma, see build_feature_index().
+        """
+        if sim_type == 'all_pairs':
+            found = set(self.wrapper.definitions
+                        if candidates is None else candidates)
+        else:
+            if self.lemma_features is None:
+                self.build_feature_index()
+            found = set()
+            for feature in self.get_lemma_features(lemma):
+                found |= self.feature_index.get(feature, set())
+            if candidates is not None:
+                found &= set(candidates)
+        found.discard(lemma)
+        return found
+
+    def most_similar(self, word, k=10, sim_type='default', candidates=None):
+        """
+        Returns the (at most) @p k lemmas most similar to @p word as a list
+        of (lemma, similarity) pairs, the most similar first. Lemmas that
+        are not similar at all are left out.
+        @param candidates the lemmas to choose from, all lemmas by default.
+        """
+        lemma = self.wrapper.get_lemma(word, existing_only=True,
+                                       stem_first=True)
+        if lemma is None:
+            return []
+        sims = ((other, self.lemma_similarity(lemma, other, sim_type))
+                for other in self.candidate_lemmas(lemma, sim_type,
+                                                   candidates))
+        return heapq.nsmallest(k, ((other, sim) for other, sim in sims
+                                   if sim > 0),
+                               key=lambda (other, sim): (-sim, other))
+
+    def similarity_row(self, word, words, sim_type='default'):
+        """
+        Returns the similarities of @p word to each of @p words, as a list,
+        with the same results as word_similarity(): @c None if one of the
+        words has no lemma.
+        """
+        lemma = self.wrapper.get_lemma(word, existing_only=True,
+                                       stem_first=True)
+        lemma_of = self.wrapper.get_lemmas(words, existing_only=True,
+                                           stem_first=True)
+        lemmas = [lemma_of[other] for other in words]
+        if lemma is None:
+            return [None] * len(lemmas)
+        found = self.candidate_lemmas(
+            lemma, sim_type, set(lemmas) - set([None]))
+        row = []
+        for other in lemmas:
+            if other is None:
+                row.append(None)
+            elif other == lemma:
+                row.append(1)
+            elif other in found:
+                row.append(self.lemma_similarity(lemma, other, sim_type))
+            else:
+                row.append(0)
+        return row
+
     def lemma_similarity(self, lemma1, lemma2, sim_type):
-        if (lemma1, lemma2) in self.lemma_sim_cache:
-            return self.lemma_sim_cache[(lemma1, lemma2)]
+        sim = self.lemma_sim_cache.get((lemma1, lemma2, sim_type))
+        if sim is not None:
+            return sim
         elif lemma1 == lemma2:
             return 1
+        if self.store is not None:
+            sim = self.store.get(lemma1, lemma2, sim_type)
+            if sim is not None:
+                self.lemma_sim_cache[(lemma1, lemma2, sim_type)] = sim
+                self.lemma_sim_cache[(lemma2, lemma1, sim_type)] = sim
+                return sim
         self.log(u'lemma1: {0}, lemma2: {1}'.format(lemma1, lemma2))
 
         machines1 = self.wrapper.definitions[lemma1]
@@ -217,20 +697,356 @@ class WordSimilarity():
         if draw_graphs and not self.wrapper.batch:
             graph = MachineGraph.create_from_machines(
                 [machine1, machine2])  # , max_depth=1)
-            f = open('graphs/{0}_{1}.dot'.format(lemma1, lemma2), 'w')
-            f.write(graph.to_dot().encode('utf-8'))
+            with open('graphs/{0}_{1}.dot'.format(lemma1, lemma2), 'w') as f:
+                graph.write_dot(f)
 
         sim = sim if sim >= 0 else 0
-        self.lemma_sim_cache[(lemma1, lemma2)] = sim
-        self.lemma_sim_cache[(lemma2, lemma1)] = sim
+        self.lemma_sim_cache[(lemma1, lemma2, sim_type)] = sim
+        self.lemma_sim_cache[(lemma2, lemma1, sim_type)] = sim
+        if self.store is not None:
+            self.store.put(lemma1, lemma2, sim_type, sim)
         return sim
 
+class SparseLemmaSimilarity():
+    """
+    Computes WordSimilarity.lemma_similarity() for all pairs of a set of
+    lemmas at once. The links and nodes of each definition machine are
+    stored in sparse incidence matrices, the intersections needed by the
+    Jaccard similarities are computed blockwise by sparse matrix products,
+    and the rules of _links_and_nodes_similarity() are applied as masks.
+    The results are the same as those of the scalar path.
+    """
+    # sim_type -> (exclude_nodes, no_contain_score)
+    sim_types = {
+        'default': (False, False),
+        'links_and_nodes': (False, False),
+        'strict_links_and_nodes': (False, True),
+        'links': (True, False),
+        'strict_links': (True, True)}
+
+    def __init__(self, word_sim, sim_type='default', block_size=512,
+                 processes=1):
+        """
+        @param processes the number of forked worker processes the blocks
+                         of machines are split among.
+        """
+        if sim_type not in SparseLemmaSimilarity.sim_types:
+            raise Exception(
+                "similarity type not supported by the sparse engine: " +
+                "{0}".format(sim_type))
+        self.word_sim = word_sim
+        self.exclude_nodes, self.no_contain_score = (
+            SparseLemmaSimilarity.sim_types[sim_type])
+        self.block_size = block_size
+        self.processes = processes
+
+    def lemma_similarities(self, lemmas):
+        """
+        Returns the similarities of the pairs of different lemmas in
+        @p lemmas that are not 0, as a dictionary {(lemma1, lemma2): sim}.
+        Each pair is only stored in one order.
+        """
+        lemmas = sorted(set(lemmas))
+        definitions = self.word_sim.wrapper.definitions
+        machine_ids = {}
+        machines = []
+        lemmas_by_machine = defaultdict(list)
+        for lemma in lemmas:
+            for machine in definitions[lemma]:
+                if machine not in machine_ids:
+                    machine_ids[machine] = len(machines)
+                    machines.append(machine)
+                lemmas_by_machine[machine_ids[machine]].append(lemma)
+        logging.info('computing similarities of {0} lemmas ({1} machines)'.format(
+            len(lemmas), len(machines)))
+
+        machine_sims = self.machine_similarities(machines)
+
+        # the pairs of lemmas with machines of non-zero similarity
+        lemma_pairs = set()
+        for i, j in machine_sims:
+            for lemma1 in lemmas_by_machine[i]:
+                for lemma2 in lemmas_by_machine[j]:
+                    if lemma1 != lemma2:
+                        lemma_pairs.add(tuple(sorted((lemma1, lemma2))))
+
+        def machine_sim(machine1, machine2):
+            i, j = machine_ids[machine1], machine_ids[machine2]
+            return machine_sims.get((min(i, j), max(i, j)), 0)
+
+        sims = {}
+        for lemma1, lemma2 in lemma_pairs:
+            # the same choice as in WordSimilarity.lemma_similarity()
+            pairs_by_sim = sorted([
+                (machine_sim(machine1, machine2), (machine1, machine2))
+                for machine1 in definitions[lemma1]
+                for machine2 in definitions[lemma2]], reverse=True)
+            sim = pairs_by_sim[0][0]
+            sim = sim if sim >= 0 else 0
+            if sim != 0:
+                sims[lemma1, lemma2] = sim
+        return sims
+
+    def machine_similarities(self, machines):
+        """
+        Returns the _links_and_nodes_similarity() of the pairs of
+        @p machines that are not 0, as a dictionary {(i, j): sim}, i <= j.
+        """
+        link_ids, name_ids = {}, {}
+
+        def get_id(ids, item):
+            if item not in ids:
+                ids[item] = len(ids)
+            return ids[item]
+
+        # rows of the incidence matrices
+        links, nodes, str_links, link_names, names = [], [], [], [], []
+        entity_links = set()
+        for machine in machines:
+            links1, nodes1 = self.word_sim.get_links_nodes(machine)
+            links.append([get_id(link_ids, link) for link in links1])
+            for link in links1:
+                if "@" in link:
+                    entity_links.add(link_ids[link])
+            nodes.append([get_id(name_ids, node) for node in nodes1])
+            str_links.append([get_id(name_ids, link) for link in links1
+                              if not isinstance(link, tuple)])
+            # contains() also looks inside the binary links
+            link_names.append(list(set(
+                get_id(name_ids, name) for link in links1
+                for name in (link if isinstance(link, tuple) else (link,)))))
+            names.append([get_id(name_ids, machine.printname())])
+
+        L = SparseLemmaSimilarity.incidence(links, len(link_ids))
+        entity_cols = np.zeros(len(link_ids), dtype=bool)
+        entity_cols[list(entity_links)] = True
+        E = L[:, np.flatnonzero(entity_cols)].tocsr()
+        N = SparseLemmaSimilarity.incidence(nodes, len(name_ids))
+        ZL = SparseLemmaSimilarity.incidence(str_links, len(name_ids))
+        CL = SparseLemmaSimilarity.incidence(link_names, len(name_ids))
+        P = SparseLemmaSimilarity.incidence(names, len(name_ids))
+        has_entities = np.diff(E.indptr) > 0
+        matrices = (L, E, N, ZL, CL, P, has_entities)
+
+        sims = {}
+        starts = xrange(0, len(machines), self.block_size)
+        if self.processes < 2 or len(starts) < 2:
+            for start in starts:
+                sims.update(self.block_sim_dict(start, *matrices))
+            return sims
+        logging.info('computing {0} blocks with {1} processes'.format(
+            len(starts), self.processes))
+        # the workers inherit these when they are forked
+        _sparse_state['engine'] = self
+        _sparse_state['matrices'] = matrices
+        pool = multiprocessing.Pool(self.processes)
+        try:
+            for block_sims in pool.imap_unordered(_sparse_block, starts):
+                sims.update(block_sims)
+            pool.close()
+            pool.join()
+        finally:
+            pool.terminate()
+            _sparse_state.clear()
+        return sims
+
+    def block_sim_dict(self, start, L, E, N, ZL, CL, P, has_entities):
+        """
+        The non-zero similarities of the machines in the block starting at
+        @p start, as machine_similarities() returns them.
+        """
+        end = min(start + self.block_size, L.shape[0])
+        block_sims, is_int = self.block_similarities(
+            start, end, L, E, N, ZL, CL, P, has_entities)
+        sims = {}
+        rows, cols = np.nonzero(block_sims)
+        for r, c in zip(rows.tolist(), cols.tolist()):
+            i = start + r
+            if c < i:
+                continue
+            sim = block_sims[r, c]
+            sims[i, c] = int(sim) if is_int[r, c] else float(sim)
+        return sims
+
+    def block_similarities(self, start, end, L, E, N, ZL, CL, P,
+                           has_entities):
+        """
+        Computes _links_and_nodes_similarity() between the machines
+        [start, end) and all machines. Returns the similarities and a mask
+        of those that the scalar path returns as an int.
+        """
+        def both_ways(A, B):
+            """Whether row i of A and row j of B or vica versa intersect."""
+            return ((A[start:end] * B.T).toarray() +
+                    (B[start:end] * A.T).toarray()) > 0
+
+        def jaccard(A):
+            # the rows have no duplicate columns
+            sizes = np.diff(A.indptr).astype(np.float64)
+            inter = (A[start:end] * A.T).toarray().astype(np.float64)
+            union = sizes[start:end, None] + sizes[None, :] - inter
+            res = np.zeros(inter.shape)
+            np.divide(inter, union, out=res, where=inter > 0)
+            return res
+
+        sim = np.zeros((end - start, L.shape[0]))
+        if not self.no_contain_score:
+            contains_nodes = (np.zeros(sim.shape, dtype=bool)
+                              if self.exclude_nodes else both_ways(N, P))
+            sim[contains_nodes] = 0.25
+            sim[both_ways(CL, P)] = 0.35
+
+        entities = has_entities[start:end, None] | has_entities[None, :]
+        sim = np.where(entities, np.maximum(sim, jaccard(E)),
+                       np.maximum(sim, jaccard(L)))
+        if not self.exclude_nodes:
+            node_sim = jaccard(N)
+            sim = np.where(~entities & (node_sim > sim), node_sim, sim)
+
+        zero_path = both_ways(ZL, P)
+        sim[zero_path] = 1
+        return sim, zero_path
+
+    @staticmethod
+    def incidence(rows, num_cols):
+        """A CSR matrix with ones in the columns listed in each row."""
+        indptr = np.cumsum([0] + [len(row) for row in rows])
+        indices = np.fromiter(chain.from_iterable(rows), dtype=np.int64,
+                              count=indptr[-1])
+        data = np.ones(len(indices), dtype=np.float64)
+        return csr_matrix((data, indices, indptr),
+                          shape=(len(rows), num_cols))
+
+class MinHashIndex():
+    """
+    An approximate nearest-neighbour index of the lemmas in
+    wrapper.definitions under the links_and_nodes similarity. The links and
+    nodes of each definition machine are summarized by a MinHash signature,
+    and the signatures are split into bands that are hashed into LSH
+    buckets: machines sharing a bucket are likely to have a high Jaccard
+    similarity. Since the contains and 0-path rules do not depend on the
+    Jaccard similarity, the machines that have the printname of the query
+    among their links or nodes (or vica versa) are also candidates. The
+    candidates are ranked by the exact _links_and_nodes_similarity().
+    """
+    # a Mersenne prime for the hash functions (a * x + b) mod prime
+    prime = (1 << 31) - 1
+
+    def __init__(self, word_sim, num_perm=64, bands=16, seed=0):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm must be a multiple of bands")
+        self.word_sim = word_sim
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm / bands
+        rnd = np.random.RandomState(seed)
+        self.a = rnd.randint(1, MinHashIndex.prime, num_perm).astype(np.int64)
+        self.b = rnd.randint(0, MinHashIndex.prime, num_perm).astype(np.int64)
+
+    def build(self, lemmas=None):
+        """Indexes the definitions of @p lemmas (by default, all lemmas)."""
+        definitions = self.word_sim.wrapper.definitions
+        if lemmas is None:
+            lemmas = definitions.keys()
+        self.machines = []
+        self.lemma_of = []
+        self.machine_ids = defaultdict(list)
+        # name -> ids of the machines with the name among their links/nodes
+        self.name_index = defaultdict(set)
+        # band -> band of the signature -> machine ids
+        self.buckets = [defaultdict(list) for i in xrange(self.bands)]
+        for lemma in sorted(lemmas):
+            for machine in definitions[lemma]:
+                i = len(self.machines)
+                self.machines.append(machine)
+                self.lemma_of.append(lemma)
+                self.machine_ids[lemma].append(i)
+                links, nodes = self.word_sim.get_links_nodes(machine)
+                for name in MinHashIndex.names(links, nodes):
+                    self.name_index[name].add(i)
+                if not links and not nodes:
+                    continue
+                signature = self.signature(links, nodes)
+                for band in xrange(self.bands):
+                    self.buckets[band][signature[
+                        band * self.rows:(band + 1) * self.rows].tostring()
+                    ].append(i)
+        logging.info('indexed {0} machines of {1} lemmas'.format(
+            len(self.machines), len(self.machine_ids)))
+
+    @staticmethod
+    def names(links, nodes):
+        """The names that contains() and the 0-path rule look for."""
+        for link in links:
+            if isinstance(link, tuple):
+                for name in link:
+                    yield name
+            else:
+                yield link
+        for node in nodes:
+            yield node
+
+    def signature(self, links, nodes):
+        """The MinHash signature of the links and nodes of a machine."""
+        items = [('link', link) for link in links] + [
+            ('node', node) for node in nodes]
+        x = np.fromiter((hash(item) & 0x7fffffff for item in items),
+                        dtype=np.int64, count=len(items))
+        hashes = (np.outer(self.a, x) + self.b[:, None]) % MinHashIndex.prime
+        return hashes.min(axis=1).astype(np.uint32)
+
+    def candidates(self, lemma):
+        """The ids of the machines that may be similar to those of @p lemma."""
+        candidates = set()
+        for machine in self.word_sim.wrapper.definitions[lemma]:
+            links, nodes = self.word_sim.get_links_nodes(machine)
+            candidates |= self.name_index.get(machine.printname(), set())
+            for name in MinHashIndex.names(links, nodes):
+                candidates.update(self.machine_ids.get(name, ()))
+            if not links and not nodes:
+                continue
+            signature = self.signature(links, nodes)
+            for band in xrange(self.bands):
+                candidates.update(self.buckets[band].get(signature[
+                    band * self.rows:(band + 1) * self.rows].tostring(), ()))
+        return candidates
+
+    def most_similar(self, lemma, k=10):
+        """
+        Returns the (at most) @p k lemmas most similar to @p lemma as a list
+        of (lemma, similarity) pairs, the most similar first.
+        """
+        sims = {}
+        for i in self.candidates(lemma):
+            other = self.lemma_of[i]
+            if other == lemma:
+                continue
+            for machine in self.word_sim.wrapper.definitions[lemma]:
+                sim = self.word_sim._links_and_nodes_similarity(
+                    machine, self.machines[i])
+                if sim > sims.get(other, 0):
+                    sims[other] = sim
+        return sorted(sims.iteritems(), key=lambda (l, s): (-s, l))[:k]
+
 class SentenceSimilarity():
-    def __init__(self, machine_wrapper):
+    def __init__(self, machine_wrapper, symmetric_fallback=False):
+        """
+        @param symmetric_fallback whether the fallback similarities passed
+                                  to the methods are symmetric. If so,
+                                  sentence_similarity() compares each word
+                                  pair only once (see
+                                  batch_sentence_similarity()); with an
+                                  asymmetric fallback, the scores would be
+                                  different.
+        """
         self.wrapper = machine_wrapper
         self.word_sim = WordSimilarity(machine_wrapper)
+        self.symmetric_fallback = symmetric_fallback
 
     def process_line(self, line, parser, sen_filter, fallback_sim):
+        print self.line_similarity(line, parser, sen_filter, fallback_sim)
+
+    def line_similarity(self, line, parser, sen_filter, fallback_sim):
         fields = line.decode('latin1').strip().split('\t')
         sen1, sen2, tags1, tags2 = parser(fields)
         sen1 = sen_filter([{"token": sen1[i], "pos": pos, "ner": ner}
@@ -238,8 +1054,54 @@ class SentenceSimilarity():
         sen2 = sen_filter([{"token": sen2[i], "pos": pos, "ner": ner}
                           for i, (pos, ner) in enumerate(tags2)])
 
-        sim = self.sentence_similarity(sen1, sen2, fallback=fallback_sim)
-        print sim
+        return self.sentence_similarity(sen1, sen2, fallback=fallback_sim)
+
+    def process_file(self, in_file, out_file, parser, sen_filter,
+                     fallback_sim, processes=1, chunk_size=100):
+        """
+        Writes the similarity of each line of @p in_file to @p out_file, in
+        the order of the lines, as process_line() prints them. The lines
+        are read in chunks of @p chunk_size and scored by @p processes
+        forked worker processes, which share the loaded wrapper. The
+        throughput of reading, scoring and writing is logged.
+        """
+        times = defaultdict(float)
+
+        def chunks():
+            while True:
+                started = time.time()
+                lines = list(islice(in_file, chunk_size))
+                times['read'] += time.time() - started
+                if not lines:
+                    return
+                yield lines
+
+        # the workers inherit these when they are forked
+        _pipeline_state['sen_sim'] = self
+        _pipeline_state['args'] = (parser, sen_filter, fallback_sim)
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        count = 0
+        started = time.time()
+        try:
+            results = (imap if pool is None else pool.imap)(
+                _line_similarities, chunks())
+            for sims, score_time in results:
+                times['score'] += score_time
+                write_started = time.time()
+                for sim in sims:
+                    out_file.write('{0}\n'.format(sim))
+                times['write'] += time.time() - write_started
+                count += len(sims)
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _pipeline_state.clear()
+        for stage in ('read', 'score', 'write'):
+            logging.info('{0}: {1} lines in {2:.2f}s ({3:.1f} lines/s)'.format(
+                stage, count, times[stage],
+                count / times[stage] if times[stage] else float('inf')))
+        logging.info('{0} lines in {1:.2f}s with {2} processes'.format(
+            count, time.time() - started, processes))
 
     def directional_sen_similarity(self, sen1, sen2, fallback):
         return average((
@@ -250,10 +1112,175 @@ class SentenceSimilarity():
             for word1 in sen1))
 
     def sentence_similarity(self, sen1, sen2, fallback=lambda a, b, c, d: 0.0):
+        if self.symmetric_fallback:
+            return self.batch_sentence_similarity(sen1, sen2, fallback)
         return harmonic_mean((
             self.directional_sen_similarity(sen1, sen2, fallback),
             self.directional_sen_similarity(sen2, sen1, fallback)))
 
+    def batch_sentence_similarity(self, sen1, sen2, fallback):
+        """
+        The same as sentence_similarity(), but each word is lemmatized once
+        and each word pair is compared once: both directional similarities
+        are computed from the rows and the columns of similarity_matrix().
+        @p fallback has to be symmetric.
+        """
+        matrix = self.similarity_matrix(sen1, sen2, fallback)
+        return harmonic_mean((
+            average(SentenceSimilarity.maxima(matrix, axis=1)),
+            average(SentenceSimilarity.maxima(matrix, axis=0))))
+
+    def similarity_matrix(self, sen1, sen2, fallback):
+        """
+        The word similarities of @p sen1 and @p sen2 as a
+        len(sen1) x len(sen2) array, NaN where @p fallback returned None.
+        """
+        lemmas = self.wrapper.get_lemmas(
+            set(word['token'] for word in chain(sen1, sen2)),
+            existing_only=True, stem_first=True)
+        matrix = np.empty((len(sen1), len(sen2)))
+        for i, word1 in enumerate(sen1):
+            lemma1 = lemmas[word1['token']]
+            for j, word2 in enumerate(sen2):
+                lemma2 = lemmas[word2['token']]
+                if lemma1 is None or lemma2 is None:
+                    sim = fallback(word1['token'], word2['token'], -1, -1)
+                else:
+                    sim = self.word_sim.lemma_similarity(
+                        lemma1, lemma2, 'default')
+                matrix[i, j] = np.nan if sim is None else sim
+        return matrix
+
+    @staticmethod
+    def maxima(matrix, axis):
+        """
+        The maxima of the rows (@p axis = 1) or columns (@p axis = 0) of
+        @p matrix, as my_max() computes them: NaN (None) loses to any
+        similarity, a row of NaNs gives None and an empty row 0.0.
+        """
+        if matrix.shape[axis] == 0:
+            return [0.0] * matrix.shape[1 - axis]
+        maxima = np.where(np.isnan(matrix), -np.inf, matrix).max(axis=axis)
+        return [None if sim == -np.inf else sim for sim in maxima.tolist()]
+
+
+class SimMatrix():
+    """
+    The similarities of all pairs of a vocabulary, stored in two files: the
+    words, one per line, in @p file_name.vocab, and the upper triangle of
+    the similarity matrix, row by row, in @p file_name.npy, as a float32
+    array (a memmap). Missing similarities are NaN.
+    """
+    def __init__(self, words, sims):
+        self.words = words
+        self.word_index = dict((word, i) for i, word in enumerate(words))
+        self.sims = sims
+
+    @staticmethod
+    def create(file_name, words):
+        words = sorted(words)
+        with open(file_name + '.vocab', 'w') as vocab_file:
+            for word in words:
+                vocab_file.write(u'{0}\n'.format(word).encode('utf-8'))
+        n = len(words)
+        sims = np.lib.format.open_memmap(
+            file_name + '.npy', mode='w+', dtype=np.float32,
+            shape=(n * (n - 1) / 2,))
+        sims[:] = np.nan
+        return SimMatrix(words, sims)
+
+    @staticmethod
+    def load(file_name):
+        with open(file_name + '.vocab') as vocab_file:
+            words = [line.rstrip('\n').decode('utf-8') for line in vocab_file]
+        return SimMatrix(words, np.load(file_name + '.npy', mmap_mode='r'))
+
+    def pair_index(self, w1, w2):
+        i, j = sorted((self.word_index[w1], self.word_index[w2]))
+        if i == j:
+            raise KeyError((w1, w2))
+        return i * (2 * len(self.words) - i - 1) / 2 + j - i - 1
+
+    def __getitem__(self, (w1, w2)):
+        return self.sims[self.pair_index(w1, w2)]
+
+    def __setitem__(self, (w1, w2), sim):
+        self.sims[self.pair_index(w1, w2)] = np.nan if sim is None else sim
+
+    def flush(self):
+        self.sims.flush()
+
+class WordPairs():
+    """
+    The pairs (w1, w2) of different @p words with w1 < w2, in the order of
+    SimMatrix. The pairs are generated, not stored.
+    """
+    def __init__(self, words):
+        self.words = sorted(words)
+
+    def __len__(self):
+        return len(self.words) * (len(self.words) - 1) / 2
+
+    def __iter__(self):
+        return self.slice(0, len(self))
+
+    def slice(self, start, end):
+        """
+        The pairs [@p start, @p end), generated from the position of
+        @p start without going through the pairs before it.
+        """
+        n = len(self.words)
+        # the first word of the pair at start, and its position in the row
+        i, j = 0, start
+        while i < n and j >= n - 1 - i:
+            j -= n - 1 - i
+            i += 1
+        count = end - start
+        while i < n and count > 0:
+            w1 = self.words[i]
+            for w2 in self.words[i + 1 + j:i + 1 + j + count]:
+                yield w1, w2
+            count -= n - 1 - i - j
+            i, j = i + 1, 0
+
+class Correlation():
+    """
+    The Pearson correlation of a stream of value pairs, read in chunks.
+    The chunks are merged into the means and (co)variances with the
+    pairwise update formulas of Chan et al., which are numerically stable.
+    """
+    def __init__(self):
+        self.n = 0
+        self.mean_x = self.mean_y = 0.0
+        self.m2_x = self.m2_y = self.c_xy = 0.0
+
+    def update(self, xs, ys):
+        xs, ys = np.asarray(xs, dtype=float), np.asarray(ys, dtype=float)
+        n = len(xs)
+        if n == 0:
+            return
+        mean_x, mean_y = xs.mean(), ys.mean()
+        dxs, dys = xs - mean_x, ys - mean_y
+        total = self.n + n
+        delta_x, delta_y = mean_x - self.mean_x, mean_y - self.mean_y
+        factor = float(self.n) * n / total
+        self.m2_x += np.dot(dxs, dxs) + delta_x * delta_x * factor
+        self.m2_y += np.dot(dys, dys) + delta_y * delta_y * factor
+        self.c_xy += np.dot(dxs, dys) + delta_x * delta_y * factor
+        self.mean_x += delta_x * n / total
+        self.mean_y += delta_y * n / total
+        self.n = total
+
+    def correlation(self):
+        """The same (r, two-tailed p-value) pair as scipy's pearsonr()."""
+        if self.m2_x == 0 or self.m2_y == 0:
+            return float('nan'), 1.0
+        r = max(min(self.c_xy / np.sqrt(self.m2_x * self.m2_y), 1.0), -1.0)
+        df = self.n - 2
+        if abs(r) == 1.0 or df <= 0:
+            return r, 0.0
+        t = r * np.sqrt(df / ((1.0 - r) * (1.0 + r)))
+        return r, 2 * t_distribution.sf(abs(t), df)
 
 class SimComparer():
     def __init__(self, cfg_file, batch=True):
@@ -284,11 +1311,61 @@ class SimComparer():
     def get_machine_sim(self, batch):
         wrapper = MachineWrapper(
             self.config_file, include_longman=True, batch=batch)
-        self.sim_wrapper = WordSimilarity(wrapper)
+        cache_sizes = [
+            self.config.getint('machine', option)
+            if self.config.has_option('machine', option) else None
+            for option in ('lemma_cache_size', 'links_nodes_cache_size')]
+        store = None
+        if self.config.has_option('machine', 'sim_store'):
+            store = SimilarityStore(self.config.get('machine', 'sim_store'),
+                                    wrapper.definitions_fingerprint())
+        self.sim_wrapper = WordSimilarity(
+            wrapper, *[LRUCache(size) for size in cache_sizes], store=store)
+        if self.config.has_option('machine', 'links_nodes_index'):
+            self.get_links_nodes_index(
+                self.config.get('machine', 'links_nodes_index'))
+
+    def get_links_nodes_index(self, file_name):
+        """
+        Loads the LinksNodesIndex of the definitions from @p file_name, or
+        builds it and saves it there if it is missing or out of date.
+        """
+        fingerprint = self.sim_wrapper.wrapper.definitions_fingerprint()
+        index = None
+        if os.path.exists(file_name):
+            index = LinksNodesIndex.load(file_name, fingerprint)
+        if index is None:
+            logging.warning('building links and nodes index...')
+            index = LinksNodesIndex.build(self.sim_wrapper, fingerprint)
+            index.save(file_name)
+        self.sim_wrapper.links_nodes_index = index
 
     def sim(self, w1, w2):
         return self.sim_wrapper.word_similarity(w1, w2, -1, -1)
 
+    def binary_sims(self):
+        """
+        Whether the similarities are written to SimMatrix files instead of
+        text files ([words] binary_sims).
+        """
+        return (self.config.has_option('words', 'binary_sims') and
+                self.config.getboolean('words', 'binary_sims'))
+
+    def sim_processes(self):
+        """The number of processes computing the similarities."""
+        return (self.config.getint('machine', 'sim_processes')
+                if self.config.has_option('machine', 'sim_processes') else 1)
+
+    def sparse_sims(self):
+        """
+        Whether the similarities of all pairs are computed at once by
+        SparseLemmaSimilarity ([machine] sparse_sims) instead of pair by
+        pair. The results are the same, but the definitions of all words
+        are held in sparse matrices.
+        """
+        return (self.config.has_option('machine', 'sparse_sims') and
+                self.config.getboolean('machine', 'sparse_sims'))
+
     def get_words(self):
         self.words = set((
             line.strip().decode("utf-8") for line in open(
@@ -297,13 +1374,24 @@ class SimComparer():
 
     def get_machine_sims(self):
         sim_file = self.config.get('machine', 'sim_file')
-        self.machine_sims = {}
-        out = open(sim_file, 'w')
+        processes = self.sim_processes()
+        # the sparse engine splits its blocks of machines among the
+        # processes itself; the shards then only look up its results
+        get_sim = self.get_batch_sims() if self.sparse_sims() else self.sim
+        if processes > 1:
+            self.get_machine_sims_parallel(sim_file, get_sim, processes)
+            return
+        if self.binary_sims():
+            self.machine_sims = SimMatrix.create(sim_file, self.non_oov)
+            out = None
+        else:
+            self.machine_sims = {}
+            out = open(sim_file, 'w')
         count = 0
         for w1, w2 in self.sorted_word_pairs:
             if count % 100000 == 0:
                 logging.warning("{0} pairs done".format(count))
-            sim = self.sim(w1, w2)
+            sim = get_sim(w1, w2)
             if sim is None:
                 logging.warning(
                     u"sim is None for non-ooovs: {0} and {1}".format(w1, w2))
@@ -312,12 +1400,148 @@ class SimComparer():
             else:
                 self.machine_sims[(w1, w2)] = sim
             count += 1
-            out.write(
-                u"{0}_{1}\t{2}\n".format(w1, w2, sim).encode('utf-8'))
-        out.close()
+            if out is not None:
+                out.write(
+                    u"{0}_{1}\t{2}\n".format(w1, w2, sim).encode('utf-8'))
+        if out is None:
+            self.machine_sims.flush()
+        else:
+            out.close()
+        self.sim_wrapper.flush()
+        logging.warning('cache stats: {0}'.format(
+            self.sim_wrapper.cache_stats()))
+
+    def get_machine_sims_parallel(self, sim_file, get_sim, processes):
+        """
+        The same as get_machine_sims(), but the pairs are split into
+        shards, which are computed by forked worker processes sharing the
+        loaded lexicon. Each shard is written to a file of its own; the
+        files are merged in the order of the pairs, so the output is the
+        same as that of the sequential version.
+        """
+        # the workers iterate the pairs in the same order, and jump to the
+        # first pair of their shards
+        pairs = self.sorted_word_pairs
+        if not isinstance(pairs, (WordPairs, list)):
+            pairs = list(pairs)
+        shard_num = min(len(pairs), processes * 4) or 1
+        shard_size = (len(pairs) + shard_num - 1) / shard_num
+        shards = [(start, min(start + shard_size, len(pairs)),
+                   '{0}.shard{1}'.format(sim_file, i))
+                  for i, start in enumerate(xrange(0, len(pairs), shard_size))]
+        logging.warning('computing {0} pairs in {1} shards with {2} '.format(
+            len(pairs), len(shards), processes) + 'processes')
+        # the workers inherit these when they are forked
+        _shard_state['pairs'] = pairs
+        _shard_state['get_sim'] = get_sim
+        _shard_state['word_sim'] = self.sim_wrapper
+        _shard_state['text'] = not self.binary_sims()
+        self.sim_wrapper.flush()
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = [pool.apply_async(_machine_sims_shard, shard)
+                       for shard in shards]
+            pool.close()
+            # get() reraises the exceptions of the workers
+            stats = [result.get() for result in results]
+            pool.join()
+        finally:
+            pool.terminate()
+            _shard_state.clear()
+        logging.warning('cache stats: {0}'.format(merge_cache_stats(stats)))
+
+        if self.binary_sims():
+            self.machine_sims = SimMatrix.create(sim_file, self.non_oov)
+            out = None
+        else:
+            self.machine_sims = {}
+            out = open(sim_file, 'w')
+        pair_iter = iter(pairs)
+        for start, end, shard_fn in shards:
+            sims = np.load(shard_fn + '.npy')
+            if len(sims) != end - start:
+                raise Exception('shard {0} is incomplete'.format(shard_fn))
+            for pair, sim in izip(islice(pair_iter, end - start), sims):
+                self.machine_sims[pair] = sim
+            if out is not None:
+                with open(shard_fn) as shard_file:
+                    shutil.copyfileobj(shard_file, out)
+                os.remove(shard_fn)
+            os.remove(shard_fn + '.npy')
+        if out is None:
+            self.machine_sims.flush()
+        else:
+            out.close()
+
+    def get_batch_sims(self):
+        """
+        Computes the similarities of all words in the pairs with
+        SparseLemmaSimilarity. Returns a function that gives the same
+        results as sim().
+        """
+        if isinstance(self.sorted_word_pairs, WordPairs):
+            words = self.sorted_word_pairs.words
+        else:
+            words = set(chain(*self.sorted_word_pairs))
+        lemmas = self.sim_wrapper.wrapper.get_lemmas(
+            words, existing_only=True, stem_first=True)
+        store = self.sim_wrapper.store
+        if store is None:
+            lemma_sims = SparseLemmaSimilarity(
+                self.sim_wrapper,
+                processes=self.sim_processes()).lemma_similarities(
+                    lemma for lemma in lemmas.itervalues()
+                    if lemma is not None)
+        else:
+            lemma_sims = self.get_stored_batch_sims(lemmas, store)
+
+        def get_sim(w1, w2):
+            lemma1, lemma2 = lemmas[w1], lemmas[w2]
+            if lemma1 is None or lemma2 is None:
+                return None
+            elif lemma1 == lemma2:
+                return 1
+            return lemma_sims.get((lemma1, lemma2),
+                                  lemma_sims.get((lemma2, lemma1), 0))
+        return get_sim
+
+    def get_stored_batch_sims(self, lemmas, store):
+        """
+        Reads the similarities of the lemma pairs from @p store, and
+        computes only the missing ones, with SparseLemmaSimilarity. The
+        new similarities (zeros included) are added to @p store.
+        """
+        lemma_pairs = set()
+        for w1, w2 in self.sorted_word_pairs:
+            lemma1, lemma2 = lemmas[w1], lemmas[w2]
+            if lemma1 is None or lemma2 is None or lemma1 == lemma2:
+                continue
+            lemma_pairs.add((lemma1, lemma2))
+        lemma_sims = store.get_all(lemma_pairs, 'default')
+        missing = lemma_pairs.difference(lemma_sims)
+        logging.warning('{0} lemma pairs in the store, {1} missing'.format(
+            len(lemma_sims), len(missing)))
+        if missing:
+            new_sims = SparseLemmaSimilarity(
+                self.sim_wrapper,
+                processes=self.sim_processes()).lemma_similarities(
+                    chain(*missing))
+            for lemma1, lemma2 in missing:
+                sim = new_sims.get((lemma1, lemma2),
+                                   new_sims.get((lemma2, lemma1), 0))
+                lemma_sims[(lemma1, lemma2)] = sim
+                store.put(lemma1, lemma2, 'default', sim)
+            store.flush()
+        return lemma_sims
 
     def get_vec_sims(self):
         sim_file = self.config.get('vectors', 'sim_file')
+        if self.binary_sims():
+            self.vec_sims = SimMatrix.create(sim_file, self.non_oov)
+            for w1, w2 in self.sorted_word_pairs:
+                self.vec_sims[(w1, w2)] = self.vec_sim(w1, w2)
+            self.vec_sims.flush()
+            return
         out = open(sim_file, 'w')
         self.vec_sims = {}
         for w1, w2 in self.sorted_word_pairs:
@@ -337,31 +1561,58 @@ class SimComparer():
                 len(self.non_oov)))
 
         logging.warning('lemmatizing words to determine machine-OOVs...')
+        lemmas = self.sim_wrapper.wrapper.get_lemmas(
+            self.non_oov, existing_only=True, stem_first=True)
         self.non_oov = set(
-            (word for word in self.non_oov
-                if self.sim_wrapper.wrapper.get_lemma(
-                    word, existing_only=True, stem_first=True) is not None))
+            word for word, lemma in lemmas.iteritems() if lemma is not None)
 
         logging.warning(
             'kept {0} words after discarding those not in machine sim'.format(
                 len(self.non_oov)))
 
-        self.sorted_word_pairs = set()
-        for w1 in self.non_oov:
-            for w2 in self.non_oov:
-                if w1 != w2 and w1 == sorted([w1, w2])[0]:
-                    self.sorted_word_pairs.add((w1, w2))
+        self.sorted_word_pairs = WordPairs(self.non_oov)
 
         self.get_machine_sims()
         self.get_vec_sims()
 
-    def compare(self):
-        sims = [self.machine_sims[pair] for pair in self.sorted_word_pairs]
-        vec_sims = [self.vec_sims[pair] for pair in self.sorted_word_pairs]
+    def sim_arrays(self, chunk_size=1000000):
+        """
+        Generates the machine and the vector similarities of the word pairs
+        in pairs of arrays of at most @p chunk_size elements.
+        """
+        if self.binary_sims():
+            # the matrices are read from the files, without copying them
+            sims = SimMatrix.load(self.config.get('machine', 'sim_file')).sims
+            vec_sims = SimMatrix.load(
+                self.config.get('vectors', 'sim_file')).sims
+            for start in xrange(0, len(sims), chunk_size):
+                yield (sims[start:start + chunk_size],
+                       vec_sims[start:start + chunk_size])
+            return
+        pairs = iter(self.sorted_word_pairs)
+        while True:
+            chunk = list(islice(pairs, chunk_size))
+            if not chunk:
+                return
+            yield (np.array([self.machine_sims[pair] for pair in chunk],
+                            dtype=float),
+                   np.array([self.vec_sims[pair] for pair in chunk],
+                            dtype=float))
 
-        pearson = pearsonr(sims, vec_sims)
-        print "compared {0} distance pairs.".format(len(sims))
-        print "Pearson-correlation: {0}".format(pearson)
+    def compare(self):
+        pearson = Correlation()
+        for sims, vec_sims in self.sim_arrays():
+            pearson.update(sims, vec_sims)
+        print "compared {0} distance pairs.".format(pearson.n)
+        print "Pearson-correlation: {0}".format(pearson.correlation())
+        if self.config.has_option('words', 'spearman') and \
+                self.config.getboolean('words', 'spearman'):
+            # ranking needs all similarities in memory
+            sims, vec_sims = [np.concatenate(arrays)
+                              for arrays in zip(*self.sim_arrays())]
+            spearman = Correlation()
+            spearman.update(rankdata(sims), rankdata(vec_sims))
+            print "Spearman-correlation: {0}".format(spearman.correlation())
 
 def main():
         logging.basicConfig(
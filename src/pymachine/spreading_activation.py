@@ -1,4 +1,3 @@
-from math import factorial as fac
 import logging
 import itertools
 
@@ -99,38 +98,19 @@ class SpreadingActivation(object):
             for c in semantic_constructions:
                 # The machines that can take part in constructions
                 logging.info("CONST " + c.name)
-                accepted = []
-                # Find the sequences that match the construction
-                # TODO: combinatorial explosion alert!
-                no_active = len(self.lexicon.active_machines())
+                candidates = [
+                    machine for machine in self.lexicon.active_machines()
+                    if not isinstance(machine.control, ConceptControl)]
                 max_length = 3
-                no_all_combinations = sum((fac(no_active)/fac(no_active-i-1)
-                                          for i in range(max_length)))
                 logging.info((
                     '# of active machines: {0}, ' +
-                    'trying all sequences of at most {1} machines, ' +
-                    'total # of sequences: {2}').format(
-                    no_active, max_length, no_all_combinations))
-                """
-                for i, seq in enumerate(powerset(
-                        self.lexicon.active_machines())):
-                """
-                count = 0
-                for elems in xrange(
-                        min(len(self.lexicon.active_machines()), max_length)):
-                #for elems in xrange(len(constable)):
-                    for i, seq in enumerate(itertools.permutations(
-                            self.lexicon.active_machines(), elems + 1)):
-                        if any(isinstance(machine.control, ConceptControl)
-                               for machine in seq):
-                            continue
-                        #logging.info('trying this: {0}'.format(seq))
-                        count += 1
-                        if count % 10000 == 0:
-                            logging.info("{0}".format(count))
-
-                        if c.check(seq):
-                            accepted.append(seq)
+                    '# of non-concept machines: {1}, ' +
+                    'looking for sequences of at most {2} machines').format(
+                    len(self.lexicon.active), len(candidates), max_length))
+                # Find the sequences that match the construction; the
+                # control of the construction drives the search, so not
+                # every permutation has to be checked
+                accepted = c.matching_sequences(candidates, max_length)
 
                 # The sequence preference order is longer first
                 # TODO: obviously this won't work for every imaginable
@@ -0,0 +1,512 @@
+"""Frozen, array-backed storage for the static graph of the Lexicon."""
+from collections import MutableMapping, deque
+from itertools import chain
+import mmap
+import os
+import struct
+
+import numpy as np
+
+from pymachine.constants import deep_pre, avm_pre, enc_pre, id_sep
+from pymachine.control import ConceptControl
+from pymachine.machine import Machine, Partition
+
+class StaticMachine(Machine):
+    """
+    A machine backed by a node of a StaticGraph. The partitions and the
+    parents of the machine are only created when they are first accessed,
+    so touching a machine does not materialize the whole graph around it.
+    Static machines should be treated as read-only.
+    """
+    __slots__ = ('graph', 'node')
+
+    def __init__(self, graph, node):
+        self.graph = graph
+        self.node = node
+        self.printname_ = graph.printname_(node)
+        self.set_control(graph.control(node))
+
+    def __getattr__(self, attr):
+        # only called for attributes that have not been hydrated yet
+        if attr == 'partitions':
+            self.partitions = [
+                Partition(self.graph.machine(child) for child in part)
+                for part in self.graph.partitions(self.node)]
+            return self.partitions
+        elif attr == 'parents':
+            self.parents = set((self.graph.machine(parent), color)
+                               for parent, color in
+                               self.graph.parents(self.node))
+            return self.parents
+        raise AttributeError(attr)
+
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, unicode) else s
+
+class StringTable(object):
+    """
+    The string table of a snapshot: strings are decoded from the mapped
+    buffer when they are first accessed.
+    """
+    def __init__(self, offsets, data):
+        self.offsets = offsets
+        self.data = data
+        self.cache = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        """The UTF-8 encoded string with index @p i."""
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tostring()
+
+    def __getitem__(self, i):
+        i = int(i)
+        s = self.cache.get(i)
+        if s is None:
+            s = self.cache[i] = self.raw(i).decode('utf-8')
+        return s
+
+class SnapshotEntries(object):
+    """
+    The entries (keys of Lexicon.static) of a snapshot. They are stored
+    sorted by their UTF-8 encoding, so lookups are binary searches on the
+    mapped buffer and no dictionary has to be built when a snapshot is
+    opened.
+    """
+    def __init__(self, strings, keys):
+        self.strings = strings
+        # string ids of the keys, in sorted order
+        self.keys_ = keys
+
+    def __len__(self):
+        return len(self.keys_)
+
+    def _bisect(self, raw_key):
+        """The index of the first key not smaller than @p raw_key."""
+        lo, hi = 0, len(self.keys_)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.strings.raw(self.keys_[mid]) < raw_key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def __getitem__(self, key):
+        raw_key = _utf8(key)
+        i = self._bisect(raw_key)
+        if (i < len(self.keys_) and
+                self.strings.raw(self.keys_[i]) == raw_key):
+            return i
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        try:
+            self[key]
+            return True
+        except (KeyError, UnicodeError):
+            return False
+
+    def __iter__(self):
+        return (self.strings[k] for k in self.keys_)
+
+    def keys(self):
+        return list(self)
+
+    def with_prefix(self, prefix):
+        """Returns the keys that start with @p prefix."""
+        raw_prefix = _utf8(prefix)
+        res = []
+        for i in xrange(self._bisect(raw_prefix), len(self.keys_)):
+            if not self.strings.raw(self.keys_[i]).startswith(raw_prefix):
+                break
+            res.append(self.strings[self.keys_[i]])
+        return res
+
+class StaticGraph(object):
+    """
+    A frozen copy of Lexicon.static, built by Lexicon.finalize_static(). Nodes
+    are identified by integers, printnames are interned in a string table,
+    and the partitions of the machines are stored as partition-colored
+    adjacency lists in CSR format, along with the reverse (parent) adjacency.
+    Machine objects are only created on demand (see machine()).
+    """
+    CONTROL_NONE, CONTROL_CONCEPT, CONTROL_OTHER = xrange(3)
+
+    # the snapshot format; see save()
+    magic = 'PMSTATIC'
+    version = 1
+    header = struct.Struct('<8sII')
+    section_header = struct.Struct('<16s4sQQ')
+
+    def __init__(self):
+        # string table
+        self.strings = []
+        self.string_ids = {}
+        # node table
+        self.names = None
+        self.part_nums = None
+        self.control_kinds = None
+        # controls that are neither None nor ConceptControl, by node id
+        self.controls = {}
+        # partition-colored adjacency (children) and reverse adjacency
+        self.offsets, self.targets, self.colors = None, None, None
+        self.rev_offsets, self.rev_sources, self.rev_colors = None, None, None
+        # Lexicon.static keys -> the nodes stored under them
+        self.entries = {}
+        self.entry_offsets, self.entry_nodes = None, None
+        # hydrated machines, by node id
+        self._machines = {}
+
+    @staticmethod
+    def from_static(static):
+        """
+        Builds the graph from @p static, a Lexicon.static-like dictionary
+        that maps printnames to lists of machines. Node ids are assigned in
+        breadth-first order, starting from the entries in sorted key order.
+        """
+        g = StaticGraph()
+        node_ids = {}
+        queue = deque()
+
+        def node_id(m):
+            if m not in node_ids:
+                node_ids[m] = len(node_ids)
+                queue.append(m)
+            return node_ids[m]
+
+        keys = sorted(static.keys())
+        entry_offsets, entry_nodes = [0], []
+        for i, key in enumerate(keys):
+            g.entries[key] = i
+            entry_nodes.extend(node_id(m) for m in static[key])
+            entry_offsets.append(len(entry_nodes))
+
+        names, part_nums, control_kinds = [], [], []
+        offsets, targets, colors = [0], [], []
+        while queue:
+            m = queue.popleft()
+            names.append(g._intern(m.printname_))
+            part_nums.append(len(m.partitions))
+            control_kinds.append(g._control_kind(len(names) - 1, m.control))
+            for color, part in enumerate(m.partitions):
+                for child in part:
+                    targets.append(node_id(child))
+                    colors.append(color)
+            offsets.append(len(targets))
+
+        g.entry_offsets = np.array(entry_offsets, dtype=np.int32)
+        g.entry_nodes = np.array(entry_nodes, dtype=np.int32)
+        g.names = np.array(names, dtype=np.int32)
+        g.part_nums = np.array(part_nums, dtype=np.uint8)
+        g.control_kinds = np.array(control_kinds, dtype=np.uint8)
+        g.offsets = np.array(offsets, dtype=np.int32)
+        g.targets = np.array(targets, dtype=np.int32)
+        g.colors = np.array(colors, dtype=np.uint8)
+        g._build_reverse()
+        return g
+
+    def save(self, file_name):
+        """
+        Saves the graph in a versioned binary snapshot that can be opened
+        with load(). The file consists of a header, a table of sections
+        (name, dtype, offset and length) and the sections themselves: the
+        string table, the node table, the edge arrays and the entries.
+        Sections are 8-byte aligned little-endian arrays.
+        """
+        if self.controls:
+            raise ValueError(
+                "only None and ConceptControl controls can be saved, " +
+                "got {0}".format(set(type(c) for c in self.controls.values())))
+        if self.string_ids is None:
+            # loaded from a snapshot
+            self.string_ids = dict((self.strings[i], i)
+                                   for i in xrange(len(self.strings)))
+        # entries are sorted by their UTF-8 encoding; see SnapshotEntries
+        keys = sorted(self.entries, key=_utf8)
+        entry_keys, entry_offsets, entry_nodes = [], [0], []
+        for key in keys:
+            entry_keys.append(self._intern(key))
+            entry_nodes.extend(self.entry(key))
+            entry_offsets.append(len(entry_nodes))
+
+        raw_strings = [_utf8(self.strings[i])
+                       for i in xrange(len(self.strings))]
+        string_offsets = np.zeros(len(raw_strings) + 1, dtype=np.int64)
+        np.cumsum([len(r) for r in raw_strings], out=string_offsets[1:])
+        string_data = np.frombuffer(''.join(raw_strings) or '\0',
+                                    dtype=np.uint8)
+
+        sections = [
+            ('string_offsets', string_offsets),
+            ('string_data', string_data),
+            ('names', self.names),
+            ('part_nums', self.part_nums),
+            ('control_kinds', self.control_kinds),
+            ('offsets', self.offsets),
+            ('targets', self.targets),
+            ('colors', self.colors),
+            ('rev_offsets', self.rev_offsets),
+            ('rev_sources', self.rev_sources),
+            ('rev_colors', self.rev_colors),
+            ('entry_keys', np.array(entry_keys, dtype=np.int32)),
+            ('entry_offsets', np.array(entry_offsets, dtype=np.int32)),
+            ('entry_nodes', np.array(entry_nodes, dtype=np.int32))]
+
+        offset = (StaticGraph.header.size +
+                  StaticGraph.section_header.size * len(sections))
+        table = []
+        for name, array_ in sections:
+            array_ = np.ascontiguousarray(
+                array_, dtype=array_.dtype.newbyteorder('<'))
+            offset += -offset % 8
+            table.append((name, array_, offset))
+            offset += array_.nbytes
+
+        # written to a temporary file first, so that processes that have
+        # the old snapshot open are not affected
+        tmp_name = '{0}.tmp{1}'.format(file_name, os.getpid())
+        with open(tmp_name, 'wb') as f:
+            f.write(StaticGraph.header.pack(
+                StaticGraph.magic, StaticGraph.version, len(table)))
+            for name, array_, offset in table:
+                f.write(StaticGraph.section_header.pack(
+                    name, array_.dtype.str, offset, len(array_)))
+            for name, array_, offset in table:
+                f.write('\0' * (offset - f.tell()))
+                f.write(array_.tostring())
+        os.rename(tmp_name, file_name)
+
+    @staticmethod
+    def load(file_name):
+        """
+        Opens a snapshot written by save(). The file is memory-mapped and
+        the arrays of the graph are views of the mapping, so opening does not
+        depend on the size of the graph, and processes that open the same
+        snapshot share its pages.
+        """
+        with open(file_name, 'rb') as f:
+            buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, num_sections = StaticGraph.header.unpack_from(buf, 0)
+        if magic != StaticGraph.magic:
+            raise ValueError("{0} is not a static graph snapshot".format(
+                file_name))
+        if version != StaticGraph.version:
+            raise ValueError(
+                "unsupported snapshot version {0} in {1}, expected {2}".format(
+                    version, file_name, StaticGraph.version))
+        sections = {}
+        for i in xrange(num_sections):
+            name, dtype, offset, length = StaticGraph.section_header.unpack_from(
+                buf, StaticGraph.header.size +
+                i * StaticGraph.section_header.size)
+            dtype = np.dtype(dtype.rstrip('\0'))
+            if length == 0:
+                sections[name.rstrip('\0')] = np.zeros(0, dtype=dtype)
+            else:
+                sections[name.rstrip('\0')] = np.frombuffer(
+                    buf, dtype=dtype, count=length, offset=offset)
+
+        g = StaticGraph()
+        g.strings = StringTable(sections['string_offsets'],
+                                sections['string_data'])
+        g.string_ids = None
+        for attr in ('names', 'part_nums', 'control_kinds', 'offsets',
+                     'targets', 'colors', 'rev_offsets', 'rev_sources',
+                     'rev_colors', 'entry_offsets', 'entry_nodes'):
+            setattr(g, attr, sections[attr])
+        g.entries = SnapshotEntries(g.strings, sections['entry_keys'])
+        return g
+
+    def _intern(self, s):
+        if s not in self.string_ids:
+            self.string_ids[s] = len(self.strings)
+            self.strings.append(s)
+        return self.string_ids[s]
+
+    def _control_kind(self, node, control):
+        if control is None:
+            return StaticGraph.CONTROL_NONE
+        elif type(control) is ConceptControl:
+            return StaticGraph.CONTROL_CONCEPT
+        self.controls[node] = control
+        return StaticGraph.CONTROL_OTHER
+
+    def _build_reverse(self):
+        """Builds the reverse adjacency from the forward one."""
+        num_nodes = len(self.names)
+        sources = np.repeat(np.arange(num_nodes, dtype=np.int32),
+                            np.diff(self.offsets))
+        # stable sort keeps the parents of a node in node id order
+        order = np.argsort(self.targets, kind='mergesort')
+        self.rev_sources = sources[order]
+        self.rev_colors = self.colors[order]
+        self.rev_offsets = np.zeros(num_nodes + 1, dtype=np.int32)
+        np.cumsum(np.bincount(self.targets, minlength=num_nodes),
+                  out=self.rev_offsets[1:])
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def keys(self):
+        return self.entries.keys()
+
+    def num_nodes(self):
+        return len(self.names)
+
+    def entry(self, key):
+        """Returns the ids of the nodes stored under @p key."""
+        i = self.entries[key]
+        return self.entry_nodes[
+            self.entry_offsets[i]:self.entry_offsets[i + 1]].tolist()
+
+    def printname_(self, node):
+        """The full printname of @p node (see Machine.printname_)."""
+        return self.strings[self.names[node]]
+
+    def printname(self, node):
+        """The printname of @p node without the disambiguation id."""
+        return self.printname_(node).split(id_sep)[0]
+
+    def deep_case(self, node):
+        return self.printname_(node)[0] == deep_pre
+
+    def fancy(self, node):
+        return self.printname_(node)[0] in (deep_pre, avm_pre, enc_pre)
+
+    def control(self, node):
+        """Returns a control for @p node, or @c None."""
+        kind = self.control_kinds[node]
+        if kind == StaticGraph.CONTROL_CONCEPT:
+            return ConceptControl()
+        elif kind == StaticGraph.CONTROL_OTHER:
+            return self.controls[node]
+        return None
+
+    def edges(self, node):
+        """Returns the (child, partition) pairs of @p node."""
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return zip(self.targets[start:end].tolist(),
+                   self.colors[start:end].tolist())
+
+    def children(self, node):
+        start, end = self.offsets[node], self.offsets[node + 1]
+        return self.targets[start:end].tolist()
+
+    def parents(self, node):
+        """Returns the (parent, partition) pairs of @p node."""
+        start, end = self.rev_offsets[node], self.rev_offsets[node + 1]
+        return zip(self.rev_sources[start:end].tolist(),
+                   self.rev_colors[start:end].tolist())
+
+    def partitions(self, node):
+        """Returns the partitions of @p node as lists of node ids."""
+        partitions = [[] for _ in xrange(self.part_nums[node])]
+        for child, color in self.edges(node):
+            partitions[color].append(child)
+        return partitions
+
+    def machine(self, node):
+        """Returns the (lazily hydrated) machine for @p node."""
+        m = self._machines.get(node)
+        if m is None:
+            m = self._machines[node] = StaticMachine(self, node)
+        return m
+
+    def machines(self, key):
+        return [self.machine(node) for node in self.entry(key)]
+
+class StaticGraphView(MutableMapping):
+    """
+    Exposes a StaticGraph through the dictionary interface of
+    Lexicon.static. Entries are hydrated into lists of StaticMachines when
+    they are first accessed; entries added after the graph was frozen are
+    kept in a plain dictionary on top of it.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        # hydrated entries of the graph
+        self.hydrated = {}
+        # entries added or replaced after the graph was built
+        self.overlay = {}
+        self.deleted = set()
+
+    def is_frozen(self, key):
+        """Whether @p key can be read from the graph directly."""
+        return (key in self.graph and key not in self.overlay and
+                key not in self.deleted)
+
+    def __getitem__(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if not self.is_frozen(key):
+            raise KeyError(key)
+        if key not in self.hydrated:
+            self.hydrated[key] = self.graph.machines(key)
+        return self.hydrated[key]
+
+    def __setitem__(self, key, value):
+        self.overlay[key] = value
+        self.deleted.discard(key)
+
+    def __delitem__(self, key):
+        if key in self.overlay:
+            del self.overlay[key]
+        elif not self.is_frozen(key):
+            raise KeyError(key)
+        if key in self.graph:
+            self.deleted.add(key)
+            self.hydrated.pop(key, None)
+
+    def __contains__(self, key):
+        return key in self.overlay or self.is_frozen(key)
+
+    def __iter__(self):
+        return chain(
+            (key for key in self.graph.entries if self.is_frozen(key)),
+            iter(self.overlay))
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+class DisambigView(MutableMapping):
+    """
+    Lexicon.static_disambig for a static graph loaded from a snapshot: the
+    fully qualified names of an ambiguous name are looked up in the sorted
+    entries of the snapshot when they are first needed.
+    """
+    def __init__(self, graph):
+        self.graph = graph
+        self.cache = {}
+
+    def __getitem__(self, ambig_name):
+        if ambig_name not in self.cache:
+            names = set(self.graph.entries.with_prefix(ambig_name + id_sep))
+            if ambig_name in self.graph:
+                names.add(ambig_name)
+            if not names:
+                raise KeyError(ambig_name)
+            self.cache[ambig_name] = names
+        return self.cache[ambig_name]
+
+    def __setitem__(self, ambig_name, names):
+        self.cache[ambig_name] = names
+
+    def __delitem__(self, ambig_name):
+        self[ambig_name]
+        self.cache[ambig_name] = set()
+
+    def __iter__(self):
+        seen = set()
+        for key in chain(self.graph.entries, self.cache):
+            ambig_name = key.split(id_sep)[0]
+            if ambig_name not in seen and self.get(ambig_name):
+                seen.add(ambig_name)
+                yield ambig_name
+
+    def __len__(self):
+        return sum(1 for _ in self)
@@ -1,46 +1,132 @@
+from collections import OrderedDict
+import json
 import logging
 import os
 
-import networkx as nx
-from networkx.readwrite import json_graph
-
 from pymachine.machine import Machine
 
 def ensure_dir(path):
     if not os.path.exists(path):
         os.mkdir(path)
 
+class LRUCache(object):
+    """
+    A dictionary of at most @p max_size items (no limit if @c None): when
+    it is full, adding an item evicts the least recently used one. The
+    hits, misses and evictions are counted, see stats().
+    """
+    def __init__(self, max_size=None):
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        try:
+            value = self.items.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self.items[key] = value
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.items:
+            del self.items[key]
+        elif self.max_size is not None and len(self.items) >= self.max_size:
+            self.items.popitem(last=False)
+            self.evictions += 1
+        self.items[key] = value
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self):
+        return {'size': len(self.items), 'max_size': self.max_size,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
+
 class MachineTraverser():
+    """
+    Depth-first traversal of machine graphs with an explicit stack, so deep
+    graphs do not hit the recursion limit. The machines are visited in the
+    order of a recursive preorder traversal: the children partition by
+    partition, then the parents. Each machine is visited once, at the depth
+    of the first path that reaches it.
+    @param direction 'children', 'parents' or 'both'.
+    @param max_depth the machines deeper than this are not visited (no
+                     limit if @c None).
+    @param partitions the partitions whose children are followed (all of
+                      them if @c None).
+    """
+    directions = ('children', 'parents', 'both')
+
     @staticmethod
     def get_nodes(machine, exclude_words=[]):
-        traverser = MachineTraverser()
-        # logging.info('getting nodes for: {0}'.format(machine.printname()))
-        return traverser._get_nodes(machine, depth=0,
-                                    exclude_words=set(exclude_words))
+        """
+        The printnames of the machines connected to @p machine, except for
+        the uppercase ones and @p exclude_words.
+        """
+        exclude_words = set(exclude_words)
+        for submachine, depth in MachineTraverser().traverse(machine):
+            name = submachine.printname()
+            if not name.isupper() and name not in exclude_words:
+                yield name
 
-    def __init__(self):
-        self.seen_for_nodes = set()
+    def __init__(self, direction='both', max_depth=None, partitions=None):
+        if direction not in MachineTraverser.directions:
+            raise ValueError("unknown direction: {0}".format(direction))
+        self.children = direction in ('children', 'both')
+        self.parents = direction in ('parents', 'both')
+        self.max_depth = max_depth
+        self.partitions = partitions
 
-    def _get_nodes(self, machine, depth, exclude_words=set()):
-        if machine in self.seen_for_nodes:
-            return
-        self.seen_for_nodes.add(machine)
-        name = machine.printname()
-        # logging.info(u'traversing: {0}'.format(name))
-        if not name.isupper() and name not in exclude_words:
-            yield name
-
-        for part in machine.partitions:
-            for submachine in part:
-                for node in self._get_nodes(submachine, depth=depth+1,
-                                            exclude_words=exclude_words):
-                    yield node
-        for parent, _ in machine.parents:
-            for node in self._get_nodes(parent, depth=depth+1,
-                                        exclude_words=exclude_words):
-                yield node
+    def neighbours(self, machine):
+        neighbours = []
+        if self.children:
+            for i, part in enumerate(machine.partitions):
+                if self.partitions is None or i in self.partitions:
+                    neighbours.extend(part)
+        if self.parents:
+            neighbours.extend(parent for parent, _ in machine.parents)
+        return neighbours
+
+    def traverse(self, machine):
+        """Generates the (machine, depth) pairs reachable from @p machine."""
+        seen = set()
+        stack = [(machine, 0)]
+        while stack:
+            machine, depth = stack.pop()
+            if machine in seen:
+                continue
+            seen.add(machine)
+            yield machine, depth
+            if self.max_depth is not None and depth >= self.max_depth:
+                continue
+            neighbours = self.neighbours(machine)
+            neighbours.reverse()
+            stack.extend((neighbour, depth + 1) for neighbour in neighbours)
+
+    def visit(self, machine, visitor):
+        """Calls @p visitor(machine, depth) on each machine of traverse()."""
+        for submachine, depth in self.traverse(machine):
+            visitor(submachine, depth)
 
 class MachineGraph:
+    """
+    A directed multigraph of the unique names of machines, for drawing:
+    each edge is labeled by a color (the partition). It is written as DOT
+    or as the adjacency format of networkx's json_graph. Nodes and edges
+    are sorted, so the output is deterministic.
+    """
     @staticmethod
     def create_from_machines(iterable, max_depth=None, whitelist=None,
                              strict=False):
@@ -97,44 +183,89 @@ class MachineGraph:
                 neighbour, max_depth, whitelist, depth=depth+1)
 
     def __init__(self):
-        self.G = nx.MultiDiGraph()
+        # node -> list of (neighbour, color) pairs
+        self.adjacency = {}
+
+    def add_node(self, node):
+        self.adjacency.setdefault(node, [])
 
     def add_edge(self, node1, node2, color):
         # logging.debug(u'adding edge: {} -> {}'.format(node1, node2))
-        self.G.add_nodes_from([node1, node2])
-        self.G.add_edge(node1, node2, color=color)
+        self.add_node(node2)
+        self.adjacency.setdefault(node1, []).append((node2, color))
+
+    def adjacency_data(self, node):
+        """
+        The edges from @p node in json_graph format: the key of an edge
+        numbers the edges between the same two nodes.
+        """
+        keys = {}
+        for neighbour, color in sorted(self.adjacency[node]):
+            key = keys.get(neighbour, 0)
+            keys[neighbour] = key + 1
+            yield {'id': neighbour, 'key': key, 'color': color}
 
     def to_dict(self):
-        return json_graph.adjacency.adjacency_data(self.G)
+        nodes = sorted(self.adjacency)
+        return {'directed': True, 'multigraph': True, 'graph': [],
+                'nodes': [{'id': node} for node in nodes],
+                'adjacency': [list(self.adjacency_data(node))
+                              for node in nodes]}
+
+    def write_json(self, f):
+        """Writes to_dict() to @p f as JSON, one node at a time."""
+        nodes = sorted(self.adjacency)
+        f.write('{"directed": true, "multigraph": true, "graph": [], ')
+        f.write('"nodes": [')
+        for i, node in enumerate(nodes):
+            f.write((', ' if i else '') + json.dumps({'id': node}))
+        f.write('], "adjacency": [')
+        for i, node in enumerate(nodes):
+            f.write((', ' if i else '') + json.dumps(
+                list(self.adjacency_data(node)), sort_keys=True))
+        f.write(']}')
 
     @staticmethod
     def from_dict(d):
-        return json_graph.adjacency.adjacency_graph(d)
+        g = MachineGraph()
+        for node, edges in zip(d['nodes'], d['adjacency']):
+            g.add_node(node['id'])
+            for edge in edges:
+                g.add_edge(node['id'], edge['id'], edge['color'])
+        return g
 
-    def to_dot(self):
-        lines = [u'digraph finite_state_machine {', '\tdpi=100;']
-        # lines.append('\tordering=out;')
+    def dot_lines(self):
+        yield u'digraph finite_state_machine {'
+        yield u'\tdpi=100;'
+        # yield u'\tordering=out;'
         # sorting everything to make the process deterministic
         node_lines = []
-        for node in self.G.nodes_iter():
+        for node in self.adjacency:
             d_node = Machine.d_clean(node)
             printname = Machine.d_clean(d_node.split('_')[0])
             node_lines.append(u'\t{0} [shape = circle, label = "{1}"];'.format(
                 d_node, printname).replace('-', '_'))
-        lines += sorted(node_lines)
+        node_lines.sort()
+        for line in node_lines:
+            yield line
         edge_lines = []
-        for node1, adjacency in self.G.adjacency_iter():
-            d_node1 = Machine.d_clean(node1)
-            for node2, edges in adjacency.iteritems():
-                d_node2 = Machine.d_clean(node2)
-                for i, attributes in edges.iteritems():
-                    edge_lines.append(
-                        u'\t{0} -> {1} [ label = "{2}" ];'.format(
-                            d_node1.replace('-', '_'),
-                            d_node2.replace('-', '_'), attributes['color']))
-        lines += sorted(edge_lines)
-        lines.append('}')
-        return u'\n'.join(lines)
+        for node1, edges in self.adjacency.iteritems():
+            d_node1 = Machine.d_clean(node1).replace('-', '_')
+            for node2, color in edges:
+                edge_lines.append(u'\t{0} -> {1} [ label = "{2}" ];'.format(
+                    d_node1, Machine.d_clean(node2).replace('-', '_'), color))
+        edge_lines.sort()
+        for line in edge_lines:
+            yield line
+        yield u'}'
+
+    def to_dot(self):
+        return u'\n'.join(self.dot_lines())
+
+    def write_dot(self, f, encoding='utf-8'):
+        """Writes to_dot() to @p f line by line."""
+        for i, line in enumerate(self.dot_lines()):
+            f.write(((u'\n' if i else u'') + line).encode(encoding))
 
 def harmonic_mean(seq):
     try:
@@ -1,10 +1,13 @@
 #!/usr/bin/env python
-from copy import deepcopy
 import cPickle
+import hashlib
+import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
+from itertools import chain
 
 from pymachine.construction import VerbConstruction
 from pymachine.sentence_parser import SentenceParser
@@ -13,7 +16,11 @@ from pymachine.operators import AppendToBinaryFromLexiconOperator  # nopep8
 from pymachine.utils import ensure_dir, MachineGraph, MachineTraverser
 from pymachine.machine import Machine
 from pymachine.spreading_activation import SpreadingActivation
-from pymachine.definition_parser import read as read_defs
+from pymachine.definition_parser import cache_file_name, files_hash
+from pymachine.definition_parser import read_cached
+from pymachine.definition_parser import LazyDefinitions, PARSER_VERSION
+from pymachine.definition_parser import read_plur
+from pymachine.lemma_index import LemmaIndex
 from pymachine.sup_dic import supplementary_dictionary_reader as sdreader
 from pymachine import np_grammar
 
@@ -27,6 +34,35 @@ def jaccard(s1, s2):
     except ZeroDivisionError:
         return 0.0
 
+# state shared with the worker processes of Wrapper.draw_word_graphs()
+_draw_state = {}
+
+def _as_unicode(string):
+    """Headwords may be UTF-8 byte strings; the manifest has unicode."""
+    return string.decode('utf-8') if isinstance(string, str) else string
+
+def _fs_path(path, file_name):
+    """The path of @p file_name (unicode) as a UTF-8 byte string."""
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    return os.path.join(path, file_name.encode('utf-8'))
+
+def _draw_word_graphs_shard(words):
+    """
+    Draws the graphs of @p words in a worker of Wrapper.draw_word_graphs().
+    Returns the manifest entries of the words and the number of words
+    that had to be drawn.
+    """
+    wrapper = _draw_state['wrapper']
+    entries = {}
+    drawn = 0
+    for word in words:
+        key = _as_unicode(word)
+        entries[key], changed = wrapper.draw_word_graph(
+            word, _draw_state['path'], _draw_state['manifest'].get(key))
+        drawn += changed
+    return entries, drawn
+
 class Wrapper:
 
     num_re = re.compile(r'^[0-9.,]+$', re.UNICODE)
@@ -39,18 +75,35 @@ class Wrapper:
         self.__read_definitions()
         if include_ext:
             self.get_ext_definitions()
+        self.build_lemma_index()
         self.__read_supp_dict()
         self.reset_lexicon()
 
     def reset_lexicon(self, load_from=None, save_to=None):
+        """
+        Builds the lexicon from the definitions, or loads it from
+        @p load_from. Files whose name ends with 'pickle' hold a pickled
+        Lexicon; any other file is a static graph snapshot (see
+        Lexicon.save_static()).
+        """
         if load_from:
-            self.lexicon = cPickle.load(open(load_from))
+            if load_from.endswith('pickle'):
+                self.lexicon = cPickle.load(open(load_from))
+            else:
+                logging.info('loading static graph snapshot from {}...'.format(
+                    load_from))
+                self.lexicon = Lexicon()
+                self.lexicon.load_static(load_from)
+                self.__add_constructions()
         else:
             self.lexicon = Lexicon()
             self.__add_definitions()
             self.__add_constructions()
         if save_to:
-            cPickle.dump(self.lexicon, open(save_to, 'w'))
+            if save_to.endswith('pickle'):
+                cPickle.dump(self.lexicon, open(save_to, 'w'))
+            else:
+                self.lexicon.save_static(save_to)
 
     def __read_config(self):
         items = dict(self.cfg.items("machine"))
@@ -61,10 +114,37 @@ class Wrapper:
         self.ext_defs_path = items.get("ext_definitions")
         self.supp_dict_fn = items.get("supp_dict")
         self.plural_fn = items.get("plurals")
+        self.definition_cache = items.get("definition_cache")
+        self.compact_static = (
+            self.cfg.has_option("machine", "compact_static") and
+            self.cfg.getboolean("machine", "compact_static"))
+        self.lazy_definitions = (
+            self.cfg.has_option("machine", "lazy_definitions") and
+            self.cfg.getboolean("machine", "lazy_definitions"))
+        self.fast_parser = (
+            self.cfg.has_option("machine", "fast_parser") and
+            self.cfg.getboolean("machine", "fast_parser"))
+        self.definition_processes = (
+            self.cfg.getint("machine", "definition_processes")
+            if self.cfg.has_option("machine", "definition_processes") else 1)
+        self.graph_processes = (
+            self.cfg.getint("machine", "graph_processes")
+            if self.cfg.has_option("machine", "graph_processes") else 1)
 
     def __read_definitions(self):
-        self.definitions = {}
+        if self.lazy_definitions:
+            lazy_files = [(file_name, printname_index)
+                          for file_name, printname_index in self.def_files
+                          if not file_name.endswith('pickle')]
+            logging.info('indexing 4lang definitions...')
+            self.definitions = LazyDefinitions(
+                lazy_files, self.plural_fn, three_parts=True,
+                fast_parser=self.fast_parser)
+        else:
+            self.definitions = {}
         for file_name, printname_index in self.def_files:
+            if self.lazy_definitions and not file_name.endswith('pickle'):
+                continue
             # TODO HACK makefile needed
             if (file_name.endswith("generated") and
                     not os.path.exists(file_name)):
@@ -76,16 +156,25 @@ class Wrapper:
             if file_name.endswith('pickle'):
                 logging.info(
                     'loading 4lang definitions from {}...'.format(file_name))
-                definitions = cPickle.load(file(file_name))
+                with open(file_name, 'rb') as f:
+                    definitions = cPickle.load(f)
             else:
                 logging.info('parsing 4lang definitions...')
-                definitions = read_defs(
-                    file(file_name), self.plural_fn, printname_index,
-                    three_parts=True)
+                pickle_fn = '{0}.pickle'.format(file_name)
+                cached = os.path.exists(cache_file_name(
+                    file_name, self.plural_fn, printname_index,
+                    three_parts=True, cache_dir=self.definition_cache))
+                definitions = read_cached(
+                    file_name, self.plural_fn, printname_index,
+                    three_parts=True, processes=self.definition_processes,
+                    fast_parser=self.fast_parser,
+                    cache_dir=self.definition_cache)
 
-                logging.info('dumping 4lang definitions to file...')
-                f = open('{0}.pickle'.format(file_name), 'w')
-                cPickle.dump(definitions, f)
+                # only needed if the definitions had to be parsed
+                if not cached or not os.path.exists(pickle_fn):
+                    logging.info('dumping 4lang definitions to file...')
+                    with open(pickle_fn, 'wb') as f:
+                        cPickle.dump(definitions, f, cPickle.HIGHEST_PROTOCOL)
 
             for pn, machines in definitions.iteritems():
                 if pn not in self.definitions:
@@ -94,9 +183,16 @@ class Wrapper:
                     self.definitions[pn] |= machines
 
     def __add_definitions(self):
-            definitions = deepcopy(self.definitions)
-            self.lexicon.add_static(definitions.itervalues())
-            self.lexicon.finalize_static()
+            if self.lazy_definitions:
+                # definitions are added to the lexicon when it needs them
+                if self.compact_static:
+                    logging.warning(
+                        'compact_static is ignored with lazy_definitions')
+                self.lexicon.set_definition_source(self.definitions)
+                self.lexicon.finalize_static()
+                return
+            self.lexicon.add_static(self.definitions.itervalues())
+            self.lexicon.finalize_static(compact=self.compact_static)
 
     def __read_supp_dict(self):
         self.supp_dict = sdreader(
@@ -108,6 +204,32 @@ class Wrapper:
         # add_verb_constructions(self.lexicon, self.supp_dict)
         # add_avm_constructions(self.lexicon, self.supp_dict)
 
+    def build_lemma_index(self):
+        """Has to be called again if the definitions change."""
+        plur_dict = read_plur(open(self.plural_fn)) if self.plural_fn else {}
+        self.lemma_index = LemmaIndex(self.definitions, plur_dict)
+
+    def get_lemma(self, word, existing_only=True, stem_first=True):
+        """See LemmaIndex.get()."""
+        return self.lemma_index.get(word, existing_only, stem_first)
+
+    def get_lemmas(self, words, existing_only=True, stem_first=True):
+        """The lemmas of @p words, as a dictionary."""
+        return self.lemma_index.get_all(words, existing_only, stem_first)
+
+    def definitions_fingerprint(self):
+        """
+        A hex digest that changes whenever the definitions may change: the
+        hash of the definition, plural and external definition files.
+        """
+        file_names = [file_name for file_name, _ in self.def_files] + [
+            self.plural_fn]
+        if self.ext_defs_path and os.path.exists(self.ext_defs_path):
+            file_names.append(self.ext_defs_path)
+        sha = files_hash(file_names)
+        sha.update(repr((self.def_files, PARSER_VERSION)))
+        return sha.hexdigest()
+
     def get_ext_definitions(self):
         if self.ext_defs_path.endswith('pickle'):
             logging.info(
@@ -129,20 +251,103 @@ class Wrapper:
             graph = MachineGraph.create_from_machines([machine])
             file_name = os.path.join(path, '{0}_{1}.dot'.format(clean_word, c))
             with open(file_name, 'w') as file_obj:
-                file_obj.write(graph.to_dot().encode('utf-8'))
-
-    def draw_word_graphs(self):
-        ensure_dir('graphs/words')
-        for c, (word, machines) in enumerate(self.definitions.iteritems()):
-            if c % 1000 == 0:
-                logging.info("{0}...".format(c))
-            for i, machine in enumerate(machines):
-                graph = MachineGraph.create_from_machines([machine])
-                clean_word = Machine.d_clean(word)
-                if clean_word[0] == 'X':
-                    clean_word = clean_word[1:]
-                f = open('graphs/words/{0}_{1}.dot'.format(clean_word, i), 'w')
-                f.write(graph.to_dot().encode('utf-8'))
+                graph.write_dot(file_obj)
+
+    @staticmethod
+    def definition_fingerprint(machine):
+        """
+        A hex digest of the graph of @p machine that does not depend on
+        the identity of the machines (unlike their unique names).
+        """
+        edges = sorted(
+            (submachine.printname_, color, child.printname_)
+            for submachine, _ in MachineTraverser().traverse(machine)
+            for color, part in enumerate(submachine.partitions)
+            for child in part)
+        return hashlib.sha1(repr((machine.printname_, edges))).hexdigest()
+
+    def draw_word_graph(self, word, path, entry=None):
+        """
+        Writes the graph of each definition of @p word to
+        @p path/<word>_<i>.dot, the definitions ordered by their
+        fingerprints, unless @p entry (the manifest entry of a previous
+        run) shows that the same files are already there. Returns the new
+        manifest entry and whether the files were written. The file names
+        in the entry are unicode, on disk they are encoded in UTF-8.
+        """
+        fingerprints = [(Wrapper.definition_fingerprint(machine), machine)
+                        for machine in self.definitions[word]]
+        fingerprints.sort(key=lambda (fingerprint, machine): fingerprint)
+        fingerprint = hashlib.sha1(''.join(
+            fp for fp, machine in fingerprints)).hexdigest()
+        clean_word = Machine.d_clean(_as_unicode(word))
+        if clean_word[0] == 'X':
+            clean_word = clean_word[1:]
+        files = [u'{0}_{1}.dot'.format(clean_word, i)
+                 for i in xrange(len(fingerprints))]
+        if (entry is not None and entry['fingerprint'] == fingerprint and
+                entry['files'] == files and
+                all(os.path.exists(_fs_path(path, fn)) for fn in files)):
+            return entry, False
+        for file_name, (_, machine) in zip(files, fingerprints):
+            graph = MachineGraph.create_from_machines([machine])
+            with open(_fs_path(path, file_name), 'w') as f:
+                graph.write_dot(f)
+        return {'fingerprint': fingerprint, 'files': files}, True
+
+    def draw_word_graphs(self, path='graphs/words', processes=None):
+        """
+        Draws the graphs of the definitions of all words (see
+        draw_word_graph()) with @p processes forked worker processes
+        ([machine] graph_processes by default). The words whose definitions
+        did not change since the last run are skipped. The files of each
+        word are listed in the manifest @p path/index.json, the files of
+        removed words are deleted.
+        """
+        if processes is None:
+            processes = self.graph_processes
+        ensure_dir(path)
+        manifest_fn = os.path.join(path, 'index.json')
+        manifest = {}
+        if os.path.exists(manifest_fn):
+            with open(manifest_fn) as f:
+                manifest = json.load(f)
+        words = sorted(self.definitions, key=_as_unicode)
+        shard_size = max(1, len(words) / (processes * 4))
+        shards = [words[i:i + shard_size]
+                  for i in xrange(0, len(words), shard_size)]
+        # the workers inherit these when they are forked
+        _draw_state['wrapper'] = self
+        _draw_state['path'] = path
+        _draw_state['manifest'] = manifest
+        pool = multiprocessing.Pool(processes) if processes > 1 else None
+        new_manifest = {}
+        drawn = 0
+        try:
+            results = (map if pool is None else pool.imap)(
+                _draw_word_graphs_shard, shards)
+            for c, (entries, shard_drawn) in enumerate(results):
+                new_manifest.update(entries)
+                drawn += shard_drawn
+                logging.info("{0}/{1} shards...".format(c + 1, len(shards)))
+        finally:
+            if pool is not None:
+                pool.terminate()
+            _draw_state.clear()
+
+        current_files = set(chain.from_iterable(
+            entry['files'] for entry in new_manifest.itervalues()))
+        for entry in manifest.itervalues():
+            for file_name in entry['files']:
+                if file_name not in current_files and os.path.exists(
+                        _fs_path(path, file_name)):
+                    os.remove(_fs_path(path, file_name))
+        tmp_fn = manifest_fn + '.tmp'
+        with open(tmp_fn, 'w') as f:
+            json.dump(new_manifest, f, indent=0, sort_keys=True)
+        os.rename(tmp_fn, manifest_fn)
+        logging.info('drew the graphs of {0} of {1} words'.format(
+            drawn, len(words)))
 
     def get_def_words(self, stream):
         for headword, machines in self.definitions.iteritems():
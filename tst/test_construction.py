@@ -0,0 +1,53 @@
+import random
+from itertools import permutations
+
+import pytest
+
+from pymachine.construction import Construction
+from pymachine.fst import FSA, FST
+from pymachine.machine import Machine
+from pymachine.matcher import PrintnameMatcher, NotMatcher, OrMatcher
+
+names = ['a', 'b', 'c', 'd']
+
+def random_matcher(rnd):
+    kind = rnd.random()
+    if kind < 0.6:
+        return PrintnameMatcher(rnd.choice(names), exact=True)
+    elif kind < 0.8:
+        return OrMatcher(*[PrintnameMatcher(name, exact=True)
+                           for name in rnd.sample(names, 2)])
+    return NotMatcher(PrintnameMatcher(rnd.choice(names), exact=True))
+
+def random_control(rnd, cls):
+    control = cls()
+    n = rnd.randint(1, 5)
+    for state in xrange(n):
+        control.add_state(state, is_init=state == 0 or rnd.random() < 0.2,
+                          is_final=rnd.random() < 0.4)
+    if len(control.final_states) == 0:
+        control.set_final(rnd.randrange(n))
+    for i in xrange(rnd.randint(0, 3 * n)):
+        args = (random_matcher(rnd), rnd.randrange(n), rnd.randrange(n))
+        if cls is FST:
+            control.add_transition(args[0], [], *args[1:])
+        else:
+            control.add_transition(*args)
+    return control
+
+def checked_sequences(construction, machines, max_length):
+    """The permutation loop matching_sequences() replaced."""
+    return [seq for length in xrange(1, min(len(machines), max_length) + 1)
+            for seq in permutations(machines, length)
+            if construction.check(seq)]
+
+@pytest.mark.parametrize('cls', [FSA, FST])
+def test_matching_sequences(cls):
+    rnd = random.Random(42)
+    for trial in xrange(200):
+        construction = Construction('test', random_control(rnd, cls))
+        machines = [Machine(rnd.choice(names))
+                    for i in xrange(rnd.randint(0, 5))]
+        max_length = rnd.randint(0, 3)
+        assert (construction.matching_sequences(machines, max_length) ==
+                checked_sequences(construction, machines, max_length))
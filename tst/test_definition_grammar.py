@@ -0,0 +1,29 @@
+import os
+
+from pyparsing import ParseException
+
+from pymachine.definition_parser import DefinitionParser
+from pymachine.definition_grammar import read_definitions
+
+tst_dir = os.path.dirname(os.path.abspath(__file__))
+
+definitions = [
+    "dog", "-x", "a/12", "HAS", "=AGT CAUSE[=PAT[healthy]]",
+    "[vet] HEAL [animal], [vet] HAS [hair]", "animal[wild], <big>",
+    "CAUSE/3[dog; cat]", "=REL", "$HUN_X", "#Ab", "@Foo-1", "'",
+    "<dog>", "<=AGT>", "dog(cat)", "<[dog] HAS> IS_A [<cat>]",
+    "dog HAS cat HAS", "dog[cat[mouse[cheese, <hole>]]] IS_A [pet]",
+    "dog(", "[dog", "HAS [cat; dog]", ", dog", "dog ,cat",
+    "  dog\t HAS\tcat  "]
+
+def parse(parser, definition):
+    try:
+        return parser.parse(definition)
+    except ParseException:
+        return None
+
+def test_same_results():
+    slow, fast = DefinitionParser({}), DefinitionParser({}, fast_parser=True)
+    for definition in definitions + read_definitions(
+            os.path.join(tst_dir, 'static_test_definitions')):
+        assert parse(slow, definition) == parse(fast, definition)
@@ -0,0 +1,30 @@
+from pymachine.lemma_index import LemmaIndex
+
+def test_lemma_index():
+    index = LemmaIndex(
+        ['horse', 'animal', 'mouse', 'run', 'university', 'universe',
+         'HAS', '@Paris', '=AGT'],
+        {'horses': 'horse', 'mice': 'mouse', 'oxen': 'ox'})
+    assert index.get('horse') == 'horse'
+    assert index.get('Horse') == 'horse'
+    assert index.get('horses') == 'horse'
+    assert index.get('mice') == 'mouse'
+    assert index.get('oxen') is None
+    assert index.get('running') == 'run'
+    assert index.get('running', stem_first=False) is None
+    assert index.get('running', existing_only=False,
+                     stem_first=False) == 'running'
+    # stems shared by several headwords are not guessed
+    assert index.get('universities') is None
+    assert index.get('universes') is None
+    assert index.get('universities', existing_only=False) == 'universities'
+    assert index.get('university') == 'university'
+    assert index.get('Universe') == 'universe'
+    # binaries, deep cases and entities only by their printnames
+    assert index.get('HAS') == 'HAS'
+    assert index.get('has') is None
+    assert index.get('=AGT') == '=AGT'
+    assert index.get('zebra') is None
+    assert ('zebra', True, True) in index.cache
+    assert index.get_all(['horses', 'zebra']) == {
+        'horses': 'horse', 'zebra': None}
@@ -0,0 +1,96 @@
+import cPickle
+
+import pytest
+
+from pymachine.machine import Machine, Partition
+
+def machines(n):
+    return [Machine('m{0}'.format(i)) for i in xrange(n)]
+
+@pytest.mark.parametrize('n', [4, Partition.scan_limit * 3])
+def test_partition_dedup_and_remove(n):
+    ms = machines(n)
+    part = Partition(ms + ms[::-1])
+    assert len(part) == n
+    assert list(part) == ms
+    part.append(ms[0])
+    assert list(part) == ms
+
+    # removing more than half of the items compacts the partition
+    removed = ms[::2] + ms[1:n / 2:2]
+    for m in removed:
+        part.remove(m)
+    kept = [m for m in ms if m not in removed]
+    assert len(part) == len(kept)
+    assert list(part) == kept
+    assert all(m not in part for m in removed)
+    assert all(m in part for m in kept)
+    assert part[0] is kept[0] and part[-1] is kept[-1]
+    assert part == kept
+    with pytest.raises(ValueError):
+        part.remove(removed[0])
+
+    part.append(removed[0])
+    assert list(part) == kept + [removed[0]]
+
+@pytest.mark.parametrize('n', [4, Partition.scan_limit * 3])
+def test_partition_replace(n):
+    ms = machines(n)
+    new = Machine('new')
+    part = Partition(ms)
+    part.replace(ms[1], new)
+    assert list(part) == [ms[0], new] + ms[2:]
+    assert ms[1] not in part and new in part
+    # replacing with an item already in the partition just removes the old
+    part.replace(ms[0], new)
+    assert list(part) == [new] + ms[2:]
+    part[0] = ms[0]
+    assert list(part) == [ms[0]] + ms[2:]
+
+def test_pickle():
+    dog, animal, bark = Machine('dog/1'), Machine('animal'), Machine('bark')
+    dog.append(animal, 0)
+    bark.append(dog, 1)
+    dog2 = cPickle.loads(cPickle.dumps(dog, 2))
+    assert dog2.printname() == 'dog' and dog2.printname_ == 'dog/1'
+    assert isinstance(dog2.partitions[0], Partition)
+    [animal2] = dog2.partitions[0]
+    assert animal2.printname() == 'animal'
+    assert (dog2, 0) in animal2.parents
+    [(bark2, i)] = dog2.parents
+    assert i == 1 and list(bark2.partitions[1]) == [dog2]
+
+    # machines pickled before __slots__
+    old = Machine.__new__(Machine)
+    old.__setstate__({'printname_': 'old', 'partitions': [[animal], [], []],
+                      'control': None, 'parents': set()})
+    assert old.printname() == 'old'
+    assert list(old.partitions[0]) == [animal]
+
+def test_unify():
+    m1, m2 = Machine('m1'), Machine('m2')
+    children = machines(Partition.scan_limit * 2)
+    parent = Machine('parent')
+    m2.append_all(children, 0)
+    m2.append(children[0], 1)
+    parent.append(m2, 1)
+    m1.unify(m2)
+    # every child is moved, none is skipped while iterating
+    assert list(m1.partitions[0]) == children
+    assert list(m1.partitions[1]) == [children[0]]
+    assert all(len(part) == 0 for part in m2.partitions)
+    assert list(parent.partitions[1]) == [m1]
+    assert m2.parents == set() and (parent, 1) in m1.parents
+    assert all((m2, 0) not in child.parents for child in children)
+
+def test_remove():
+    m, child, other = Machine('m'), Machine('child'), Machine('other')
+    m.append(child, 0)
+    m.append(child, 2)
+    m.append(other, 1)
+    m.remove(child)
+    assert [list(part) for part in m.partitions] == [[], [other], []]
+    assert child.parents == set()
+    assert other.parents == set([(m, 1)])
+    with pytest.raises(ValueError):
+        m.remove(child, 0)
@@ -0,0 +1,44 @@
+import json
+from StringIO import StringIO
+
+from pymachine.machine import Machine
+from pymachine.utils import MachineGraph
+
+def test_machine_graph():
+    dog, animal, has, tail = [Machine(name) for name in (
+        'dog', 'animal', 'HAS', 'tail')]
+    dog.append(animal, 0)
+    has.append(dog, 1)
+    has.append(tail, 2)
+    graph = MachineGraph.create_from_machines([dog])
+    names = dict((m, m.unique_name()) for m in (dog, animal, has, tail))
+    dot = graph.to_dot()
+    lines = dot.split('\n')
+    assert lines[:2] == ['digraph finite_state_machine {', '\tdpi=100;']
+    assert lines[-1] == '}'
+    assert lines[2:6] == sorted(lines[2:6])
+    assert u'\t{0} -> {1} [ label = "1" ];'.format(
+        names[has], names[dog]) in lines
+    assert len(lines) == 2 + 4 + 3 + 1
+
+    f = StringIO()
+    graph.write_dot(f)
+    assert f.getvalue() == dot.encode('utf-8')
+
+    d = graph.to_dict()
+    assert [node['id'] for node in d['nodes']] == sorted(names.values())
+    f = StringIO()
+    graph.write_json(f)
+    assert json.loads(f.getvalue()) == d
+    assert MachineGraph.from_dict(d).to_dot() == dot
+
+def test_multi_edges():
+    graph = MachineGraph()
+    graph.add_edge('a', 'b', 2)
+    graph.add_edge('a', 'b', 0)
+    graph.add_node('c')
+    assert graph.to_dict() == {
+        'directed': True, 'multigraph': True, 'graph': [],
+        'nodes': [{'id': 'a'}, {'id': 'b'}, {'id': 'c'}],
+        'adjacency': [[{'id': 'b', 'key': 0, 'color': 0},
+                       {'id': 'b', 'key': 1, 'color': 2}], [], []]}
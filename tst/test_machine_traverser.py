@@ -0,0 +1,43 @@
+from pymachine.machine import Machine
+from pymachine.utils import MachineTraverser
+
+def chain_of_machines(length):
+    machines = [Machine('m{0}'.format(i)) for i in xrange(length)]
+    for machine, child in zip(machines, machines[1:]):
+        machine.append(child, 0)
+    return machines
+
+def test_traverse_order():
+    root, a, b, c = [Machine(name) for name in ('root', 'a', 'B', 'c')]
+    root.append(a, 0)
+    root.append(b, 1)
+    a.append(c, 0)
+    b.append(c, 2)
+    assert [(m.printname(), depth) for m, depth
+            in MachineTraverser().traverse(root)] == [
+        ('root', 0), ('a', 1), ('c', 2), ('B', 3)]
+    assert list(MachineTraverser.get_nodes(root)) == ['root', 'a', 'c']
+    assert list(MachineTraverser.get_nodes(
+        root, exclude_words=['a'])) == ['root', 'c']
+    assert [m.printname() for m, depth in MachineTraverser(
+        'children', partitions=(0,)).traverse(root)] == ['root', 'a', 'c']
+    parents = [(m.printname(), depth) for m, depth
+               in MachineTraverser('parents').traverse(c)]
+    assert parents[0] == ('c', 0)
+    assert sorted(parents[1:]) == [('B', 1), ('a', 1), ('root', 2)]
+    assert root.unique_machines_in_tree() == set([root, a, b, c])
+
+def test_depth_bounds():
+    machines = chain_of_machines(10)
+    visited = []
+    MachineTraverser('children', max_depth=3).visit(
+        machines[0], lambda machine, depth: visited.append(depth))
+    assert visited == [0, 1, 2, 3]
+    assert [m for m, depth in MachineTraverser(
+        'parents', max_depth=2).traverse(machines[5])] == machines[3:6][::-1]
+
+def test_deep_chain():
+    # deeper than the recursion limit
+    machines = chain_of_machines(5000)
+    assert len(list(MachineTraverser.get_nodes(machines[0]))) == 5000
+    assert len(machines[0].unique_machines_in_tree()) == 5000
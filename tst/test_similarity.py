@@ -0,0 +1,419 @@
+from ConfigParser import ConfigParser
+import copy
+import itertools
+import logging
+import random
+
+import numpy as np
+import pytest
+from scipy.stats import pearsonr
+
+from pymachine.machine import Machine
+from pymachine.similarity import WordSimilarity, SparseLemmaSimilarity
+from pymachine.similarity import MinHashIndex, SimComparer, SimilarityStore
+from pymachine.similarity import Correlation, SentenceSimilarity, SimMatrix
+from pymachine.similarity import LinksNodesIndex, WordPairs
+from pymachine.similarity import merge_cache_stats
+from pymachine.utils import harmonic_mean, LRUCache
+
+class DummyWrapper(object):
+    batch = True
+
+    def __init__(self, definitions):
+        self.definitions = definitions
+
+    def get_lemma(self, word, existing_only=True, stem_first=True):
+        return word if word in self.definitions else None
+
+    def get_lemmas(self, words, existing_only=True, stem_first=True):
+        return dict((word, self.get_lemma(word)) for word in words)
+
+def random_definitions(seed, num_lemmas=60):
+    """Definitions sharing random concepts, binaries and entities."""
+    rnd = random.Random(seed)
+    names = ['w{0}'.format(i) for i in xrange(num_lemmas)] + [
+        '@ent0', '@ent1', '=AGT', 'x', 'y']
+    binaries = ['HAS', 'IS_A', 'AT', 'CAUSE']
+    pool = [Machine(rnd.choice(names)) for i in xrange(num_lemmas * 6)]
+    definitions = {}
+    for i in xrange(num_lemmas):
+        lemma = 'w{0}'.format(i)
+        definitions[lemma] = set()
+        for j in xrange(rnd.choice([1, 1, 1, 2])):
+            root = Machine(lemma)
+            for k in xrange(rnd.randint(0, 4)):
+                if rnd.random() < 0.5:
+                    root.append(rnd.choice(pool), 0)
+                else:
+                    binary = Machine(rnd.choice(binaries))
+                    binary.append(rnd.choice(pool + [root]), 1)
+                    binary.append(rnd.choice(pool), 2)
+                    root.append(binary, 0)
+            definitions[lemma].add(root)
+    return definitions
+
+def test_sparse_lemma_similarity():
+    for seed in xrange(3):
+        definitions = random_definitions(seed)
+        for sim_type in SparseLemmaSimilarity.sim_types:
+            word_sim = WordSimilarity(DummyWrapper(definitions))
+            sims = SparseLemmaSimilarity(
+                word_sim, sim_type, block_size=16).lemma_similarities(
+                    definitions.keys())
+            for lemma1, lemma2 in itertools.combinations(
+                    sorted(definitions), 2):
+                sim = sims.get((lemma1, lemma2), sims.get((lemma2, lemma1), 0))
+                # the types matter, too: 1 and 1.0 are printed differently
+                assert repr(sim) == repr(word_sim.lemma_similarity(
+                    lemma1, lemma2, sim_type))
+            # the blocks can be split among worker processes
+            parallel_sims = SparseLemmaSimilarity(
+                word_sim, sim_type, block_size=16,
+                processes=3).lemma_similarities(definitions.keys())
+            assert map(repr, sorted(parallel_sims.iteritems())) == map(
+                repr, sorted(sims.iteritems()))
+
+def test_min_hash_index():
+    definitions = random_definitions(0)
+    word_sim = WordSimilarity(DummyWrapper(definitions))
+    index = MinHashIndex(word_sim)
+    index.build()
+    for lemma in sorted(definitions)[:20]:
+        exact = {}
+        for other in definitions:
+            if other != lemma:
+                exact[other] = max(
+                    word_sim._links_and_nodes_similarity(machine1, machine2)
+                    for machine1 in definitions[lemma]
+                    for machine2 in definitions[other])
+        result = index.most_similar(lemma, k=len(definitions))
+        assert [sim for other, sim in result] == sorted(
+            [sim for other, sim in result], reverse=True)
+        for other, sim in result:
+            assert sim == exact[other]
+        # lemmas connected by a 0-path are never missed
+        found = set(other for other, sim in result)
+        assert all(other in found for other, sim in exact.iteritems()
+                   if isinstance(sim, int) and sim == 1)
+
+class DummyComparer(SimComparer):
+    """A SimComparer comparing the lemmas of random_definitions()."""
+    def __init__(self, definitions, sim_file, processes):
+        self.config = ConfigParser()
+        self.config.add_section('machine')
+        self.config.set('machine', 'sim_file', sim_file)
+        self.config.set('machine', 'sim_processes', str(processes))
+        wrapper = DummyWrapper(definitions)
+        self.sim_wrapper = WordSimilarity(wrapper)
+        self.sorted_word_pairs = set(itertools.combinations(
+            sorted(wrapper.definitions), 2))
+
+    def get_batch_sims(self):
+        return self.sim
+
+    def sim(self, w1, w2):
+        return self.sim_wrapper.lemma_similarity(w1, w2, 'default')
+
+def test_parallel_machine_sims(tmpdir):
+    # equally similar machines are ordered by their ids in lemma_similarity,
+    # so both runs need the same machines
+    definitions = random_definitions(0)
+    results = []
+    for processes in (1, 3):
+        sim_file = str(tmpdir.join('sims{0}'.format(processes)))
+        comparer = DummyComparer(definitions, sim_file, processes)
+        comparer.get_machine_sims()
+        results.append((open(sim_file).read(), comparer.machine_sims))
+    assert results[0] == results[1]
+    assert sorted(tmpdir.listdir()) == [
+        tmpdir.join('sims1'), tmpdir.join('sims3')]
+
+def test_merge_cache_stats():
+    stats = [{'lemma_sim_cache': {'size': size, 'max_size': None, 'hits': 1,
+                                  'misses': 2, 'evictions': 0}}
+             for size in (3, 5)]
+    assert merge_cache_stats(stats) == {'lemma_sim_cache': {
+        'size': 5, 'max_size': None, 'hits': 2, 'misses': 4, 'evictions': 0}}
+
+def test_parallel_cache_stats(tmpdir, caplog):
+    comparer = DummyComparer(random_definitions(0, num_lemmas=20),
+                             str(tmpdir.join('sims')), 2)
+    with caplog.at_level(logging.WARNING):
+        comparer.get_machine_sims()
+    [message] = [record.getMessage() for record in caplog.records
+                 if record.getMessage().startswith('cache stats: ')]
+    assert "'lemma_sim_cache'" in message
+
+def test_sparse_machine_sims(tmpdir):
+    definitions = random_definitions(5, num_lemmas=30)
+    results = []
+    for sparse, processes in ((False, 1), (True, 1), (True, 3)):
+        sim_file = str(tmpdir.join('sims{0}{1}'.format(sparse, processes)))
+        comparer = DummyComparer(definitions, sim_file, processes)
+        comparer.config.set('machine', 'sparse_sims', str(sparse))
+        # the engine does not depend on the batch flag of the wrapper
+        comparer.sim_wrapper.wrapper.batch = not sparse
+        comparer.get_batch_sims = lambda: SimComparer.get_batch_sims(comparer)
+        comparer.get_machine_sims()
+        results.append(open(sim_file).read())
+    assert results[0] == results[1] == results[2]
+
+def test_lru_cache():
+    cache = LRUCache(2)
+    cache['a'] = 1
+    cache['b'] = 2
+    assert cache.get('a') == 1
+    cache['c'] = 3
+    assert 'b' not in cache
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.stats() == {'size': 2, 'max_size': 2, 'hits': 3,
+                             'misses': 1, 'evictions': 1}
+
+def test_bounded_caches():
+    definitions = random_definitions(1, num_lemmas=30)
+    word_sim = WordSimilarity(DummyWrapper(definitions))
+    small_sim = WordSimilarity(DummyWrapper(definitions), LRUCache(10),
+                               LRUCache(5))
+    for lemma1, lemma2 in itertools.combinations(sorted(definitions), 2):
+        assert repr(small_sim.lemma_similarity(lemma1, lemma2, 'default')) \
+            == repr(word_sim.lemma_similarity(lemma1, lemma2, 'default'))
+    stats = small_sim.cache_stats()
+    assert stats['lemma_sim_cache']['size'] == 10
+    assert stats['links_nodes_cache']['size'] == 5
+    assert stats['links_nodes_cache']['evictions'] > 0
+    # definitions are cached by lemma, not by machine
+    assert all(isinstance(key[0], str)
+               for key in word_sim.links_nodes_cache.items)
+
+def test_definition_key():
+    definitions = random_definitions(1, num_lemmas=30)
+    copied = copy.deepcopy(definitions)
+    word_sim = WordSimilarity(DummyWrapper(definitions))
+    copied_sim = WordSimilarity(DummyWrapper(copied))
+    for lemma in definitions:
+        keys = sorted(map(word_sim.definition_key, definitions[lemma]))
+        # the same in another process, where the sets are ordered otherwise
+        assert keys == sorted(map(copied_sim.definition_key, copied[lemma]))
+        assert all(key is None or key[0] == lemma for key in keys)
+    assert word_sim.definition_key(Machine('w0')) is None
+    # the keys are computed once per lemma
+    assert sorted(word_sim.definition_keys) == sorted(definitions)
+    # definitions with the same signature cannot be told apart
+    definitions['w0'] = set([Machine('w0'), Machine('w0')])
+    word_sim = WordSimilarity(DummyWrapper(definitions))
+    assert [word_sim.definition_key(machine)
+            for machine in definitions['w0']] == [None, None]
+
+def test_similarity_store(tmpdir):
+    definitions = random_definitions(2, num_lemmas=20)
+    store_fn = str(tmpdir.join('sims.db'))
+    word_sim = WordSimilarity(DummyWrapper(definitions),
+                              store=SimilarityStore(store_fn, 'lexicon1'))
+    pairs = list(itertools.combinations(sorted(definitions), 2))
+    sims = [word_sim.lemma_similarity(lemma1, lemma2, sim_type)
+            for lemma1, lemma2 in pairs for sim_type in ('default', 'links')]
+    word_sim.flush()
+
+    # a new run reads everything from the store
+    stored_sim = WordSimilarity(DummyWrapper({}),
+                                store=SimilarityStore(store_fn, 'lexicon1'))
+    assert map(repr, sims) == [
+        repr(stored_sim.lemma_similarity(lemma2, lemma1, sim_type))
+        for lemma1, lemma2 in pairs for sim_type in ('default', 'links')]
+    # but not with other definitions
+    assert SimilarityStore(store_fn, 'lexicon2').get(
+        pairs[0][0], pairs[0][1], 'default') is None
+
+def test_similarity_store_get_all(tmpdir):
+    store_fn = str(tmpdir.join('sims.db'))
+    store = SimilarityStore(store_fn, 'lexicon')
+    store.put('a', 'b', 'default', 1)
+    store.put('caf\xc3\xa9', 'a', 'default', 0.5)
+    store.flush()
+    store.put('b', 'c', 'default', 0.25)
+    store.put('a', 'c', 'links', 0.75)
+    pairs = [('a', 'b'), ('b', 'a'), ('a', 'caf\xc3\xa9'), ('b', 'c'),
+             ('a', 'c'), ('c', 'd')]
+    expected = {('a', 'b'): 1, ('b', 'a'): 1, ('a', 'caf\xc3\xa9'): 0.5,
+                ('b', 'c'): 0.25}
+    assert store.get_all(pairs, 'default') == expected
+    assert dict((pair, store.get(pair[0], pair[1], 'default'))
+                for pair in pairs if pair in expected) == expected
+    # the temporary table is emptied
+    assert store.get_all([('c', 'd')], 'default') == {}
+    assert SimilarityStore(store_fn, 'lexicon2').get_all(pairs, 'default') \
+        == {}
+
+def test_stored_batch_sims(tmpdir):
+    definitions = random_definitions(3, num_lemmas=20)
+    lemmas = dict((lemma, lemma) for lemma in definitions)
+    comparer = DummyComparer(definitions, str(tmpdir.join('sims')), 1)
+    store_fn = str(tmpdir.join('sims.db'))
+    # the first run computes half of the pairs, the second one the rest
+    all_pairs = comparer.sorted_word_pairs
+    comparer.sorted_word_pairs = set(sorted(all_pairs)[::2])
+    comparer.get_stored_batch_sims(
+        lemmas, SimilarityStore(store_fn, 'lexicon'))
+    comparer.sorted_word_pairs = all_pairs
+    store = SimilarityStore(store_fn, 'lexicon')
+    sims = comparer.get_stored_batch_sims(lemmas, store)
+    for lemma1, lemma2 in all_pairs:
+        assert repr(sims[(lemma1, lemma2)]) == repr(
+            comparer.sim_wrapper.lemma_similarity(lemma1, lemma2, 'default'))
+
+def test_binary_machine_sims(tmpdir):
+    definitions = random_definitions(4, num_lemmas=20)
+    comparer = DummyComparer(definitions, str(tmpdir.join('sims')), 1)
+    comparer.get_machine_sims()
+    text_sims = comparer.machine_sims
+    for processes in (1, 3):
+        sim_file = str(tmpdir.join('sims{0}'.format(processes)))
+        comparer = DummyComparer(definitions, sim_file, processes)
+        comparer.config.add_section('words')
+        comparer.config.set('words', 'binary_sims', 'true')
+        comparer.non_oov = set(definitions)
+        comparer.sorted_word_pairs = WordPairs(definitions)
+        comparer.get_machine_sims()
+        matrix = SimMatrix.load(sim_file)
+        assert matrix.words == sorted(definitions)
+        assert len(matrix.sims) == 20 * 19 / 2
+        for (w1, w2), sim in text_sims.iteritems():
+            assert matrix[(w2, w1)] == np.float32(sim)
+
+def test_word_pairs():
+    words = ['b', 'd', 'a', 'c']
+    pairs = WordPairs(words)
+    assert len(pairs) == 6
+    assert list(pairs) == sorted(
+        (w1, w2) for w1 in words for w2 in words if w1 < w2)
+    for n in xrange(5):
+        pairs = WordPairs(words[:n])
+        all_pairs = list(pairs)
+        for start in xrange(len(pairs) + 1):
+            for end in xrange(start, len(pairs) + 2):
+                assert list(pairs.slice(start, end)) == all_pairs[start:end]
+    matrix = SimMatrix(pairs.words, np.arange(6))
+    assert [matrix[pair] for pair in pairs] == range(6)
+
+def test_correlation():
+    rnd = np.random.RandomState(0)
+    xs = rnd.rand(10000) + 1e6
+    ys = xs * 0.02 + rnd.rand(10000)
+    correlation = Correlation()
+    for start in xrange(0, 10000, 777):
+        correlation.update(xs[start:start + 777], ys[start:start + 777])
+    r, p = correlation.correlation()
+    expected_r, expected_p = pearsonr(xs, ys)
+    assert correlation.n == 10000
+    assert abs(r - expected_r) < 1e-9
+    assert abs(p - expected_p) < 1e-9
+
+def test_most_similar():
+    definitions = random_definitions(5, num_lemmas=40)
+    word_sim = WordSimilarity(DummyWrapper(definitions))
+    lemmas = sorted(definitions)
+    for sim_type in ('default', 'links', 'strict_links'):
+        for lemma in lemmas[:10]:
+            row = word_sim.similarity_row(lemma, lemmas + ['oov'], sim_type)
+            expected = [word_sim.lemma_similarity(lemma, other, sim_type)
+                        for other in lemmas] + [None]
+            assert map(repr, row) == map(repr, expected)
+            top = sorted(((other, sim) for other, sim in zip(lemmas, row)
+                          if other != lemma and sim > 0),
+                         key=lambda (other, sim): (-sim, other))
+            assert word_sim.most_similar(lemma, 5, sim_type) == top[:5]
+            assert word_sim.most_similar(
+                lemma, 5, sim_type, candidates=lemmas[::2]) == [
+                    (other, sim) for other, sim in top
+                    if other in lemmas[::2]][:5]
+    assert word_sim.most_similar('oov') == []
+
+def test_batch_sentence_similarity():
+    definitions = random_definitions(6, num_lemmas=30)
+    lemmas = sorted(definitions)
+    rnd = random.Random(0)
+    sen_sim = SentenceSimilarity(DummyWrapper(definitions),
+                                 symmetric_fallback=True)
+    fallbacks = [lambda a, b, c, d: 0.0,
+                 lambda a, b, c, d: 0.5 if a[0] == b[0] else None]
+    for i in xrange(50):
+        sen1, sen2 = [
+            [{'token': rnd.choice(lemmas + ['oov1', 'oov2'])}
+             for j in xrange(rnd.randint(1, 8))] for k in xrange(2)]
+        for fallback in fallbacks:
+            try:
+                expected = harmonic_mean((
+                    sen_sim.directional_sen_similarity(sen1, sen2, fallback),
+                    sen_sim.directional_sen_similarity(sen2, sen1, fallback)))
+            except Exception:
+                # a word without any similarity
+                with pytest.raises(Exception):
+                    sen_sim.sentence_similarity(sen1, sen2, fallback)
+                continue
+            assert sen_sim.sentence_similarity(
+                sen1, sen2, fallback) == expected
+
+def test_asymmetric_fallback():
+    definitions = random_definitions(6, num_lemmas=30)
+    wrapper = DummyWrapper(definitions)
+    sen_sim = SentenceSimilarity(wrapper)
+    sen1 = [{'token': 'oov1'}, {'token': 'w0'}]
+    sen2 = [{'token': 'oov22'}, {'token': 'w1'}]
+
+    def fallback(a, b, c, d):
+        return 0.1 * len(a)
+    expected = harmonic_mean((
+        sen_sim.directional_sen_similarity(sen1, sen2, fallback),
+        sen_sim.directional_sen_similarity(sen2, sen1, fallback)))
+    # the batch flag of the wrapper does not change the scores
+    for batch in (True, False):
+        wrapper.batch = batch
+        assert sen_sim.sentence_similarity(sen1, sen2, fallback) == expected
+
+def test_process_file(tmpdir):
+    definitions = random_definitions(7, num_lemmas=30)
+    lemmas = sorted(definitions)
+    rnd = random.Random(0)
+    lines = []
+    for i in xrange(100):
+        sen1, sen2 = [' '.join(rnd.choice(lemmas)
+                               for j in xrange(rnd.randint(1, 6)))
+                      for k in xrange(2)]
+        lines.append('{0}\t{1}\n'.format(sen1, sen2))
+
+    def parser(fields):
+        sen1, sen2 = [field.split() for field in fields]
+        return sen1, sen2, [(None, None)] * len(sen1), [
+            (None, None)] * len(sen2)
+    sen_sim = SentenceSimilarity(DummyWrapper(definitions))
+    expected = ['{0}\n'.format(sen_sim.line_similarity(
+        line, parser, lambda sen: sen, lambda a, b, c, d: 0.0))
+        for line in lines]
+    for processes in (1, 3):
+        out_fn = str(tmpdir.join('out{0}'.format(processes)))
+        with open(out_fn, 'w') as out_file:
+            sen_sim.process_file(iter(lines), out_file, parser,
+                                 lambda sen: sen, lambda a, b, c, d: 0.0,
+                                 processes=processes, chunk_size=7)
+        assert open(out_fn).readlines() == expected
+
+def test_links_nodes_index(tmpdir):
+    definitions = random_definitions(8)
+    word_sim = WordSimilarity(DummyWrapper(definitions))
+    index_fn = str(tmpdir.join('links_nodes'))
+    LinksNodesIndex.build(word_sim, 'lexicon').save(index_fn)
+    assert LinksNodesIndex.load(index_fn, 'other lexicon') is None
+    index = LinksNodesIndex.load(index_fn, 'lexicon')
+    indexed_sim = WordSimilarity(DummyWrapper(definitions))
+    indexed_sim.links_nodes_index = index
+    found = 0
+    for lemma in definitions:
+        for machine in definitions[lemma]:
+            links_nodes = index.get(machine)
+            expected = word_sim.get_links_nodes(machine, use_cache=False)
+            if links_nodes is not None:
+                assert links_nodes == expected
+                found += 1
+            assert indexed_sim.get_links_nodes(machine) == expected
+    assert found > 0.9 * sum(map(len, definitions.itervalues()))
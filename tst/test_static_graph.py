@@ -0,0 +1,222 @@
+import os
+
+from pymachine.definition_parser import read as read_defs, read_cached
+from pymachine.definition_parser import LazyDefinitions
+from pymachine.lexicon import Lexicon
+from pymachine.machine import Machine
+from pymachine.control import ConceptControl
+
+tst_dir = os.path.dirname(os.path.abspath(__file__))
+
+def build_lexicon(compact):
+    definitions = read_defs(
+        open(os.path.join(tst_dir, 'static_test_definitions')),
+        os.path.join(tst_dir, 'static_test_plurals'), three_parts=True)
+    lexicon = Lexicon()
+    lexicon.add_static(definitions.itervalues())
+    lexicon.finalize_static(compact=compact)
+    return lexicon
+
+def partition_names(machine):
+    return [sorted(m.printname() for m in part)
+            for part in machine.partitions]
+
+def test_compact_static():
+    plain, compact = build_lexicon(False), build_lexicon(True)
+    assert sorted(plain.static.keys()) == sorted(compact.static.keys())
+    for pn, machines in plain.static.iteritems():
+        compact_machines = compact.get_static_machine(pn)
+        assert len(machines) == len(compact_machines)
+        for m1, m2 in zip(machines, compact_machines):
+            assert m1.printname_ == m2.printname_
+            assert partition_names(m1) == partition_names(m2)
+            assert (sorted((p.printname(), i) for p, i in m1.parents) ==
+                    sorted((p.printname(), i) for p, i in m2.parents))
+
+def test_compact_expand():
+    active = []
+    for compact in (False, True):
+        lexicon = build_lexicon(compact)
+        machine = Machine('vet', ConceptControl())
+        lexicon.add_active(machine)
+        lexicon.expand(machine)
+        active.append(dict(
+            (pn, partition_names(machines.keys()[0]))
+            for pn, machines in lexicon.active.iteritems()))
+    assert active[0] == active[1]
+
+def test_compact_definition_graph():
+    graphs = []
+    for compact in (False, True):
+        def_graph = build_lexicon(compact).extract_definition_graph()
+        graphs.append(dict((pn, partition_names(machines[0]))
+                           for pn, machines in def_graph.iteritems()))
+    assert graphs[0] == graphs[1]
+
+def test_snapshot():
+    import shutil
+    import tempfile
+    lexicon = build_lexicon(False)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        snapshot = os.path.join(tmp_dir, 'static.snapshot')
+        lexicon.save_static(snapshot)
+        loaded = Lexicon()
+        loaded.load_static(snapshot)
+        assert sorted(lexicon.static.keys()) == sorted(loaded.static.keys())
+        for pn, machines in lexicon.static.iteritems():
+            loaded_machines = loaded.get_static_machine(pn)
+            assert [partition_names(m) for m in machines] == [
+                partition_names(m) for m in loaded_machines]
+        assert loaded.static_disambig['vet'] == set(['vet'])
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_lazy_definitions():
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        def_file = os.path.join(tmp_dir, 'static_test_definitions')
+        shutil.copy(os.path.join(tst_dir, 'static_test_definitions'), def_file)
+        lazy = LazyDefinitions(
+            [(def_file, 0)], os.path.join(tst_dir, 'static_test_plurals'),
+            three_parts=True)
+        eager = build_lexicon(False)
+        lexicon = Lexicon()
+        lexicon.set_definition_source(lazy)
+        lexicon.finalize_static()
+        active = []
+        for lex in (eager, lexicon):
+            machine = Machine('vet', ConceptControl())
+            lex.add_active(machine)
+            lex.expand(machine)
+            active.append(dict(
+                (pn, partition_names(machines.keys()[0]))
+                for pn, machines in lex.active.iteritems()))
+        assert active[0] == active[1]
+        assert len(lexicon.static) < len(eager.static)
+        assert os.path.exists(def_file + '.index')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def lazy_lexicon(tmp_dir):
+    import shutil
+    def_file = os.path.join(tmp_dir, 'static_test_definitions')
+    shutil.copy(os.path.join(tst_dir, 'static_test_definitions'), def_file)
+    lazy = LazyDefinitions(
+        [(def_file, 0)], os.path.join(tst_dir, 'static_test_plurals'),
+        three_parts=True)
+    lexicon = Lexicon()
+    lexicon.set_definition_source(lazy)
+    lexicon.finalize_static()
+    return lexicon
+
+def activation_state(lexicon):
+    return (sorted(lexicon.static.keys()),
+            dict((key, sorted(deps))
+                 for key, deps in lexicon.activation_deps.iteritems()),
+            dict((pn, sorted(keys))
+                 for pn, keys in lexicon.activation_index.iteritems() if keys),
+            sorted(lexicon.activation_roots),
+            dict((pn, [partition_names(m) for m in machines])
+                 for pn, machines in lexicon.static.iteritems()))
+
+def test_lazy_incremental_index():
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        lexicon = lazy_lexicon(tmp_dir)
+        for printname in ('vet', 'horse', 'heal', 'zebra', 'animal'):
+            lexicon.get_static_machine(printname)
+        incremental = activation_state(lexicon)
+        lexicon.finalize_static()
+        assert incremental == activation_state(lexicon)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_lazy_activate():
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        lexicon = lazy_lexicon(tmp_dir)
+        for printname in ('HAS', 'hair', 'HEAL', 'animal'):
+            lexicon.add_active(Machine(printname, ConceptControl()))
+        # definitions not loaded yet are not activated
+        assert lexicon.activate() == []
+        # loading a definition whose dependencies are already active makes it
+        # a candidate for the next call
+        lexicon.get_static_machine('vet')
+        assert [m.printname() for m in lexicon.activate()] == ['vet']
+        lexicon.get_static_machine('zebra')
+        assert [m.printname() for m in lexicon.activate()] == ['zebra']
+        assert lexicon.activate() == []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+def test_add_static_keeps_definitions():
+    definitions = read_defs(
+        open(os.path.join(tst_dir, 'static_test_definitions')),
+        os.path.join(tst_dir, 'static_test_plurals'), three_parts=True)
+    before = dict((pn, [partition_names(m) for m in machines])
+                  for pn, machines in definitions.iteritems())
+    lexicons = []
+    for i in xrange(2):
+        lexicon = Lexicon()
+        lexicon.add_static(definitions.itervalues())
+        lexicon.finalize_static()
+        lexicons.append(dict(
+            (pn, [partition_names(m) for m in machines])
+            for pn, machines in lexicon.static.iteritems()))
+    assert before == dict((pn, [partition_names(m) for m in machines])
+                          for pn, machines in definitions.iteritems())
+    assert lexicons[0] == lexicons[1]
+
+def test_activate():
+    for compact in (False, True):
+        lexicon = build_lexicon(compact)
+        for printname in ('HAS', 'hair', 'HEAL', 'animal'):
+            lexicon.add_active(Machine(printname, ConceptControl()))
+        assert [m.printname() for m in lexicon.activate()] == ['vet', 'zebra']
+        assert lexicon.activate() == []
+        lexicon.clear_active()
+        lexicon.add_active(Machine('animal', ConceptControl()))
+        assert [m.printname() for m in lexicon.activate()] == ['zebra']
+
+def test_parallel_read():
+    results = []
+    for processes in (1, 3):
+        definitions = read_defs(
+            open(os.path.join(tst_dir, 'static_test_definitions')),
+            os.path.join(tst_dir, 'static_test_plurals'), three_parts=True,
+            processes=processes)
+        results.append(dict(
+            (pn, [partition_names(m) for m in machines])
+            for pn, machines in definitions.iteritems()))
+    assert results[0] == results[1]
+
+def test_definition_cache():
+    import shutil
+    import tempfile
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        def_file = os.path.join(tmp_dir, 'static_test_definitions')
+        shutil.copy(os.path.join(tst_dir, 'static_test_definitions'), def_file)
+        plur_file = os.path.join(tst_dir, 'static_test_plurals')
+        first = read_cached(def_file, plur_file, three_parts=True)
+        cache_files = [fn for fn in os.listdir(tmp_dir)
+                       if fn.endswith('.pickle')]
+        assert len(cache_files) == 1
+        second = read_cached(def_file, plur_file, three_parts=True)
+        assert sorted(first.keys()) == sorted(second.keys())
+        with open(def_file, 'a') as f:
+            f.write('dog\t#\t#\t#\t7\t#\tN\tanimal\t\n')
+        third = read_cached(def_file, plur_file, three_parts=True)
+        assert 'dog' in third and 'dog' not in first
+        new_cache_files = [fn for fn in os.listdir(tmp_dir)
+                           if fn.endswith('.pickle')]
+        assert len(new_cache_files) == 1 and new_cache_files != cache_files
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,85 @@
+import json
+import os
+import shutil
+import tempfile
+
+from pymachine.machine import Machine
+from pymachine.wrapper import Wrapper
+
+class DummyWrapper(Wrapper):
+    def __init__(self, definitions):
+        self.definitions = definitions
+        self.graph_processes = 1
+
+def definition(name, *children):
+    machine = Machine(name)
+    for child in children:
+        machine.append(Machine(child), 0)
+    return machine
+
+def test_draw_word_graphs():
+    path = tempfile.mkdtemp()
+    try:
+        wrapper = DummyWrapper({
+            'dog': set([definition('dog', 'animal'),
+                        definition('dog', 'follow')]),
+            'cat': set([definition('cat', 'animal')]),
+            'mouse': set([definition('mouse', 'animal', 'small')])})
+        wrapper.draw_word_graphs(path, processes=2)
+        with open(os.path.join(path, 'index.json')) as f:
+            manifest = json.load(f)
+        assert sorted(manifest) == ['cat', 'dog', 'mouse']
+        assert manifest['dog']['files'] == ['dog_0.dot', 'dog_1.dot']
+        assert sorted(os.listdir(path)) == [
+            'cat_0.dot', 'dog_0.dot', 'dog_1.dot', 'index.json', 'mouse_0.dot']
+        # the fingerprints do not depend on the identity of the machines
+        other = DummyWrapper({'dog': set([definition('dog', 'follow'),
+                                          definition('dog', 'animal')])})
+        other_path = tempfile.mkdtemp()
+        try:
+            assert other.draw_word_graph('dog', other_path) == (
+                manifest['dog'], True)
+        finally:
+            shutil.rmtree(other_path)
+
+        mtimes = dict((fn, os.path.getmtime(os.path.join(path, fn)))
+                      for fn in os.listdir(path))
+        os.utime(os.path.join(path, 'cat_0.dot'), (0, 0))
+        wrapper.definitions['cat'] = set([definition('cat', 'pet')])
+        del wrapper.definitions['mouse']
+        wrapper.draw_word_graphs(path)
+        with open(os.path.join(path, 'index.json')) as f:
+            new_manifest = json.load(f)
+        assert new_manifest['dog'] == manifest['dog']
+        assert new_manifest['cat'] != manifest['cat']
+        assert 'mouse' not in new_manifest
+        assert sorted(os.listdir(path)) == [
+            'cat_0.dot', 'dog_0.dot', 'dog_1.dot', 'index.json']
+        assert os.path.getmtime(os.path.join(path, 'cat_0.dot')) > 0
+        for fn in ('dog_0.dot', 'dog_1.dot'):
+            assert os.path.getmtime(os.path.join(path, fn)) == mtimes[fn]
+    finally:
+        shutil.rmtree(path)
+
+def test_non_ascii_word_graphs():
+    path = tempfile.mkdtemp()
+    try:
+        # headwords as UTF-8 byte strings and as unicode
+        wrapper = DummyWrapper({
+            'caf\xc3\xa9': set([definition(u'caf\xe9', 'drink')]),
+            u'na\xefve': set([definition(u'na\xefve', 'simple')])})
+        wrapper.draw_word_graphs(path)
+        with open(os.path.join(path, 'index.json')) as f:
+            manifest = json.load(f)
+        assert manifest[u'caf\xe9']['files'] == [u'caf\xe9_0.dot']
+        assert manifest[u'na\xefve']['files'] == [u'na\xefve_0.dot']
+        assert sorted(os.listdir(path)) == [
+            'caf\xc3\xa9_0.dot', 'index.json', 'na\xc3\xafve_0.dot']
+        # the manifest entries are found by the next run
+        mtime = os.path.getmtime(os.path.join(path, 'caf\xc3\xa9_0.dot'))
+        os.utime(os.path.join(path, 'caf\xc3\xa9_0.dot'), (0, 0))
+        wrapper.draw_word_graphs(path)
+        assert os.path.getmtime(
+            os.path.join(path, 'caf\xc3\xa9_0.dot')) == 0 < mtime
+    finally:
+        shutil.rmtree(path)